@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+
+# attstandin.py
+#
+# A stand-in for the bed's ATT server, for trying the att transport
+# (atttransport.py) without a bed, or without bluetooth at all.  It answers on
+# one end of a socketpair (SOCK_SEQPACKET, so each packet arrives whole, the
+# same as on L2CAP) with the same services, characteristics and handles as
+# the bed, and moves the head, feet and tilt when the whole position is
+# written, the same as the bed does.
+#
+#     sock, server = attstandin.pair(latency=0.0075)
+#     bed = AttTransport(connector=lambda mac, timeout: sock)
+#
+# latency is how long it takes to answer each request (a connection interval
+# or two on a real bed), and commands are taken in the order they come.
+# readMultiple is which of Read Multiple Variable and Read Multiple it
+# answers ("variable" answers both, "fixed" only the older one, and None
+# neither, the same as a bed that doesn't have them).
+
+import socket
+import struct
+import threading
+import time
+
+from atttransport import (uuidBytes, DEFAULT_MTU, MTU, ERROR_RSP, EXCHANGE_MTU_REQ, EXCHANGE_MTU_RSP, FIND_INFORMATION_REQ,
+	FIND_INFORMATION_RSP, READ_BY_TYPE_REQ, READ_BY_TYPE_RSP, READ_REQ, READ_BLOB_REQ, READ_BY_GROUP_TYPE_REQ,
+	READ_BY_GROUP_TYPE_RSP, WRITE_REQ, WRITE_RSP, HANDLE_VALUE_NTF, HANDLE_VALUE_CFM, WRITE_CMD, ATTRIBUTE_NOT_FOUND,
+	REQUEST_NOT_SUPPORTED, PRIMARY_SERVICE, CHARACTERISTIC, CLIENT_CONFIGURATION, READ_MULTIPLE_REQ, READ_MULTIPLE_RSP,
+	READ_MULTIPLE_VARIABLE_REQ, READ_MULTIPLE_VARIABLE_RSP)
+
+BASE = "-f324-29c3-38d1-85c0c2e86885"
+
+# The bed's characteristics, in handle order: UUID, properties, whether it
+# can notify (which gives it a client configuration descriptor), and the
+# value it starts with.
+BED_CHARACTERISTICS = [
+	("db8010d0" + BASE, 0x0e, False, bytes.fromhex("0000002400000000000000")),
+	("db801041" + BASE, 0x1e, True, b"\x00"),
+	("db801042" + BASE, 0x1e, True, b"\x00"),
+	("db801040" + BASE, 0x1e, True, b"\x24"),
+	("db801061" + BASE, 0x0e, False, b"\x00"),
+	("db801060" + BASE, 0x0e, False, b"\x00"),
+	("db801080" + BASE, 0x0e, False, b"\x00"),
+	("db8010a0" + BASE, 0x0e, False, b"\x00"),
+]
+
+def uuid16(value):
+	return struct.pack("<H", value)
+
+class Attribute:
+	def __init__(self, handle, attributeType, value, properties=0x02):
+		self.handle = handle
+		self.type = attributeType
+		self.value = value
+		self.properties = properties
+
+class StandInServer:
+	def __init__(self, sock, latency=0.0, readMultiple="variable"):
+		self.sock = sock
+		self.latency = latency
+		self.readMultiple = readMultiple
+		self.mtu = DEFAULT_MTU
+		self.requests = 0
+		self.notifying = set()
+		self.attributes = []
+		self.services = []
+		self.valueHandles = {}
+
+		self.addService(uuid16(0x1800), [("00002a00-0000-1000-8000-00805f9b34fb", 0x02, False, b"RevCB_A1")])
+		self.addService(uuidBytes("db801000" + BASE), BED_CHARACTERISTICS)
+
+	def add(self, attributeType, value, properties=0x02):
+		attribute = Attribute(len(self.attributes) + 1, attributeType, value, properties)
+		self.attributes.append(attribute)
+		return attribute
+
+	def addService(self, uuid, characteristics):
+		start = len(self.attributes) + 1
+		self.add(uuid16(PRIMARY_SERVICE), uuid)
+		for uuid, properties, notifies, value in characteristics:
+			valueHandle = len(self.attributes) + 2
+			self.add(uuid16(CHARACTERISTIC), struct.pack("<BH", properties, valueHandle) + uuidBytes(uuid))
+			self.add(uuidBytes(uuid), value, properties)
+			self.valueHandles[uuid] = valueHandle
+			if notifies:
+				self.add(uuid16(CLIENT_CONFIGURATION), b"\x00\x00", 0x0a)
+		self.services.append((start, len(self.attributes)))
+
+	def attribute(self, handle):
+		if 1 <= handle <= len(self.attributes):
+			return self.attributes[handle - 1]
+		return None
+
+	def value(self, uuid):
+		return self.attribute(self.valueHandles[uuid]).value
+
+	def start(self):
+		threading.Thread(target=self.serve, name="attstandin", daemon=True).start()
+		return self
+
+	def serve(self):
+		while True:
+			try:
+				pdu = self.sock.recv(1024)
+			except OSError:
+				return
+			if not pdu:
+				return
+			reply = self.handle(pdu)
+			if reply is not None:
+				if self.latency:
+					time.sleep(self.latency)
+				self.sock.send(reply)
+
+	def error(self, op, handle, code):
+		return struct.pack("<BBHB", ERROR_RSP, op, handle, code)
+
+	def handle(self, pdu):
+		op = pdu[0]
+		if op & 0x40 or op == HANDLE_VALUE_CFM:
+			if op == WRITE_CMD:
+				self.write(struct.unpack_from("<H", pdu, 1)[0], pdu[3:])
+			return None
+
+		self.requests += 1
+		if op == EXCHANGE_MTU_REQ:
+			self.mtu = max(DEFAULT_MTU, min(MTU, struct.unpack_from("<H", pdu, 1)[0]))
+			return struct.pack("<BH", EXCHANGE_MTU_RSP, MTU)
+		if op == READ_REQ or op == READ_BLOB_REQ:
+			handle = struct.unpack_from("<H", pdu, 1)[0]
+			offset = struct.unpack_from("<H", pdu, 3)[0] if op == READ_BLOB_REQ else 0
+			attribute = self.attribute(handle)
+			if attribute is None:
+				return self.error(op, handle, 0x01)
+			return bytes([op + 1]) + attribute.value[offset:offset + self.mtu - 1]
+		if (op == READ_MULTIPLE_VARIABLE_REQ and self.readMultiple == "variable") or (op == READ_MULTIPLE_REQ and self.readMultiple):
+			handles = struct.unpack_from("<%dH" % ((len(pdu) - 1) // 2), pdu, 1)
+			for handle in handles:
+				if self.attribute(handle) is None:
+					return self.error(op, handle, 0x01)
+			if op == READ_MULTIPLE_REQ:
+				reply = b"".join(self.attribute(handle).value for handle in handles)
+			else:
+				reply = b"".join(struct.pack("<H", len(self.attribute(handle).value)) + self.attribute(handle).value for handle in handles)
+			return (bytes([op + 1]) + reply)[:self.mtu]
+		if op == WRITE_REQ:
+			handle = struct.unpack_from("<H", pdu, 1)[0]
+			if self.attribute(handle) is None:
+				return self.error(op, handle, 0x01)
+			self.write(handle, pdu[3:])
+			return bytes([WRITE_RSP])
+		if op == READ_BY_GROUP_TYPE_REQ:
+			start, end, attributeType = struct.unpack_from("<HHH", pdu, 1)
+			entries = [struct.pack("<HH", first, last) + self.attribute(first).value
+				for first, last in self.services if start <= first <= end]
+			return self.entries(op, READ_BY_GROUP_TYPE_RSP, start, entries)
+		if op == READ_BY_TYPE_REQ:
+			start, end, attributeType = struct.unpack_from("<HHH", pdu, 1)
+			entries = [struct.pack("<H", attribute.handle) + attribute.value for attribute in self.attributes
+				if start <= attribute.handle <= end and attribute.type == uuid16(attributeType)]
+			return self.entries(op, READ_BY_TYPE_RSP, start, entries)
+		if op == FIND_INFORMATION_REQ:
+			start, end = struct.unpack_from("<HH", pdu, 1)
+			found = [attribute for attribute in self.attributes if start <= attribute.handle <= end]
+			if not found:
+				return self.error(op, start, ATTRIBUTE_NOT_FOUND)
+			size = len(found[0].type)
+			found = [attribute for attribute in found if len(attribute.type) == size][:(self.mtu - 2) // (size + 2)]
+			return bytes([FIND_INFORMATION_RSP, 1 if size == 2 else 2]) + b"".join(
+				struct.pack("<H", attribute.handle) + attribute.type for attribute in found)
+		return self.error(op, 0, REQUEST_NOT_SUPPORTED)
+
+	# As many entries of the same length as fit.
+
+	def entries(self, op, response, start, entries):
+		if not entries:
+			return self.error(op, start, ATTRIBUTE_NOT_FOUND)
+		length = len(entries[0])
+		entries = [entry for entry in entries if len(entry) == length][:(self.mtu - 2) // length]
+		return bytes([response, length]) + b"".join(entries)
+
+	def write(self, handle, data):
+		attribute = self.attribute(handle)
+		if attribute is None:
+			return
+		attribute.value = bytes(data)
+		if attribute.type == uuid16(CLIENT_CONFIGURATION):
+			if data[:1] == b"\x01":
+				self.notifying.add(handle - 1)
+			else:
+				self.notifying.discard(handle - 1)
+		if handle == self.valueHandles["db8010d0" + BASE]:
+			for uuid, value in (("db801041" + BASE, data[1:2]), ("db801042" + BASE, data[2:3]), ("db801040" + BASE, data[3:4])):
+				self.attribute(self.valueHandles[uuid]).value = value
+				self.notify(self.valueHandles[uuid], value)
+
+	def notify(self, handle, value):
+		if handle in self.notifying:
+			self.sock.send(struct.pack("<BH", HANDLE_VALUE_NTF, handle) + value)
+
+# A connected socketpair, with the stand-in answering on one end.  Returns the
+# other end and the server.
+
+def pair(latency=0.0, readMultiple="variable"):
+	client, server = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+	return client, StandInServer(server, latency, readMultiple).start()
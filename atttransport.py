@@ -0,0 +1,576 @@
+#!/usr/bin/python3
+
+# atttransport.py
+#
+# The att transport (BLE_TRANSPORT=att, see transport.py): the attribute
+# protocol spoken straight over an L2CAP socket (the LE attribute channel, CID
+# 4), with no bluepy-helper process in between.  With bluepy, every read and
+# write is a line of text to the helper, which talks to the bed and sends a
+# line back; here it's one packet each way.
+#
+# The socket is non-blocking, and read by its own thread.  ATT allows one
+# request at a time, but callers don't take turns to send them: requests from
+# any thread are queued, and the next one goes out (from the socket's thread)
+# as soon as the answer to the last one arrives.  Writes without response
+# don't wait for anything; they go out in order with the requests.
+# Notifications and indications are handed to whoever subscribed (see
+# AttTransport.subscribe()).
+#
+# Handles come from the device profile (dump.py) if there is one; otherwise
+# the services and characteristics are looked up over ATT when connecting.
+# The socket needs CAP_NET_RAW (the service runs as root), and bluetoothd
+# still has to be running.  attstandin.py stands in for the bed, for trying
+# it out without one (see benchmark-att.py).
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import uuid as uuidlib
+
+from transport import TransportError, GattError, profileFor, withResponse, propertyNames
+
+AF_BLUETOOTH = 31
+BTPROTO_L2CAP = 0
+ATT_CID = 4
+BDADDR_LE_PUBLIC = 1
+BDADDR_LE_RANDOM = 2
+
+# ATT opcodes, from the bluetooth core spec (vol 3, part F).
+ERROR_RSP = 0x01
+EXCHANGE_MTU_REQ = 0x02
+EXCHANGE_MTU_RSP = 0x03
+FIND_INFORMATION_REQ = 0x04
+FIND_INFORMATION_RSP = 0x05
+READ_BY_TYPE_REQ = 0x08
+READ_BY_TYPE_RSP = 0x09
+READ_REQ = 0x0a
+READ_RSP = 0x0b
+READ_BLOB_REQ = 0x0c
+READ_BLOB_RSP = 0x0d
+READ_MULTIPLE_REQ = 0x0e
+READ_MULTIPLE_RSP = 0x0f
+READ_BY_GROUP_TYPE_REQ = 0x10
+READ_BY_GROUP_TYPE_RSP = 0x11
+WRITE_REQ = 0x12
+WRITE_RSP = 0x13
+HANDLE_VALUE_NTF = 0x1b
+HANDLE_VALUE_IND = 0x1d
+HANDLE_VALUE_CFM = 0x1e
+READ_MULTIPLE_VARIABLE_REQ = 0x20
+READ_MULTIPLE_VARIABLE_RSP = 0x21
+WRITE_CMD = 0x52
+
+RESPONSES = (ERROR_RSP, EXCHANGE_MTU_RSP, FIND_INFORMATION_RSP, READ_BY_TYPE_RSP, READ_RSP, READ_BLOB_RSP,
+	READ_MULTIPLE_RSP, READ_BY_GROUP_TYPE_RSP, WRITE_RSP, READ_MULTIPLE_VARIABLE_RSP)
+
+# Error codes.
+ATTRIBUTE_NOT_FOUND = 0x0a
+REQUEST_NOT_SUPPORTED = 0x06
+
+# Attribute types.
+PRIMARY_SERVICE = 0x2800
+CHARACTERISTIC = 0x2803
+CLIENT_CONFIGURATION = 0x2902
+
+DEFAULT_MTU = 23
+MTU = 247
+
+class AttError(GattError):
+	def __init__(self, request, handle, code):
+		GattError.__init__(self, "ATT error 0x%02x for request 0x%02x on handle 0x%04x" % (code, request, handle), code)
+		self.request = request
+		self.handle = handle
+
+# UUIDs come little endian, in 16 or 128 bits.
+
+def uuidString(raw):
+	if len(raw) == 2:
+		return "0000%04x-0000-1000-8000-00805f9b34fb" % struct.unpack("<H", raw)
+	return str(uuidlib.UUID(bytes=bytes(reversed(raw))))
+
+def uuidBytes(uuid):
+	return bytes(reversed(uuidlib.UUID(str(uuid)).bytes))
+
+###############################################################################
+# The L2CAP socket
+#
+# Python's socket module can only address L2CAP by PSM, not by channel, so the
+# address is built and connected to with ctypes.
+###############################################################################
+
+class sockaddr_l2(ctypes.Structure):
+	_fields_ = [
+		("l2_family", ctypes.c_ushort),
+		("l2_psm", ctypes.c_ushort),
+		("l2_bdaddr", ctypes.c_uint8 * 6),
+		("l2_cid", ctypes.c_ushort),
+		("l2_bdaddr_type", ctypes.c_uint8),
+	]
+
+def littleEndian16(value):
+	return int.from_bytes(value.to_bytes(2, "little"), sys.byteorder)
+
+def l2capAddress(mac, addressType):
+	address = sockaddr_l2()
+	address.l2_family = AF_BLUETOOTH
+	address.l2_cid = littleEndian16(ATT_CID)
+	address.l2_bdaddr_type = addressType
+	for index, byte in enumerate(reversed(bytes.fromhex(mac.replace(":", "")))):
+		address.l2_bdaddr[index] = byte
+	return address
+
+def l2capConnect(mac, timeout):
+	libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+	sock = socket.socket(AF_BLUETOOTH, socket.SOCK_SEQPACKET, BTPROTO_L2CAP)
+	try:
+		local = l2capAddress("00:00:00:00:00:00", BDADDR_LE_PUBLIC)
+		if libc.bind(sock.fileno(), ctypes.byref(local), ctypes.sizeof(local)) != 0:
+			error = ctypes.get_errno()
+			raise TransportError(error, os.strerror(error))
+
+		sock.setblocking(False)
+		remote = l2capAddress(mac, BDADDR_LE_RANDOM)
+		if libc.connect(sock.fileno(), ctypes.byref(remote), ctypes.sizeof(remote)) != 0:
+			error = ctypes.get_errno()
+			if error != errno.EINPROGRESS:
+				raise TransportError(error, os.strerror(error))
+			_, writable, _ = select.select([], [sock], [], timeout)
+			if not writable:
+				raise TransportError("timed out connecting to " + mac)
+			error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+			if error:
+				raise TransportError(error, os.strerror(error))
+	except BaseException:
+		sock.close()
+		raise
+	return sock
+
+###############################################################################
+# ATT over a connected socket
+###############################################################################
+
+class Pending:
+	def __init__(self, pdu, expect):
+		self.pdu = pdu
+		self.expect = expect
+		self.done = threading.Event()
+		self.reply = None
+		self.error = None
+
+	def wait(self, timeout):
+		if not self.done.wait(timeout):
+			raise TransportError("ATT request timed out")
+		if self.error is not None:
+			raise self.error
+		return self.reply
+
+class AttBearer:
+	def __init__(self, sock, timeout=10.0, onNotify=None):
+		self.sock = sock
+		self.sock.setblocking(False)
+		self.timeout = timeout
+		self.onNotify = onNotify
+		self.mtu = DEFAULT_MTU
+		self.lock = threading.Lock()
+		self.queue = collections.deque()
+		self.inFlight = None
+		self.error = None
+		# How many requests have been sent, each a round trip to the bed.
+		self.requests = 0
+		threading.Thread(target=self.run, name="att", daemon=True).start()
+
+	def send(self, pdu):
+		while True:
+			try:
+				self.sock.send(pdu)
+				return
+			except BlockingIOError:
+				select.select([], [self.sock], [], self.timeout)
+
+	# Called with self.lock held.
+
+	def sendNext(self):
+		while self.inFlight is None and self.queue:
+			pending = self.queue.popleft()
+			self.send(pending.pdu)
+			if pending.expect is None:
+				pending.done.set()
+			else:
+				self.inFlight = pending
+				self.requests += 1
+
+	def submit(self, pdu, expect):
+		pending = Pending(pdu, expect)
+		with self.lock:
+			if self.error is not None:
+				raise self.error
+			self.queue.append(pending)
+			try:
+				self.sendNext()
+			except OSError as error:
+				self.fail(TransportError(str(error)))
+		return pending
+
+	def request(self, pdu, expect):
+		try:
+			return self.submit(pdu, expect).wait(self.timeout)
+		except TransportError as error:
+			# After a timeout, ATT allows nothing more on the connection.
+			if not isinstance(error, AttError):
+				with self.lock:
+					self.fail(error)
+			raise
+
+	def command(self, pdu):
+		self.submit(pdu, None)
+
+	# Called with self.lock held.  Everything waiting gets the error.
+
+	def fail(self, error):
+		if self.error is None:
+			self.error = error
+		waiting = list(self.queue)
+		if self.inFlight is not None:
+			waiting.append(self.inFlight)
+		self.queue.clear()
+		self.inFlight = None
+		for pending in waiting:
+			pending.error = self.error
+			pending.done.set()
+
+	def close(self):
+		with self.lock:
+			self.fail(TransportError("disconnected"))
+		self.sock.close()
+
+	def run(self):
+		while self.error is None:
+			try:
+				readable, _, _ = select.select([self.sock], [], [], 0.5)
+				if not readable:
+					continue
+				pdu = self.sock.recv(1024)
+			except BlockingIOError:
+				continue
+			except (OSError, ValueError) as error:
+				with self.lock:
+					self.fail(TransportError(str(error)))
+				return
+			if not pdu:
+				with self.lock:
+					self.fail(TransportError("disconnected by the bed"))
+				return
+			self.received(pdu)
+
+	def received(self, pdu):
+		op = pdu[0]
+
+		if op in (HANDLE_VALUE_NTF, HANDLE_VALUE_IND):
+			if op == HANDLE_VALUE_IND:
+				self.command(bytes([HANDLE_VALUE_CFM]))
+			if self.onNotify is not None and len(pdu) >= 3:
+				self.onNotify(struct.unpack_from("<H", pdu, 1)[0], bytes(pdu[3:]))
+			return
+
+		if op not in RESPONSES:
+			# A request from the bed; we serve nothing.  Commands (bit 6) get
+			# no answer at all.
+			if not op & 0x40:
+				self.command(struct.pack("<BBHB", ERROR_RSP, op, 0, REQUEST_NOT_SUPPORTED))
+			return
+
+		with self.lock:
+			pending = self.inFlight
+			self.inFlight = None
+			if pending is None:
+				return
+			if op == ERROR_RSP:
+				request, handle, code = struct.unpack_from("<BHB", pdu, 1)
+				pending.error = AttError(request, handle, code)
+			elif op != pending.expect:
+				pending.error = TransportError("unexpected ATT response 0x%02x" % op)
+			else:
+				pending.reply = bytes(pdu[1:])
+			pending.done.set()
+			try:
+				self.sendNext()
+			except OSError as error:
+				self.fail(TransportError(str(error)))
+
+	###########################################################################
+	# Requests
+	###########################################################################
+
+	def exchangeMtu(self, mtu=MTU):
+		try:
+			reply = self.request(struct.pack("<BH", EXCHANGE_MTU_REQ, mtu), EXCHANGE_MTU_RSP)
+		except AttError:
+			return self.mtu
+		self.mtu = max(DEFAULT_MTU, min(mtu, struct.unpack("<H", reply)[0]))
+		return self.mtu
+
+	# A value as long as will fit in a packet might go on; the rest is read
+	# with Read Blob.
+
+	def read(self, handle):
+		value = self.request(struct.pack("<BH", READ_REQ, handle), READ_RSP)
+		part = value
+		while len(part) == self.mtu - 1:
+			try:
+				part = self.request(struct.pack("<BHH", READ_BLOB_REQ, handle, len(value)), READ_BLOB_RSP)
+			except AttError:
+				break
+			value += part
+		return value
+
+	# Several values in one request.  Read Multiple Variable (bluetooth 5.2)
+	# says how long each value is; plain Read Multiple just runs them
+	# together, so it needs to be told the lengths (of all but the last).
+	# Both return None if the answer didn't fit in a packet.
+
+	def readMultipleVariable(self, handles):
+		reply = self.request(struct.pack("<B%dH" % len(handles), READ_MULTIPLE_VARIABLE_REQ, *handles), READ_MULTIPLE_VARIABLE_RSP)
+		values = []
+		offset = 0
+		while offset + 2 <= len(reply):
+			length = struct.unpack_from("<H", reply, offset)[0]
+			values.append(reply[offset + 2:offset + 2 + length])
+			offset += 2 + length
+		if offset != len(reply) or len(values) != len(handles):
+			return None
+		return values
+
+	def readMultiple(self, handles, lengths):
+		reply = self.request(struct.pack("<B%dH" % len(handles), READ_MULTIPLE_REQ, *handles), READ_MULTIPLE_RSP)
+		values = []
+		offset = 0
+		for length in lengths[:-1]:
+			values.append(reply[offset:offset + length])
+			offset += length
+		values.append(reply[offset:])
+		if offset > len(reply) or len(reply) >= self.mtu - 1:
+			return None
+		return values
+
+	def write(self, handle, data, withResponse=True):
+		if withResponse:
+			self.request(struct.pack("<BH", WRITE_REQ, handle) + bytes(data), WRITE_RSP)
+		else:
+			self.command(struct.pack("<BH", WRITE_CMD, handle) + bytes(data))
+
+	# The "read by" requests return a list of entries of the same length, and
+	# are repeated from after the last one until the bed says there are no
+	# more.
+
+	def readByType(self, op, expect, start, end, attributeType):
+		entries = []
+		while start <= end:
+			try:
+				reply = self.request(struct.pack("<BHHH", op, start, end, attributeType), expect)
+			except AttError as error:
+				if error.code == ATTRIBUTE_NOT_FOUND:
+					break
+				raise
+			length = reply[0]
+			found = [reply[offset:offset + length] for offset in range(1, len(reply) - length + 1, length)]
+			if not found:
+				break
+			entries.extend(found)
+			last = struct.unpack_from("<H", found[-1], 2 if op == READ_BY_GROUP_TYPE_REQ else 0)[0]
+			if last >= end:
+				break
+			start = last + 1
+		return entries
+
+	def findInformation(self, start, end):
+		found = []
+		while start <= end:
+			try:
+				reply = self.request(struct.pack("<BHH", FIND_INFORMATION_REQ, start, end), FIND_INFORMATION_RSP)
+			except AttError as error:
+				if error.code == ATTRIBUTE_NOT_FOUND:
+					break
+				raise
+			length = 4 if reply[0] == 1 else 18
+			for offset in range(1, len(reply) - length + 1, length):
+				handle = struct.unpack_from("<H", reply, offset)[0]
+				found.append((handle, uuidString(reply[offset + 2:offset + length])))
+			if not found or found[-1][0] >= end:
+				break
+			start = found[-1][0] + 1
+		return found
+
+	# The same as transport.BluepyTransport.services().
+
+	def services(self):
+		services = []
+		for entry in self.readByType(READ_BY_GROUP_TYPE_REQ, READ_BY_GROUP_TYPE_RSP, 1, 0xffff, PRIMARY_SERVICE):
+			start, end = struct.unpack_from("<HH", entry)
+			service = {"uuid": uuidString(entry[4:]), "start": start, "end": end, "characteristics": []}
+			for declaration in self.readByType(READ_BY_TYPE_REQ, READ_BY_TYPE_RSP, start, end, CHARACTERISTIC):
+				handle, properties, valueHandle = struct.unpack_from("<HBH", declaration)
+				service["characteristics"].append({
+					"uuid": uuidString(declaration[5:]),
+					"handle": handle,
+					"valueHandle": valueHandle,
+					"properties": propertyNames(properties),
+				})
+			services.append(service)
+		return services
+
+###############################################################################
+# The transport
+###############################################################################
+
+class AttTransport:
+	def __init__(self, timeout=10.0, connector=l2capConnect):
+		self.errors = (OSError,)
+		self.timeout = timeout
+		self.connector = connector
+		self.bearer = None
+		self.handles = {}
+		self.response = {}
+		self.table = None
+		# Notification callbacks, by value handle, and the handle of the
+		# client configuration descriptor that turns each one on.
+		self.listeners = {}
+		self.configurations = {}
+		# How readMany() reads several values at once: "variable" or "fixed"
+		# (Read Multiple Variable or Read Multiple), or None once the bed has
+		# turned both down.  Read Multiple needs the length of each value,
+		# from the last time it was read.
+		self.multiple = "variable"
+		self.lengths = {}
+
+	# Raw sockets can't scan, so bluepy's scanner does that part.
+
+	def scan(self, timeout=10.0):
+		from transport import BluepyTransport
+		return BluepyTransport().scan(timeout)
+
+	def open(self, mac):
+		self.bearer = AttBearer(self.connector(mac, self.timeout), self.timeout, self.notified)
+		self.bearer.exchangeMtu()
+
+	def connect(self, mac, uuids, profile=None):
+		self.open(mac)
+
+		profile = profileFor(profile, mac)
+		if profile and all(uuid in profile["characteristics"] for uuid in uuids):
+			print("Using characteristic handles from the device profile")
+			for uuid in uuids:
+				self.handles[uuid] = profile["characteristics"][uuid]["valueHandle"]
+				self.response[uuid] = withResponse(profile, uuid)
+			return
+
+		for service in self.services():
+			for characteristic in service["characteristics"]:
+				if characteristic["uuid"] in uuids:
+					self.handles[characteristic["uuid"]] = characteristic["valueHandle"]
+					self.response[characteristic["uuid"]] = "writeWithoutResponse" not in characteristic["properties"]
+		for uuid in uuids:
+			if uuid not in self.handles:
+				raise TransportError(mac + " has no characteristic " + uuid)
+
+	# The handles are the same after reconnecting, but notifications have to
+	# be turned on again.
+
+	def reconnect(self, mac):
+		if self.bearer is not None:
+			self.bearer.close()
+		self.open(mac)
+		for handle in self.listeners:
+			self.bearer.write(self.configurations[handle], b"\x01\x00")
+
+	def disconnect(self):
+		self.bearer.close()
+
+	def read(self, uuid):
+		value = self.bearer.read(self.handles[uuid])
+		self.lengths[self.handles[uuid]] = len(value)
+		return value
+
+	def write(self, uuid, data):
+		self.bearer.write(self.handles[uuid], data, self.response.get(uuid, False))
+
+	# Several characteristics in one round trip if the bed allows it, or one
+	# after another if not.  Returns the values, and how many round trips it
+	# took.
+
+	@property
+	def readsAtOnce(self):
+		return self.multiple is not None
+
+	def readMany(self, uuids):
+		handles = [self.handles[uuid] for uuid in uuids]
+		before = self.bearer.requests
+		values = self.readAtOnce(handles) if len(handles) > 1 else None
+		if values is None:
+			values = [self.bearer.read(handle) for handle in handles]
+		for handle, value in zip(handles, values):
+			self.lengths[handle] = len(value)
+		return values, self.bearer.requests - before
+
+	def readAtOnce(self, handles):
+		if self.multiple == "variable":
+			try:
+				return self.bearer.readMultipleVariable(handles)
+			except AttError as error:
+				print("Read Multiple Variable not supported (" + str(error) + "), trying Read Multiple")
+				self.multiple = "fixed"
+		if self.multiple == "fixed" and all(handle in self.lengths for handle in handles[:-1]):
+			try:
+				return self.bearer.readMultiple(handles, [self.lengths.get(handle) for handle in handles])
+			except AttError as error:
+				print("Read Multiple not supported (" + str(error) + "), reading one at a time")
+				self.multiple = None
+		return None
+
+	def services(self):
+		if self.table is None:
+			self.table = self.bearer.services()
+		return self.table
+
+	def readHandle(self, handle):
+		return self.bearer.read(handle)
+
+	def writeHandle(self, handle, data, withResponse=True):
+		self.bearer.write(handle, data, withResponse)
+
+	# Call callback(value), on the socket's thread, every time the bed sends
+	# a new value of the characteristic.  It should be quick.
+
+	def subscribe(self, uuid, callback):
+		handle = self.handles[uuid]
+		if handle not in self.configurations:
+			self.configurations[handle] = self.findConfiguration(handle)
+		self.listeners[handle] = callback
+		self.bearer.write(self.configurations[handle], b"\x01\x00")
+
+	# The client configuration descriptor is between the value and the next
+	# characteristic (or the end of the service).
+
+	def findConfiguration(self, valueHandle):
+		end = 0xffff
+		for service in self.services():
+			if service["start"] <= valueHandle <= service["end"]:
+				end = service["end"]
+				for characteristic in service["characteristics"]:
+					if valueHandle < characteristic["handle"] <= end:
+						end = characteristic["handle"] - 1
+		for handle, uuid in self.bearer.findInformation(valueHandle + 1, end):
+			if uuid == uuidString(struct.pack("<H", CLIENT_CONFIGURATION)):
+				return handle
+		raise TransportError("no client configuration for handle 0x%04x" % valueHandle)
+
+	def notified(self, handle, value):
+		callback = self.listeners.get(handle)
+		if callback is not None:
+			callback(value)
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+
+# benchmark-att.py
+#
+# Compares the att transport (atttransport.py) with bluepy: how long a read
+# and a write of the light take, one at a time, how long reading everything
+# /state shows takes (and in how many round trips), and how many reads a
+# second get done with several threads reading at once.
+#
+#     benchmark-att.py --mac C8:D0:76:DD:C8:90 --ops 200
+#     benchmark-att.py --stand-in --latency 7.5
+#
+# Against the bed, stop reverie.py first (it only allows one connection), and
+# run it as root.  The light is written with the value it already has, so
+# nothing changes.  With --stand-in there's no bed or bluetooth at all: the att
+# transport talks to attstandin.py over a socketpair, which answers each
+# request after --latency ms, to check it works and see what it adds.
+
+import argparse
+import os
+import statistics
+import threading
+import time
+
+import transport
+
+LIGHT = "db8010a0-f324-29c3-38d1-85c0c2e86885"
+POSITION = "db8010d0-f324-29c3-38d1-85c0c2e86885"
+
+# Everything /state shows: head, feet, tilt, the massages and the light.
+STATE = tuple("db8010" + part + "-f324-29c3-38d1-85c0c2e86885" for part in ("41", "42", "40", "61", "60", "80", "a0"))
+
+def timed(function, count):
+	latencies = []
+	for i in range(count):
+		started = time.monotonic()
+		function()
+		latencies.append(time.monotonic() - started)
+	return latencies
+
+def concurrentRate(bed, count, threads):
+	def reader():
+		for i in range(count // threads):
+			bed.read(LIGHT)
+
+	workers = [threading.Thread(target=reader) for i in range(threads)]
+	started = time.monotonic()
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	return (count // threads * threads) / (time.monotonic() - started)
+
+def report(name, latencies):
+	latencies = sorted(latencies)
+	print("  %-18s median %7.2f ms   p95 %7.2f ms" % (name, statistics.median(latencies) * 1000,
+		latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000))
+
+# bluepy only allows one thing at a time on a connection, so it gets a lock
+# for the concurrent reads, the same as reverie.py's bleLock.
+
+class Locked:
+	def __init__(self, bed):
+		self.bed = bed
+		self.lock = threading.Lock()
+
+	def read(self, uuid):
+		with self.lock:
+			return self.bed.read(uuid)
+
+def benchmark(name, bed, mac, ops, threads, queued):
+	print(name)
+	started = time.monotonic()
+	bed.connect(mac, (POSITION,) + STATE)
+	print("  %-18s %7.2f ms" % ("connect", (time.monotonic() - started) * 1000))
+
+	light = bed.read(LIGHT)
+	report("read", timed(lambda: bed.read(LIGHT), ops))
+	report("write", timed(lambda: bed.write(LIGHT, light), ops))
+	report("state", timed(lambda: bed.readMany(STATE), ops))
+	print("  %-18s %d round trips for %d values" % ("", bed.readMany(STATE)[1], len(STATE)))
+	rate = concurrentRate(bed if queued else Locked(bed), ops, threads)
+	print("  %-18s %7.1f reads/s with %d threads" % ("concurrent", rate, threads))
+	bed.disconnect()
+
+parser = argparse.ArgumentParser(description="Compare the att bluetooth transport with bluepy.")
+parser.add_argument("--mac", default=os.environ.get("DEVICE_MAC", ""), help="MAC address of the bed (default: DEVICE_MAC)")
+parser.add_argument("--ops", type=int, default=100, help="reads and writes of each (default %(default)s)")
+parser.add_argument("--threads", type=int, default=4, help="threads reading at once (default %(default)s)")
+parser.add_argument("--stand-in", action="store_true", help="use attstandin.py instead of the bed")
+parser.add_argument("--latency", type=float, default=7.5, help="stand-in answer time in ms (default %(default)s)")
+parser.add_argument("--read-multiple", default="variable", choices=("variable", "fixed", "none"),
+	help="which Read Multiple requests the stand-in answers (default %(default)s)")
+args = parser.parse_args()
+
+if args.stand_in:
+	import attstandin
+	from atttransport import AttTransport
+
+	sock, server = attstandin.pair(args.latency / 1000, None if args.read_multiple == "none" else args.read_multiple)
+	benchmark("att (stand-in, %.1f ms)" % args.latency, AttTransport(connector=lambda mac, timeout: sock),
+		"00:00:00:00:00:00", args.ops, args.threads, True)
+	print("  %-18s %d" % ("requests answered", server.requests))
+else:
+	if not args.mac or args.mac == "Auto":
+		parser.error("give the bed's MAC address with --mac (or DEVICE_MAC)")
+	for name in ("bluepy", "att"):
+		benchmark(name, transport.TRANSPORTS[name](), args.mac, args.ops, args.threads, name == "att")
+		# Give the bed a moment to notice the last connection has gone.
+		time.sleep(2)
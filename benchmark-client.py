@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+# benchmark-client.py
+#
+# Compares reverieclient.py with what integrations do without it: a new
+# connection and request for every value read and every value set.  Each
+# round reads the head, feet, tilt and light, then sets the head, feet and
+# light, three ways:
+#
+#     naive     a new urllib request for each
+#     client    ReverieClient: one connection, cached state, batched sets
+#     async     AsyncReverieClient, with everything in a round at once
+#
+#     benchmark-client.py --host bedroom-pi --rounds 50
+#
+# This really moves the bed (back and forth between two positions), so run it
+# against a test setup, or while nobody is in it.
+
+import argparse
+import asyncio
+import time
+import urllib.request
+
+from reverieclient import ReverieClient, AsyncReverieClient
+
+READS = ("getHead", "getFeet", "getTilt", "light/status")
+
+def naive(base, rounds):
+	requests = 0
+	for round in range(rounds):
+		for path in READS:
+			urllib.request.urlopen(base + path).read()
+		value = 10 + round % 2 * 10
+		for path in ("setHead/" + str(value), "setFeet/" + str(value), "light/" + ("on" if round % 2 else "off")):
+			urllib.request.urlopen(base + path).read()
+		requests += len(READS) + 3
+	return requests
+
+def blocking(host, port, rounds):
+	client = ReverieClient(host, port)
+	for round in range(rounds):
+		client.forget()
+		client.head(), client.feet(), client.tilt(), client.light()
+		value = 10 + round % 2 * 10
+		with client.batch():
+			client.setHead(value)
+			client.setFeet(value)
+			client.setLight(round % 2)
+	client.close()
+	return client.requests
+
+async def concurrent(host, port, rounds):
+	client = AsyncReverieClient(host, port)
+	for round in range(rounds):
+		client.forget()
+		value = 10 + round % 2 * 10
+		await asyncio.gather(client.head(), client.feet(), client.tilt(), client.light())
+		await asyncio.gather(client.setHead(value), client.setFeet(value), client.setLight(round % 2))
+	await client.close()
+	return client.requests
+
+def report(name, rounds, seconds, requests):
+	print("%-8s %6.1f ms per round  %5.1f requests per round  %7.1f s total" % (
+		name, seconds / rounds * 1000, requests / rounds, seconds))
+
+parser = argparse.ArgumentParser(description="Benchmark reverieclient.py against a request per call.")
+parser.add_argument("--host", default="127.0.0.1", help="reverie.py host (default %(default)s)")
+parser.add_argument("--port", type=int, default=8001, help="reverie.py port (default %(default)s)")
+parser.add_argument("--rounds", type=int, default=20, help="rounds of each (default %(default)s)")
+args = parser.parse_args()
+
+base = "http://" + args.host + ":" + str(args.port) + "/"
+
+started = time.monotonic()
+requests = naive(base, args.rounds)
+report("naive", args.rounds, time.monotonic() - started, requests)
+
+started = time.monotonic()
+requests = blocking(args.host, args.port, args.rounds)
+report("client", args.rounds, time.monotonic() - started, requests)
+
+started = time.monotonic()
+requests = asyncio.run(concurrent(args.host, args.port, args.rounds))
+report("async", args.rounds, time.monotonic() - started, requests)
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+
+# benchmark-startup.py
+#
+# Compares how long reverie.py takes to start (until it answers /help) and how
+# much memory it uses (resident set size, once started and after a few
+# requests), with Flask and in slim mode (SLIM_MODE).
+#
+#     benchmark-startup.py
+#     benchmark-startup.py --runs 10 --port 8091
+#
+# It doesn't need the bed: the web server answers before the bed is
+# connected.  But stop the service first if it has the bed, or each run will
+# spend its time trying to connect to it.  Runs use a scratch STATE_DIR, so
+# the real saved state and schedule are left alone.
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reverie.py")
+
+def rss(pid):
+	with open("/proc/" + str(pid) + "/status") as f:
+		for line in f:
+			if line.startswith("VmRSS:"):
+				return int(line.split()[1]) / 1024
+	return 0
+
+def run(slim, port, stateDir):
+	env = dict(os.environ, SLIM_MODE="1" if slim else "0", RPI_LOCAL_IP="127.0.0.1", RPI_LISTEN_PORT=str(port),
+		STATE_DIR=stateDir, UNIX_SOCKET="", HTTP_WORKERS="0", KEEPALIVE_INTERVAL="0", POLL_INTERVAL="0")
+	started = time.monotonic()
+	process = subprocess.Popen([sys.executable, SCRIPT], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	try:
+		while True:
+			if process.poll() is not None:
+				raise RuntimeError("reverie.py exited with status " + str(process.returncode))
+			try:
+				urllib.request.urlopen("http://127.0.0.1:" + str(port) + "/help", timeout=1).read()
+				break
+			except OSError:
+				time.sleep(0.01)
+		startup = time.monotonic() - started
+		startRss = rss(process.pid)
+
+		for i in range(10):
+			for path in ("help", "state", "health"):
+				try:
+					urllib.request.urlopen("http://127.0.0.1:" + str(port) + "/" + path, timeout=5).read()
+				except OSError:
+					# /health is 503 until the bed is connected.
+					pass
+		return startup, startRss, rss(process.pid)
+	finally:
+		process.terminate()
+		process.wait()
+
+parser = argparse.ArgumentParser(description="Compare reverie.py's startup time and memory with and without Flask.")
+parser.add_argument("--runs", type=int, default=5, help="runs of each (default %(default)s)")
+parser.add_argument("--port", type=int, default=8091, help="port to run on (default %(default)s)")
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as stateDir:
+	for name, slim in (("flask", False), ("slim", True)):
+		results = [run(slim, args.port, stateDir) for i in range(args.runs)]
+		print("%-6s startup %6.0f ms (median of %d)  RSS %5.1f MB at start, %5.1f MB after 30 requests" % (
+			name, statistics.median(result[0] for result in results) * 1000, args.runs,
+			statistics.median(result[1] for result in results), statistics.median(result[2] for result in results)))
@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+
+# bleaktransport.py
+#
+# The bleak transport (BLE_TRANSPORT=bleak, see transport.py): asyncio based,
+# talking to BlueZ over D-Bus.  It runs its own event loop on its own thread,
+# so nothing else waits on it, and code running on that loop can await reads,
+# writes and notifications at the same time.  Needs bleak (pip3 install bleak).
+
+import asyncio
+import concurrent.futures
+import re
+import threading
+
+from transport import TransportError, GattError, BED_NAME, profileFor, withResponse, readEach
+
+# bleak's names for the characteristic properties, where they aren't the same
+# as transport.PROPERTIES.
+PROPERTY_NAMES = {
+	"write-without-response": "writeWithoutResponse",
+	"authenticated-signed-writes": "authenticatedWrite",
+	"extended-properties": "extended",
+}
+
+# The D-Bus errors BlueZ answers with when the bed refused an operation (an
+# ATT error), rather than the connection failing.  Any other ATT error comes
+# as org.bluez.Error.Failed, with the code in the message.
+REFUSALS = (
+	"org.bluez.Error.NotPermitted",
+	"org.bluez.Error.NotAuthorized",
+	"org.bluez.Error.NotSupported",
+	"org.bluez.Error.InvalidOffset",
+	"org.bluez.Error.InvalidValueLength",
+)
+
+ATT_ERROR = re.compile(r"ATT error: (0x[0-9a-fA-F]+)")
+
+class BleakTransport:
+	def __init__(self, timeout=10.0):
+		import bleak
+		import bleak.exc
+
+		self.bleak = bleak
+		self.bleakError = bleak.exc.BleakError
+		self.dbusError = bleak.exc.BleakDBusError
+		self.errors = (OSError,)
+		self.timeout = timeout
+		self.client = None
+		self.response = {}
+
+		self.loop = asyncio.new_event_loop()
+		threading.Thread(target=self.loop.run_forever, name="bleak", daemon=True).start()
+
+	# Run a coroutine on the transport's loop and wait for it.  A bleak error,
+	# or taking longer than timeout, is a TransportError (a GattError if the
+	# bed refused it).
+
+	def call(self, coroutine, timeout=None):
+		future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+		try:
+			return future.result(timeout or self.timeout)
+		except concurrent.futures.TimeoutError:
+			future.cancel()
+			raise TransportError("bluetooth operation timed out")
+		except self.dbusError as error:
+			code = ATT_ERROR.search(str(error))
+			if error.dbus_error in REFUSALS or code:
+				raise GattError(str(error), int(code.group(1), 16) if code else None)
+			raise TransportError(str(error))
+		except self.bleakError as error:
+			raise TransportError(str(error))
+
+	###########################################################################
+	# For code running on self.loop
+	###########################################################################
+
+	async def aread(self, uuid):
+		return bytes(await self.client.read_gatt_char(uuid))
+
+	# Without a profile, response is None, which leaves bleak to pick the
+	# quickest way the characteristic supports.
+
+	async def awrite(self, uuid, data):
+		await self.client.write_gatt_char(uuid, data, response=self.response.get(uuid))
+
+	# Yields the value of the characteristic every time the bed sends a
+	# notification, for as long as the caller keeps asking.
+
+	async def notifications(self, uuid):
+		values = asyncio.Queue()
+		await self.client.start_notify(uuid, lambda sender, data: values.put_nowait(bytes(data)))
+		try:
+			while True:
+				yield await values.get()
+		finally:
+			await self.client.stop_notify(uuid)
+
+	###########################################################################
+	# The same methods as the other transports
+	###########################################################################
+
+	def scan(self, timeout=10.0):
+		async def discover():
+			found = await self.bleak.BleakScanner.discover(timeout, return_adv=True)
+			return [(device.address, adv.rssi) for device, adv in found.values() if adv.local_name == BED_NAME]
+		return self.call(discover(), timeout + self.timeout)
+
+	def connect(self, mac, uuids, profile=None):
+		profile = profileFor(profile, mac)
+		if profile:
+			for uuid in uuids:
+				if uuid in profile["characteristics"]:
+					self.response[uuid] = withResponse(profile, uuid)
+
+		self.client = self.bleak.BleakClient(mac, timeout=self.timeout)
+		self.call(self.client.connect(), self.timeout * 2)
+
+		# Fail now, rather than on the first read, if the bed doesn't have
+		# everything we need.
+		for uuid in uuids:
+			if self.client.services.get_characteristic(uuid) is None:
+				raise TransportError(mac + " has no characteristic " + uuid)
+
+	def reconnect(self, mac):
+		self.call(self.client.connect(), self.timeout * 2)
+
+	def disconnect(self):
+		self.call(self.client.disconnect())
+
+	def read(self, uuid):
+		return self.call(self.aread(uuid))
+
+	def write(self, uuid, data):
+		self.call(self.awrite(uuid, data))
+
+	# BlueZ has no way to read several at once.
+
+	readsAtOnce = False
+
+	def readMany(self, uuids):
+		return readEach(self, uuids)
+
+	# bleak's handle for a characteristic is its value handle; the
+	# declaration is always the one before it.  BlueZ doesn't say where a
+	# service ends, so "end" is its last value handle.
+
+	def services(self):
+		found = []
+		for svc in self.client.services:
+			characteristics = [{
+				"uuid": characteristic.uuid,
+				"handle": characteristic.handle - 1,
+				"valueHandle": characteristic.handle,
+				"properties": [PROPERTY_NAMES.get(name, name) for name in characteristic.properties],
+			} for characteristic in svc.characteristics]
+			end = max([characteristic["valueHandle"] for characteristic in characteristics] + [svc.handle])
+			found.append({"uuid": svc.uuid, "start": svc.handle, "end": end, "characteristics": characteristics})
+		return found
+
+	def readHandle(self, handle):
+		return self.call(self.aread(handle))
+
+	def writeHandle(self, handle, data, withResponse=True):
+		self.call(self.client.write_gatt_char(handle, data, response=withResponse))
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+# bletrace.py
+#
+# A compact binary record of every read and write reverie.py makes to the
+# bed, for working out what happened when it misbehaves (the head massage
+# starting when the feet massage was asked for, say), and for replaying it
+# later with replay.py.
+#
+# The file starts with a header:
+#
+#     "RVTR"  version (1 byte)  start time (8 byte double, seconds since epoch)
+#
+# followed by one record per operation, all little endian:
+#
+#     offset   8 byte double   seconds since the start time
+#     op       1 byte          OP_READ, OP_WRITE, OP_CONNECT, ...
+#     uuid     16 bytes        characteristic UUID (zeros if there isn't one)
+#     latency  4 byte float    seconds the operation took
+#     result   1 byte          0 if it worked, 1 if it failed
+#     length   2 bytes         length of the payload
+#     payload  length bytes    the value read or written
+
+import collections
+import struct
+import threading
+import time
+import uuid as uuidlib
+
+MAGIC = b"RVTR"
+VERSION = 1
+
+HEADER = struct.Struct("<4sBd")
+RECORD = struct.Struct("<dB16sfBH")
+
+OP_READ = 1
+OP_WRITE = 2
+OP_CONNECT = 3
+OP_DISCONNECT = 4
+
+OP_NAMES = {OP_READ: "read", OP_WRITE: "write", OP_CONNECT: "connect", OP_DISCONNECT: "disconnect"}
+
+Record = collections.namedtuple("Record", "time op uuid latency ok payload")
+
+def packUUID(uuid):
+	if uuid is None:
+		return bytes(16)
+	return uuidlib.UUID(str(uuid)).bytes
+
+def unpackUUID(raw):
+	if raw == bytes(16):
+		return None
+	return str(uuidlib.UUID(bytes=raw))
+
+class TraceWriter:
+	def __init__(self, filename):
+		self.file = open(filename, "ab")
+		self.lock = threading.Lock()
+		self.start = time.time()
+		self.origin = time.monotonic()
+		self.records = 0
+		# A file that already has records in it gets a new header, so the
+		# offsets of each run are counted from the start of that run.
+		self.file.write(HEADER.pack(MAGIC, VERSION, self.start))
+		self.file.flush()
+
+	# Every record is flushed as it is written, so the trace is complete up to
+	# the moment the process is killed.
+
+	def record(self, op, uuid, payload=b"", latency=0.0, ok=True):
+		payload = bytes(payload)[:0xffff]
+		entry = RECORD.pack(time.monotonic() - self.origin, op, packUUID(uuid), latency, 0 if ok else 1, len(payload)) + payload
+		with self.lock:
+			self.file.write(entry)
+			self.file.flush()
+			self.records += 1
+
+	def close(self):
+		with self.lock:
+			self.file.close()
+
+# Read the records back.  The time of each is seconds since the epoch; a file
+# with several runs in it is read straight through.
+
+def readTrace(filename):
+	with open(filename, "rb") as f:
+		data = f.read()
+
+	position = 0
+	start = 0.0
+	while position < len(data):
+		if data[position:position + 4] == MAGIC:
+			magic, version, start = HEADER.unpack_from(data, position)
+			if version != VERSION:
+				raise ValueError("unsupported trace version " + str(version))
+			position += HEADER.size
+			continue
+
+		if position + RECORD.size > len(data):
+			break
+		offset, op, uuid, latency, result, length = RECORD.unpack_from(data, position)
+		position += RECORD.size
+		payload = data[position:position + length]
+		position += length
+		yield Record(start + offset, op, unpackUUID(uuid), latency, result == 0, payload)
@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+
+# check-mqtt.py
+#
+# Drives the MQTT bridge (mqttbridge.py) through the stand-in broker
+# (mqttstandin.py), with a made up bed, to check that it works without a
+# broker, paho-mqtt or a bed:
+#
+#     check-mqtt.py
+#
+# It checks that the state is published, retained, one topic per value, and
+# only when it changes; that a client that subscribes later gets it from the
+# broker; that command topics run the right commands with the right values
+# (and that unknown commands and bad values don't run anything); and that
+# when the broker drops the bridge, the status goes offline and everything is
+# published again once it's back.  Prints each check, and exits with 1 if any
+# of them failed.
+
+import sys
+import threading
+import time
+
+from mqttbridge import MqttBridge
+from mqttstandin import StandInBroker
+
+PREFIX = "reverie"
+
+failures = 0
+
+def check(name, ok):
+	global failures
+	print(("ok      " if ok else "FAILED  ") + name)
+	if not ok:
+		failures += 1
+
+# Wait (a little) for something the bridge does on its own threads.
+
+def eventually(test, timeout=3.0):
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline:
+		if test():
+			return True
+		time.sleep(0.01)
+	return test()
+
+# A made up bed: its state, the same as /state, and the commands it was sent.
+
+state = {"head": 10, "feet": 0, "tilt": 50, "lumbar": None, "headMassage": 0, "feetMassage": 0, "waveMassage": 0, "light": 0}
+ran = []
+ranLock = threading.Lock()
+
+def run(command, value):
+	with ranLock:
+		ran.append((command, value))
+
+def fail():
+	raise RuntimeError("the bed went away")
+
+COMMANDS = {
+	"flat": (lambda: None, False),
+	"setHead": (lambda value: None, True),
+	"light/on": (lambda: None, False),
+	"stopMassage": (lambda: None, False),
+}
+
+# Everything a client subscribed to topic has received, as {topic: payload}.
+
+class Watcher:
+	def __init__(self, broker, topic):
+		self.received = {}
+		self.client = broker.client("watcher")
+		self.client.on_connect = lambda client, userdata, flags, rc: client.subscribe(topic)
+		self.client.on_message = self.onMessage
+		self.client.loop_start()
+
+	def onMessage(self, client, userdata, message):
+		self.received[message.topic] = message.payload.decode()
+
+broker = StandInBroker()
+bridge = MqttBridge("standin", 1883, run, COMMANDS, lambda: dict(state), PREFIX, clientFactory=broker.client)
+bridge.start()
+
+# Connecting
+
+expected = dict((PREFIX + "/state/" + key, str(value)) for key, value in state.items() if value is not None)
+check("status is online, retained", eventually(lambda: PREFIX + "/status" in broker.retained and
+	broker.retained[PREFIX + "/status"].payload == b"online"))
+check("every known value is published, retained", eventually(lambda: all(topic in broker.retained and
+	broker.retained[topic].payload.decode() == payload for topic, payload in expected.items())))
+check("unknown values (None) aren't published", PREFIX + "/state/lumbar" not in broker.retained)
+
+watcher = Watcher(broker, PREFIX + "/state/#")
+check("a later subscriber gets the retained state", eventually(lambda: watcher.received == expected))
+
+# State changes
+
+before = len(broker.published)
+state["head"] = 35
+bridge.notify()
+check("a change is published", eventually(lambda: watcher.received.get(PREFIX + "/state/head") == "35"))
+time.sleep(0.1)
+changed = [message.topic for message in broker.published[before:]]
+check("only what changed is published", changed == [PREFIX + "/state/head"])
+
+before = len(broker.published)
+bridge.notify()
+time.sleep(0.1)
+check("nothing is published when nothing changed", len(broker.published) == before)
+
+# Commands
+
+def command(name, payload=b""):
+	publisher = broker.client("publisher-" + name)
+	publisher.loop_start()
+	publisher.publish(PREFIX + "/command/" + name, payload)
+	publisher.loop_stop()
+
+command("setHead", b"50")
+check("setHead 50 runs setHead with 50", eventually(lambda: ("setHead", 50) in ran))
+command("light/on")
+check("light/on runs light/on", eventually(lambda: ("light/on", None) in ran))
+command("flat", b"ignored")
+check("flat ignores its payload", eventually(lambda: ("flat", None) in ran))
+
+count = len(ran)
+command("nonsense", b"1")
+command("setHead", b"high")
+command("stopMassage")
+check("stopMassage runs, after a bad one", eventually(lambda: ("stopMassage", None) in ran))
+check("unknown commands and bad values don't run", ran[count:] == [("stopMassage", None)])
+
+# A command that fails goes to onError, and the bridge carries on.
+
+errors = []
+bridge.onError = errors.append
+bridge.runCommand = lambda command, value: fail()
+command("flat")
+check("a failed command goes to onError", eventually(lambda: len(errors) == 1))
+bridge.runCommand = run
+command("setHead", b"20")
+check("and the next one still runs", eventually(lambda: ("setHead", 20) in ran))
+
+# Losing the broker
+
+broker.drop(bridge.client)
+check("the status goes offline when the bridge is dropped", eventually(lambda:
+	broker.retained[PREFIX + "/status"].payload == b"offline"))
+check("the bridge knows it isn't connected", eventually(lambda: not bridge.connected))
+
+state["light"] = 1
+bridge.notify()
+before = len(broker.published)
+check("it connects again", eventually(lambda: bridge.connected))
+check("and is online again", eventually(lambda: broker.retained[PREFIX + "/status"].payload == b"online"))
+check("and publishes everything again", eventually(lambda: set(topic for topic in expected) <=
+	set(message.topic for message in broker.published[before:])))
+check("including what changed while it was away", broker.retained[PREFIX + "/state/light"].payload == b"1")
+
+command("flat")
+check("commands work again", eventually(lambda: ran.count(("flat", None)) == 2))
+
+print(str(failures) + " failed" if failures else "All passed")
+sys.exit(1 if failures else 0)
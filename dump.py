@@ -1,63 +1,222 @@
 #!/usr/bin/python3
 
-from flask import Flask
-from flask import render_template
-from bluepy import btle
+# dump.py
+#
+# Profiles the bed's bluetooth interface, and writes it out as JSON: every
+# service and characteristic, with its handles, what it supports (read, write,
+# write without response, notify, indicate), its current value, and how long
+# it takes to read, over a number of reads.
+#
+# reverie.py can use the result (set DEVICE_PROFILE to the file) to skip
+# looking the characteristics up every time it connects, and to write to each
+# characteristic the fastest way it supports.
+#
+#     dump.py > profile.json
+#     dump.py --mac C8:D0:76:DD:C8:90 --reads 50 --output profile.json
+#
+# The bed only allows one connection, so stop reverie.py while this runs.
+# Or, with --api, leave it running and profile the bed through its /gatt URLs
+# instead, over its connection (set ADMIN_TOKEN, or --token, to its
+# ADMIN_TOKEN).  Read latencies are then how long the reads took reverie.py,
+# not counting HTTP, and there's no connect time.
+#
+#     dump.py --api http://127.0.0.1:8001 --output profile.json
+#
+# If no MAC address is given (with --mac, or DEVICE_MAC in the environment),
+# it scans for the bed the same way scan.py does.
+
+import argparse
+import http.client
+import json
+import os
 import sys
 import time
-# TODO: You WILL need to change the mac address below to be the address of your bed's bluetooth module
-DEVICE_MAC = "C8:D0:76:DD:C8:90"
-# TODO: You WILL need to change the Local IP address below to be the address of your RPI
-RPI_LOCAL_IP = "172.22.42.16"
-# You do NOT need to change the below UUID if you have the same bed
-DEVICE_UUID = "db801000-f324-29c3-38d1-85c0c2e86885"
+import urllib.parse
+
+from transport import propertyNames
+
+def findBed():
+	from bluepy.btle import Scanner, DefaultDelegate
+
+	class ScanDelegate(DefaultDelegate):
+		def __init__(self):
+			DefaultDelegate.__init__(self)
+
+	print("Scanning for Reverie Powerbases...", file=sys.stderr)
+
+	scanner = Scanner().withDelegate(ScanDelegate())
+	for device in scanner.scan(10.0):
+		for (adtype, desc, value) in device.getScanData():
+			if desc == "Complete Local Name" and value == "RevCB_A1":
+				print("Detected Reverie Powerbase: %s" % (device.addr), file=sys.stderr)
+				return device.addr
+	return None
 
-dev = btle.Peripheral(DEVICE_MAC, "random")
+def latencyStats(latencies):
+	if not latencies:
+		return None
+	latencies = sorted(latencies)
+	return {
+		"count": len(latencies),
+		"min": round(latencies[0] * 1000, 2),
+		"mean": round(sum(latencies) / len(latencies) * 1000, 2),
+		"p50": round(latencies[len(latencies) // 2] * 1000, 2),
+		"p95": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 2),
+		"max": round(latencies[-1] * 1000, 2),
+	}
 
+def profileCharacteristic(characteristic, reads):
+	from bluepy import btle
 
-def dump(obj):
-   for attr in dir(obj):
-       if hasattr( obj, attr ):
-           print( "obj.%s (type = %s) = %s" % (attr, type(attr), getattr(obj, attr)))
+	profile = {
+		"uuid": str(characteristic.uuid),
+		"handle": characteristic.handle,
+		"valueHandle": characteristic.valHandle,
+		"properties": propertyNames(characteristic.properties),
+	}
 
+	if not characteristic.supportsRead():
+		return profile
 
-# Device c8:d0:76:dd:c8:90 (random), RSSI=-67 dB
-# 	 Flags = 06
-# 	 Complete 128b Services = db801000-f324-29c3-38d1-85c0c2e86885
-# 	 Complete Local Name = RevCB_A1
-	 
-for svc in dev.services:
+	latencies = []
 	try:
-		print(str(svc.uuid))
+		for i in range(reads):
+			started = time.monotonic()
+			value = characteristic.read()
+			latencies.append(time.monotonic() - started)
+		profile["value"] = value.hex()
+	except btle.BTLEException as error:
+		profile["error"] = str(error)
+	profile["readLatency"] = latencyStats(latencies)
+
+	return profile
+
+def profileBed(mac, reads):
+	from bluepy import btle
+
+	if mac == "Auto":
+		mac = findBed()
+		if mac is None:
+			print("No Reverie Powerbase found.", file=sys.stderr)
+			sys.exit(1)
+
+	print("Connecting to " + mac, file=sys.stderr)
+	started = time.monotonic()
+	dev = btle.Peripheral(mac, "random")
+	connectTime = time.monotonic() - started
+
+	started = time.monotonic()
+	services = dev.getServices()
+	discoveryTime = time.monotonic() - started
+
+	profile = {
+		"mac": mac,
+		"time": time.time(),
+		"connectTime": round(connectTime * 1000, 2),
+		"discoveryTime": round(discoveryTime * 1000, 2),
+		"services": [],
+	}
 
-		#sys.exit()
+	for svc in services:
+		print("Profiling service " + str(svc.uuid), file=sys.stderr)
+		service = {
+			"uuid": str(svc.uuid),
+			"start": svc.hndStart,
+			"end": svc.hndEnd,
+			"characteristics": [],
+		}
+		try:
+			for characteristic in svc.getCharacteristics():
+				service["characteristics"].append(profileCharacteristic(characteristic, reads))
+		except btle.BTLEException as error:
+			service["error"] = str(error)
+		profile["services"].append(service)
 
-		#dump(dev)
-		#print()
-		#dump(service)
-		#print()
+	dev.disconnect()
+	return profile
 
-		service = dev.getServiceByUUID(svc.uuid)
+# Through a running reverie.py (--api), over its /gatt URLs.
 
-		print (str(svc.uuid)[:4])
-		if str(svc.uuid)[:4] != "0000":
+class ApiError(Exception):
+	pass
 
-			for i in service.getCharacteristics():
-				#print(dir(i))
-				#print(i.peripheral.getServices())
-				#print(i)
-				#dump(i)
-				print(i.uuid, i.read().hex())
-	except:
-		print("Error reading UUID")
-		pass
+class Api:
+	def __init__(self, url, token):
+		parts = urllib.parse.urlsplit(url)
+		self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+		self.headers = {"Authorization": "Bearer " + token, "Content-Type": "application/json"}
 
-#print ( service.getCharacteristics(forUUID="db801041-f324-29c3-38d1-85c0c2e86885")[0].read().hex() )
+	def request(self, method, path, body=None):
+		self.connection.request(method, path, body, self.headers)
+		response = self.connection.getresponse()
+		reply = response.read()
+		if response.status != 200:
+			raise ApiError(path + ": " + str(response.status) + " " + reply.decode(errors="replace").strip())
+		return json.loads(reply)
 
-#subService = service.getCharacteristics()[12]
+def profileApi(url, token, reads):
+	api = Api(url, token)
+
+	print("Listing characteristics from " + url, file=sys.stderr)
+	started = time.monotonic()
+	services = api.request("GET", "/gatt")
+	discoveryTime = time.monotonic() - started
+
+	profile = {
+		"mac": api.request("GET", "/health")["mac"],
+		"time": time.time(),
+		"connectTime": None,
+		"discoveryTime": round(discoveryTime * 1000, 2),
+		"services": services,
+	}
+
+	for service in services:
+		print("Profiling service " + service["uuid"], file=sys.stderr)
+		for characteristic in service["characteristics"]:
+			if "read" not in characteristic["properties"]:
+				continue
+			latencies = []
+			try:
+				for i in range(reads):
+					reply = api.request("GET", "/gatt/" + str(characteristic["valueHandle"]))
+					latencies.append(reply["latency"] / 1000)
+				characteristic["value"] = reply["value"]
+			except ApiError as error:
+				characteristic["error"] = str(error)
+			characteristic["readLatency"] = latencyStats(latencies)
+
+	return profile
+
+parser = argparse.ArgumentParser(description="Profile a Reverie Powerbase's bluetooth interface as JSON.")
+parser.add_argument("--mac", default=os.environ.get("DEVICE_MAC", "Auto"), help="MAC address of the bed (default: scan for it)")
+parser.add_argument("--reads", type=int, default=20, help="how many times to read each characteristic (default %(default)s)")
+parser.add_argument("--output", help="file to write the profile to (default: standard output)")
+parser.add_argument("--api", help="profile the bed through a running reverie.py at this URL (i.e. http://127.0.0.1:8001) instead")
+parser.add_argument("--token", default=os.environ.get("ADMIN_TOKEN", ""), help="reverie.py's ADMIN_TOKEN, for --api (default: ADMIN_TOKEN from the environment)")
+args = parser.parse_args()
+
+if args.api:
+	try:
+		profile = profileApi(args.api, args.token, args.reads)
+	except (ApiError, OSError) as error:
+		print("Unable to profile the bed through " + args.api + ": " + str(error), file=sys.stderr)
+		sys.exit(1)
+else:
+	profile = profileBed(args.mac, args.reads)
+
+if args.output:
+	with open(args.output, "w") as f:
+		json.dump(profile, f, indent=1)
+else:
+	json.dump(profile, sys.stdout, indent=1)
+	print()
+
+# Notes on the values, from poking at them on an R650:
+#
+# db8010d0 is the position of the whole bed:
 # 00 [head] [foot] [lumbar/tilt] 00 00 00 00 00 00 00
 # Other octets don't seem to have any function (on my bed)
-# The tilt setting for "flat" is 0x24 
+# The tilt setting for "flat" is 0x24
 # i.e. Flat is:          "0000002400000000000000"
 # My sleep position is:  "0000004100000000000000"
 # My tv position is:     "00644f6400000000000000"
@@ -70,8 +229,3 @@ for svc in dev.services:
 # Moving the head independently doesn't update db8010d0, so can't be used for status.
 # db80102[0-2] seems to reflect the value of db80104[0-2]; [perhaps 20 is used for
 # polling for current position.
-
-#subService.write(bytes.fromhex("0000002400000000000000"))
-#subService.write(bytes.fromhex("00"))
-
-sys.exit()
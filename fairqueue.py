@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+
+# fairqueue.py
+#
+# A lock that hands the connection to the bed out fairly between clients
+# (homebridge, a dashboard, scheduled scripts, the service's own threads), so
+# one busy client can't keep the others waiting.  It works like an RLock, and
+# takes the place of reverie.py's bleLock, so every read and write to the bed
+# goes through it without knowing it's there.
+#
+# Each thread says which client it's working for (setClient(); threads that
+# don't are their own client, by thread name).  Waiting operations are served
+# by weighted fair queuing: each one is stamped with a virtual finish time,
+# 1 / weight after the later of the client's last stamp and the one being
+# served now, and the smallest stamp goes next.  So a client with weight 2 gets
+# twice as many turns as one with weight 1 while both are waiting, and a
+# client that has been quiet goes (nearly) straight to the front.
+#
+# A client with limit operations already waiting gets QueueFull instead of
+# another place in the queue.
+#
+# Client names can come from outside (an address, say), so nothing is kept
+# about a client for good: its stamp is forgotten once it's no longer ahead
+# of the one being served, and only the KEEP_CLIENTS clients used most
+# recently keep their statistics.
+#
+# Operations also go in lanes (LANES, most urgent first), which a thread picks
+# with setLane(): nothing in a lane is started while anything in a more urgent
+# one is waiting, and taking turns only happens within a lane.  An operation
+# can say what it's about to write (writing()), and cancel() takes waiting
+# writes out of the less urgent lanes if something else is about to make them
+# pointless; they raise Superseded instead of going ahead.
+
+import collections
+import itertools
+import threading
+import time
+
+LANES = ("stop", "preset", "normal")
+
+class QueueFull(Exception):
+	def __init__(self, client):
+		Exception.__init__(self, client + " has too many operations waiting")
+		self.client = client
+
+class Superseded(Exception):
+	def __init__(self, by):
+		Exception.__init__(self, "superseded by " + by)
+		self.by = by
+
+class Ticket:
+	def __init__(self, start, finish, order, writes):
+		self.start = start
+		self.finish = finish
+		self.order = order
+		self.writes = writes
+		self.cancelled = None
+		self.queued = time.monotonic()
+
+class WaitStats:
+	def __init__(self):
+		self.operations = 0
+		self.rejected = 0
+		self.cancelled = 0
+		self.totalWait = 0.0
+		self.maxWait = 0.0
+		self.recentWaits = collections.deque(maxlen=100)
+
+	def waited(self, seconds):
+		self.operations += 1
+		self.totalWait += seconds
+		self.maxWait = max(self.maxWait, seconds)
+		self.recentWaits.append(seconds)
+
+	def report(self):
+		waits = sorted(self.recentWaits)
+		return {
+			"operations": self.operations,
+			"rejected": self.rejected,
+			"cancelled": self.cancelled,
+			"meanWait": round(self.totalWait / self.operations * 1000, 2) if self.operations else None,
+			"p95Wait": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 2) if waits else None,
+			"maxWait": round(self.maxWait * 1000, 2),
+		}
+
+# So `with lock.writing(characteristic):` can be used like `with lock:`.
+
+class Writing:
+	def __init__(self, lock, writes):
+		self.lock = lock
+		self.writes = writes
+
+	def __enter__(self):
+		self.lock.acquire(writes=self.writes)
+		return self.lock
+
+	def __exit__(self, *exception):
+		self.lock.release()
+
+class FairLock:
+	KEEP_CLIENTS = 64
+
+	def __init__(self, weights=None, limit=0):
+		self.weights = weights or {}
+		self.limit = limit
+		self.condition = threading.Condition(threading.Lock())
+		self.owner = None
+		self.depth = 0
+		self.virtual = 0.0
+		# (lane, client): that client's tickets waiting in that lane.
+		self.waiting = {}
+		self.finish = {}
+		# Least recently used first.
+		self.stats = {}
+		self.laneStats = dict((lane, WaitStats()) for lane in LANES)
+		self.order = itertools.count()
+		self.local = threading.local()
+
+	def setClient(self, client):
+		self.local.client = client
+
+	def client(self):
+		return getattr(self.local, "client", None) or threading.current_thread().name
+
+	def setLane(self, lane):
+		if lane not in LANES:
+			raise ValueError("unknown lane " + lane)
+		self.local.lane = lane
+
+	def lane(self):
+		return getattr(self.local, "lane", "normal")
+
+	# The ticket with the smallest finish stamp in the most urgent lane with
+	# anything waiting (first come first served between equals).
+
+	def next(self):
+		if not self.waiting:
+			return None
+		lane = min(lane for lane, client in self.waiting)
+		heads = [queue[0] for (queueLane, client), queue in self.waiting.items() if queueLane == lane]
+		return min(heads, key=lambda ticket: (ticket.finish, ticket.order))
+
+	def waitingFor(self, client):
+		return sum(len(self.waiting.get((lane, client), ())) for lane in range(len(LANES)))
+
+	# A client's statistics, made the most recently used, making room for
+	# them if need be.
+
+	def statsFor(self, client):
+		stats = self.stats.pop(client, None) or WaitStats()
+		self.stats[client] = stats
+		if len(self.stats) > self.KEEP_CLIENTS:
+			for name in self.stats:
+				if name != client and not self.waitingFor(name):
+					del self.stats[name]
+					break
+		return stats
+
+	# Forget the stamps of clients that have nothing waiting and aren't
+	# ahead of virtual: the next one they get would start from virtual
+	# anyway.  If that still leaves more than KEEP_CLIENTS, forget the idle
+	# ones closest to virtual too, which gives them the least of a head start.
+
+	def forget(self):
+		idle = [client for client in self.finish if not self.waitingFor(client)]
+		for client in idle:
+			if self.finish[client] <= self.virtual:
+				del self.finish[client]
+		if len(self.finish) > self.KEEP_CLIENTS:
+			idle = sorted([client for client in idle if client in self.finish], key=lambda client: self.finish[client])
+			for client in idle[:len(self.finish) - self.KEEP_CLIENTS]:
+				del self.finish[client]
+
+	def dequeue(self, key, ticket):
+		queue = self.waiting[key]
+		queue.remove(ticket)
+		if not queue:
+			del self.waiting[key]
+
+	# writes, if given, is what the operation is about to write, so cancel()
+	# can tell if it's still worth doing.
+
+	def acquire(self, blocking=True, writes=()):
+		me = threading.get_ident()
+		client = self.client()
+		lane = LANES.index(self.lane())
+		with self.condition:
+			if self.owner == me:
+				self.depth += 1
+				return True
+
+			# Without waiting, only if nobody else is waiting either.
+			if not blocking:
+				if self.owner is not None or self.waiting:
+					return False
+				self.owner = me
+				self.depth = 1
+				self.statsFor(client).waited(0.0)
+				self.laneStats[LANES[lane]].waited(0.0)
+				return True
+
+			if self.limit and self.waitingFor(client) >= self.limit:
+				self.statsFor(client).rejected += 1
+				self.laneStats[LANES[lane]].rejected += 1
+				raise QueueFull(client)
+
+			start = max(self.virtual, self.finish.get(client, 0.0))
+			ticket = Ticket(start, start + 1.0 / self.weights.get(client, 1.0), next(self.order), frozenset(writes))
+			self.finish[client] = ticket.finish
+			self.waiting.setdefault((lane, client), collections.deque()).append(ticket)
+
+			while ticket.cancelled is None and (self.owner is not None or self.next() is not ticket):
+				self.condition.wait()
+			if ticket.cancelled is not None:
+				raise Superseded(ticket.cancelled)
+
+			self.dequeue((lane, client), ticket)
+			self.virtual = ticket.start
+			self.forget()
+			self.owner = me
+			self.depth = 1
+			waited = time.monotonic() - ticket.queued
+			self.statsFor(client).waited(waited)
+			self.laneStats[LANES[lane]].waited(waited)
+			return True
+
+	# Whether this thread has the lock.
+
+	def owned(self):
+		return self.owner == threading.get_ident()
+
+	def writing(self, *writes):
+		return Writing(self, writes)
+
+	# Cancel the writes waiting in lanes less urgent than this thread's that
+	# only write things in obsoletes (because by, in this thread, is about
+	# to write them itself).  Returns how many were cancelled.
+
+	def cancel(self, obsoletes, by):
+		lane = LANES.index(self.lane())
+		obsoletes = frozenset(obsoletes)
+		cancelled = 0
+		with self.condition:
+			for (queueLane, client), queue in list(self.waiting.items()):
+				if queueLane <= lane:
+					continue
+				for ticket in list(queue):
+					if ticket.writes and ticket.writes <= obsoletes:
+						ticket.cancelled = by
+						self.dequeue((queueLane, client), ticket)
+						self.statsFor(client).cancelled += 1
+						self.laneStats[LANES[queueLane]].cancelled += 1
+						cancelled += 1
+			if cancelled:
+				self.condition.notify_all()
+		return cancelled
+
+	def release(self):
+		with self.condition:
+			if self.owner != threading.get_ident():
+				raise RuntimeError("cannot release un-acquired lock")
+			self.depth -= 1
+			if self.depth == 0:
+				self.owner = None
+				# With nothing waiting, every client is idle: move virtual
+				# on past all of them, and forget them all.
+				if not self.waiting:
+					self.virtual = max([self.virtual] + list(self.finish.values()))
+					self.finish.clear()
+				self.condition.notify_all()
+
+	def __enter__(self):
+		self.acquire()
+		return self
+
+	def __exit__(self, *exception):
+		self.release()
+
+	# For /health: each client's share so far, and how long things have
+	# waited in each lane, in milliseconds.
+
+	def report(self):
+		with self.condition:
+			report = {}
+			for client, stats in self.stats.items():
+				report[client] = stats.report()
+				report[client]["weight"] = self.weights.get(client, 1.0)
+				report[client]["waiting"] = self.waitingFor(client)
+			return report
+
+	def laneReport(self):
+		with self.condition:
+			report = {}
+			for index, lane in enumerate(LANES):
+				report[lane] = self.laneStats[lane].report()
+				report[lane]["waiting"] = sum(len(queue) for (queueLane, client), queue in self.waiting.items() if queueLane == index)
+			return report
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+# flightlog.py
+#
+# A flight recorder for reverie.py: the last few thousand things it did
+# (everything it printed, every read and write to the bed, and every request),
+# kept in memory, and written to disk when the connection to the bed is lost or
+# the service stops, so what led up to it isn't lost with the process.
+#
+# Recording an entry is one tuple appended to a deque of fixed size, which is
+# thread safe on its own, so it's cheap enough to do for every bluetooth
+# operation.  Nothing is formatted until the log is looked at.
+#
+# The file is JSON, one entry per line:
+#
+#     {"time": 1700000000.123, "thread": "connectBed", "event": "read", "uuid": "db8010a0-...", ...}
+
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+class FlightLog:
+	def __init__(self, size=2000):
+		self.entries = collections.deque(maxlen=size)
+		self.recorded = 0
+
+	def resize(self, size):
+		self.entries = collections.deque(self.entries, maxlen=size)
+
+	def record(self, event, **fields):
+		self.entries.append((time.time(), threading.current_thread().name, event, fields))
+		self.recorded += 1
+
+	# The last limit entries (all of them if limit is None), oldest first, as
+	# dicts ready for JSON.  Bytes are shown in hex.
+
+	def snapshot(self, limit=None):
+		entries = list(self.entries)
+		if limit is not None:
+			entries = entries[-limit:] if limit > 0 else []
+		return [entryDict(entry) for entry in entries]
+
+	# Write the log to filename, and keep the one written before as
+	# filename.1.
+
+	def dump(self, filename):
+		try:
+			os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+			with open(filename + ".tmp", "w") as f:
+				for entry in self.snapshot():
+					f.write(json.dumps(entry) + "\n")
+			if os.path.exists(filename):
+				os.replace(filename, filename + ".1")
+			os.replace(filename + ".tmp", filename)
+		except OSError as error:
+			print("Unable to write flight log " + filename + ": " + str(error))
+			return False
+		return True
+
+def entryDict(entry):
+	when, thread, event, fields = entry
+	values = {"time": round(when, 6), "thread": thread, "event": event}
+	for name, value in fields.items():
+		values[name] = value.hex() if isinstance(value, (bytes, bytearray)) else value
+	return values
+
+# Everything printed is recorded as well as printed, so the existing print()
+# diagnostics end up in the log without changing them.  Each line is one
+# entry; print() writes its arguments separately, so a line is put together
+# (for each thread) until its newline.
+
+class PrintRecorder:
+	def __init__(self, stream, log):
+		self.stream = stream
+		self.log = log
+		self.pending = threading.local()
+
+	def write(self, text):
+		lines = (getattr(self.pending, "text", "") + text).split("\n")
+		self.pending.text = lines.pop()
+		for line in lines:
+			if line.strip():
+				self.log.record("print", message=line)
+		return self.stream.write(text)
+
+	def __getattr__(self, name):
+		return getattr(self.stream, name)
+
+def recordPrints(log):
+	sys.stdout = PrintRecorder(sys.stdout, log)
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+
+# homekit.py
+#
+# A HomeKit accessory server built into reverie.py (set HOMEKIT_PORT), so the
+# Home app talks to the bed directly, rather than through homebridge, HTTP and
+# a light dimmer pretending to be each part of the bed.  The bed shows up as a
+# bridge with:
+#
+#     Head, Feet, Tilt (or Lumbar)    window coverings, 0-100% like the set URLs
+#     Light                           a light
+#     Flat, Zero G, Anti-Snore        switches that turn themselves back off
+#     Head, Feet and Wave Massage     fans, with the speed as the level
+#
+# Commands run the same functions as the URLs (one at a time, in the order
+# they came in, on their own thread so HomeKit never waits on the bed), and
+# what HomeKit shows comes from the last known state of the bed, which is
+# checked every second; nothing is read from the bed just for HomeKit.
+#
+# Needs HAP-python (pip3 install HAP-python).  The first time it runs, it
+# prints the setup code to pair with.  The pairing is kept in the state file,
+# so if that is lost, remove the bridge from the Home app and pair it again.
+
+import os
+import queue
+import threading
+
+from pyhap.accessory import Accessory, Bridge
+from pyhap.accessory_driver import AccessoryDriver
+from pyhap.const import CATEGORY_BRIDGE, CATEGORY_FAN, CATEGORY_LIGHTBULB, CATEGORY_SWITCH, CATEGORY_WINDOW_COVERING
+
+# Window covering PositionState: not moving.
+STOPPED = 2
+
+###############################################################################
+# Accessories
+#
+# Each one is made with the bridge, and calls bridge.command() to change
+# something on the bed, and has update() called with the state of the bed
+# (the same as /state) to show it.
+###############################################################################
+
+class Position(Accessory):
+	category = CATEGORY_WINDOW_COVERING
+
+	def __init__(self, bridge, name, command, key):
+		Accessory.__init__(self, bridge.driver, name)
+		self.bridge = bridge
+		self.command = command
+		self.key = key
+		service = self.add_preload_service("WindowCovering")
+		self.current = service.configure_char("CurrentPosition")
+		self.target = service.configure_char("TargetPosition", setter_callback=self.setTarget)
+		service.configure_char("PositionState", value=STOPPED)
+
+	def setTarget(self, value):
+		self.bridge.command(self.command, value)
+
+	# The target follows the position too, so a change made some other way
+	# doesn't leave HomeKit showing the bed as still moving.
+
+	def update(self, state):
+		if state.get(self.key) is not None and state[self.key] != self.current.value:
+			self.current.set_value(state[self.key])
+			self.target.set_value(state[self.key])
+
+class Light(Accessory):
+	category = CATEGORY_LIGHTBULB
+
+	def __init__(self, bridge, name):
+		Accessory.__init__(self, bridge.driver, name)
+		self.bridge = bridge
+		service = self.add_preload_service("Lightbulb")
+		self.on = service.configure_char("On", setter_callback=self.setOn)
+
+	def setOn(self, value):
+		self.bridge.command("light/on" if value else "light/off")
+
+	def update(self, state):
+		self.on.set_value(bool(state.get("light")))
+
+# A preset is a switch that runs the preset when it's turned on, then turns
+# itself off again, like a button.
+
+class Preset(Accessory):
+	category = CATEGORY_SWITCH
+
+	def __init__(self, bridge, name, command):
+		Accessory.__init__(self, bridge.driver, name)
+		self.bridge = bridge
+		self.command = command
+		service = self.add_preload_service("Switch")
+		self.on = service.configure_char("On", setter_callback=self.setOn)
+
+	def setOn(self, value):
+		if value:
+			self.bridge.command(self.command, done=lambda: self.on.set_value(False))
+
+	def update(self, state):
+		pass
+
+# A massage is a fan.  Turning it on without a speed starts it at the speed it
+# was last set to (or half speed).  scale is the number of settings the
+# command takes for 100% (100 for the head and feet, MAX_WAVES for the wave).
+
+class Massage(Accessory):
+	category = CATEGORY_FAN
+
+	def __init__(self, bridge, name, command, key, scale=100):
+		Accessory.__init__(self, bridge.driver, name)
+		self.bridge = bridge
+		self.command = command
+		self.key = key
+		self.scale = scale
+		self.last = 50
+		service = self.add_preload_service("Fan", chars=["RotationSpeed"])
+		self.on = service.configure_char("On", setter_callback=self.setOn)
+		self.speed = service.configure_char("RotationSpeed", setter_callback=self.setSpeed)
+
+	def setOn(self, value):
+		self.setSpeed(self.last if value else 0)
+
+	def setSpeed(self, value):
+		if value > 0:
+			self.last = value
+		self.bridge.command(self.command, round(value * self.scale / 100))
+
+	def update(self, state):
+		level = state.get(self.key) or 0
+		if level > 0:
+			self.speed.set_value(min(100, round(level * 100 / self.scale)))
+		self.on.set_value(level > 0)
+
+###############################################################################
+# The bridge
+###############################################################################
+
+class BedBridge(Bridge):
+	category = CATEGORY_BRIDGE
+
+	# run(command, value) runs a command the same way a URL does, state()
+	# returns the last known state of the bed, and onError(error) is called
+	# with anything a command raises.
+
+	def __init__(self, driver, name, run, state, useTilt, maxWaves, onError=None):
+		Bridge.__init__(self, driver, name)
+		self.runCommand = run
+		self.state = state
+		self.onError = onError
+		self.commands = queue.Queue()
+
+		accessories = [
+			Position(self, "Head", "setHead", "head"),
+			Position(self, "Feet", "setFeet", "feet"),
+			Position(self, "Tilt", "setTilt", "tilt") if useTilt else Position(self, "Lumbar", "setLumbar", "lumbar"),
+			Light(self, "Light"),
+			Preset(self, "Flat", "flat"),
+			Preset(self, "Zero G", "zeroG"),
+			Preset(self, "Anti-Snore", "noSnore"),
+			Massage(self, "Head Massage", "setHeadMassage", "headMassage"),
+			Massage(self, "Feet Massage", "setFeetMassage", "feetMassage"),
+			Massage(self, "Wave Massage", "setWaveMassage", "waveMassage", maxWaves),
+		]
+		for accessory in accessories:
+			self.add_accessory(accessory)
+
+		threading.Thread(target=self.runCommands, name="homekit", daemon=True).start()
+
+	# Called from the HomeKit server's event loop, which mustn't wait for the
+	# bed, so the command is queued.  done, if given, is called once it has run.
+
+	def command(self, command, value=None, done=None):
+		self.commands.put((command, value, done))
+
+	def runCommands(self):
+		while True:
+			command, value, done = self.commands.get()
+			try:
+				self.runCommand(command, value)
+			except Exception as error:
+				print("HomeKit " + command + " failed: " + repr(error))
+				if self.onError is not None:
+					self.onError(error)
+			if done is not None:
+				self.driver.loop.call_soon_threadsafe(done)
+
+	@Accessory.run_at_interval(1)
+	def run(self):
+		state = self.state()
+		for accessory in self.accessories.values():
+			accessory.update(state)
+
+# Start the accessory server on its own thread, with its own event loop.
+
+def startHomeKit(port, persistFile, name, run, state, useTilt, maxWaves, pincode=None, onError=None):
+	def serve():
+		os.makedirs(os.path.dirname(persistFile) or ".", exist_ok=True)
+		driver = AccessoryDriver(port=port, persist_file=persistFile, pincode=pincode.encode() if pincode else None)
+		driver.add_accessory(BedBridge(driver, name, run, state, useTilt, maxWaves, onError))
+		driver.start()
+
+	thread = threading.Thread(target=serve, name="homekitServer", daemon=True)
+	thread.start()
+	return thread
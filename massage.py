@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+
+# massage.py
+#
+# Runs massage programs inside reverie.py, so a pattern (pulses, alternating
+# head and feet, speeding up and slowing down) doesn't need a client sending
+# a stream of /setHeadMassage calls with all the timing jitter that goes with
+# it.
+#
+# A program is a list of steps, run in order, and repeated as many times as
+# you like.  Each step sets any of the head, feet and wave massage, then holds
+# for a number of seconds, and can itself be repeated:
+#
+#     {
+#         "repeat": 10,
+#         "steps": [
+#             {"head": 50, "feet": 0, "duration": 2},
+#             {"head": 0, "feet": 50, "duration": 2}
+#         ]
+#     }
+#
+# "repeat" of 0 runs the program until it's stopped.  Only the settings that
+# actually change are sent to the bed, and the timing of each step is taken
+# from when the program started, so it doesn't drift however long it runs.
+
+import threading
+import time
+
+CHANNELS = ("head", "feet", "wave")
+
+# Check a program and turn it into a list of (settings, duration) with each
+# step's own repeat already expanded.  convert is called with (channel, value)
+# and returns the raw value to send to the bed for it.
+
+def parseProgram(program, convert):
+	if not isinstance(program, dict) or not isinstance(program.get("steps"), list) or not program["steps"]:
+		raise ValueError("a program needs a list of steps")
+
+	steps = []
+	for step in program["steps"]:
+		if not isinstance(step, dict):
+			raise ValueError("each step must be an object")
+
+		settings = {}
+		for channel in CHANNELS:
+			if channel in step:
+				settings[channel] = convert(channel, int(step[channel]))
+
+		duration = float(step.get("duration", 0))
+		if duration <= 0:
+			raise ValueError("each step needs a duration")
+
+		steps += [(settings, duration)] * max(1, int(step.get("repeat", 1)))
+
+	repeat = int(program.get("repeat", 1))
+	if repeat < 0:
+		raise ValueError("repeat can't be negative")
+
+	return steps, repeat
+
+class MassageProgram:
+	# write is called with (channel, raw value) to send a setting to the bed.
+	# current is the raw setting of each channel right now, so the first step
+	# doesn't send anything that is already set.  onError, if given, is called
+	# with the exception if a write fails, which ends the program.
+
+	def __init__(self, steps, repeat, write, current, name=None, onError=None):
+		self.steps = steps
+		self.repeat = repeat
+		self.write = write
+		self.onError = onError
+		self.current = dict(current)
+		self.name = name
+		self.stopped = threading.Event()
+		self.thread = None
+		self.round = 0
+		self.step = 0
+		self.writes = 0
+		self.skipped = 0
+		self.error = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run, name="massage", daemon=True)
+		self.thread.start()
+
+	# Stop the program.  The massage is left as it is; it's up to the caller to
+	# turn it off (which /stopMassage does straight after).
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread is not None and self.thread is not threading.current_thread():
+			self.thread.join()
+
+	def running(self):
+		return self.thread is not None and self.thread.is_alive()
+
+	def status(self):
+		return {
+			"name": self.name,
+			"running": self.running(),
+			"round": self.round,
+			"repeat": self.repeat,
+			"step": self.step,
+			"steps": len(self.steps),
+			"writes": self.writes,
+			"skipped": self.skipped,
+			"error": self.error,
+		}
+
+	def apply(self, settings):
+		for channel, value in settings.items():
+			if self.current.get(channel) == value:
+				self.skipped += 1
+				continue
+			self.write(channel, value)
+			self.current[channel] = value
+			self.writes += 1
+
+	def run(self):
+		deadline = time.monotonic()
+		try:
+			while self.repeat == 0 or self.round < self.repeat:
+				self.round += 1
+				for self.step, (settings, duration) in enumerate(self.steps, 1):
+					self.apply(settings)
+					deadline += duration
+					if self.stopped.wait(max(0, deadline - time.monotonic())):
+						return
+
+			# The program finished on its own, so turn off whatever it left on.
+			self.apply({channel: 0 for channel, value in self.current.items() if value})
+		except Exception as error:
+			print("Massage program failed: " + str(error))
+			self.error = str(error)
+			if self.onError is not None:
+				self.onError(error)
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+# motion.py
+#
+# Smooth moves for reverie.py.  Rather than jumping the head, feet or tilt
+# straight to a new position, a move gets there over a number of seconds,
+# following a speed profile, with the daemon sending the in-between positions
+# itself.
+#
+# There is one Mover (and one thread) for the bed.  Each tick, it works out
+# where every part that is moving should be, and hands them all over in one
+# go, so the head and feet moving at the same time is still just one write
+# per tick.  The tick is never shorter than twice the time the last write
+# took, so a slow link gets fewer, bigger steps instead of a backlog.
+
+import math
+import threading
+import time
+
+# Each profile maps how far through the move we are in time (0-1) to how far
+# through it we should be in distance (0-1).
+
+PROFILES = {
+	"linear": lambda t: t,
+	"easeIn": lambda t: t * t,
+	"easeOut": lambda t: 1 - (1 - t) * (1 - t),
+	"easeInOut": lambda t: (1 - math.cos(math.pi * t)) / 2,
+}
+
+class Move:
+	def __init__(self, start, target, duration, profile):
+		self.start = start
+		self.target = target
+		self.duration = duration
+		self.profile = profile
+		self.began = time.monotonic()
+
+	def position(self, now):
+		if self.duration <= 0:
+			return self.target, True
+		t = min(1.0, (now - self.began) / self.duration)
+		return round(self.start + (self.target - self.start) * PROFILES[self.profile](t)), t >= 1.0
+
+class Mover:
+	# write is called with {part: position} for every part that has moved
+	# since the last tick.  interval is the shortest time between ticks, and
+	# latency returns how long (in seconds) the last write to the bed took.
+	# onError, if given, is called with the exception if a write fails, which
+	# stops every move.
+
+	def __init__(self, write, interval=0.25, latency=None, onError=None):
+		self.write = write
+		self.interval = interval
+		self.latency = latency
+		self.onError = onError
+		self.moves = {}
+		self.last = {}
+		self.ticks = 0
+		self.wake = threading.Condition()
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.loop, name="mover", daemon=True)
+		self.thread.start()
+
+	def move(self, part, start, target, duration, profile="easeInOut"):
+		if profile not in PROFILES:
+			raise ValueError("unknown profile " + profile)
+		with self.wake:
+			self.moves[part] = Move(start, target, float(duration), profile)
+			self.last[part] = start
+			self.wake.notify()
+
+	# Stop moving a part (or every part), leaving it wherever it got to.  If a
+	# write is in progress, this waits for it, so once it returns, nothing
+	# more will be written for that part.
+
+	def cancel(self, part=None):
+		with self.wake:
+			if part is None:
+				self.moves.clear()
+			else:
+				self.moves.pop(part, None)
+
+	def status(self):
+		now = time.monotonic()
+		with self.wake:
+			return {
+				part: {
+					"position": move.position(now)[0],
+					"target": move.target,
+					"remaining": round(max(0, move.began + move.duration - now), 2),
+					"profile": move.profile,
+				}
+				for part, move in self.moves.items()
+			}
+
+	def tickInterval(self):
+		latency = self.latency() if self.latency is not None else None
+		return max(self.interval, 2 * (latency or 0))
+
+	def loop(self):
+		while True:
+			with self.wake:
+				while not self.moves:
+					self.wake.wait()
+
+				now = time.monotonic()
+				changed = {}
+				for part, move in list(self.moves.items()):
+					position, finished = move.position(now)
+					if position != self.last.get(part):
+						changed[part] = position
+						self.last[part] = position
+					if finished:
+						del self.moves[part]
+
+				error = None
+				if changed:
+					try:
+						self.write(changed)
+					except Exception as exception:
+						print("Move failed: " + str(exception))
+						self.moves.clear()
+						error = exception
+				self.ticks += 1
+
+			if error is not None and self.onError is not None:
+				self.onError(error)
+
+			time.sleep(self.tickInterval())
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+
+# mqttbridge.py
+#
+# Connects reverie.py to an MQTT broker (set MQTT_BROKER), for home
+# automation that would rather not poll the get URLs.
+#
+# The state of the bed is published, retained, under <prefix>/state, one topic
+# for each value in /state (and in the same units), and only when it changes:
+#
+#     reverie/state/head          35
+#     reverie/state/light         1
+#
+# <prefix>/status is "online" while the bridge is connected, and the broker
+# sets it to "offline" if the connection is lost.
+#
+# Commands are sent to <prefix>/command/<name>, with the same names as the
+# URLs, and the value (if it takes one) as the payload:
+#
+#     reverie/command/setHead     50
+#     reverie/command/flat
+#     reverie/command/light/on
+#     reverie/command/stopMassage
+#
+# If the broker goes away, the bridge keeps trying to connect again, and
+# publishes the whole state once it does.
+#
+# Needs paho-mqtt (pip3 install paho-mqtt), unless a client is passed in with
+# clientFactory: anything with the same methods and callbacks as paho's
+# Client will do, such as mqttstandin.py's, which doesn't need a broker at all
+# (check-mqtt.py uses it to check the bridge).
+
+import queue
+import threading
+
+def pahoClient(clientId):
+	import paho.mqtt.client as mqtt
+
+	# paho-mqtt 2 wants to be told which version of the callbacks we use.
+	if hasattr(mqtt, "CallbackAPIVersion"):
+		return mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, clientId)
+	return mqtt.Client(clientId)
+
+class MqttBridge:
+	# run(command, value) runs a command the same way a URL does, commands
+	# is the same table as COMMANDS (name: (function, takesValue)), state()
+	# returns the state of the bed as a dict, and onError(error) is called with
+	# anything a command raises.
+
+	def __init__(self, host, port, run, commands, state, prefix="reverie", qos=1, clientId="reverie-powerbase",
+			username=None, password=None, onError=None, clientFactory=pahoClient):
+		self.host = host
+		self.port = port
+		self.runCommand = run
+		self.commandTable = commands
+		self.state = state
+		self.prefix = prefix.rstrip("/")
+		self.qos = qos
+		self.onError = onError
+		self.published = {}
+		self.connected = False
+		self.changed = threading.Event()
+		self.commands = queue.Queue()
+
+		self.client = clientFactory(clientId)
+		if username:
+			self.client.username_pw_set(username, password)
+		self.client.will_set(self.prefix + "/status", "offline", qos, retain=True)
+		self.client.reconnect_delay_set(1, 60)
+		self.client.on_connect = self.onConnect
+		self.client.on_disconnect = self.onDisconnect
+		self.client.on_message = self.onMessage
+
+	def start(self):
+		threading.Thread(target=self.publisher, name="mqttPublisher", daemon=True).start()
+		threading.Thread(target=self.runCommands, name="mqttCommands", daemon=True).start()
+		self.client.connect_async(self.host, self.port)
+		self.client.loop_start()
+
+	# Called whenever the state of the bed may have changed.
+
+	def notify(self):
+		self.changed.set()
+
+	###########################################################################
+	# Callbacks from the client's network thread
+	###########################################################################
+
+	def onConnect(self, client, userdata, flags, rc):
+		if rc != 0:
+			print("MQTT connection to " + self.host + " refused: " + str(rc))
+			return
+		print("Connected to MQTT broker " + self.host)
+		client.subscribe(self.prefix + "/command/#", self.qos)
+		client.publish(self.prefix + "/status", "online", self.qos, retain=True)
+
+		# The broker may have lost what we published before, so send it all.
+		self.connected = True
+		self.published = {}
+		self.changed.set()
+
+	def onDisconnect(self, client, userdata, rc):
+		self.connected = False
+		if rc != 0:
+			print("Lost connection to MQTT broker " + self.host + "; reconnecting")
+
+	# The command runs on its own thread, so the client can carry on with the
+	# broker while it waits for the bed.
+
+	def onMessage(self, client, userdata, message):
+		self.commands.put((message.topic, message.payload))
+
+	###########################################################################
+	# Commands
+	###########################################################################
+
+	def runCommands(self):
+		while True:
+			topic, payload = self.commands.get()
+			command = topic[len(self.prefix + "/command/"):]
+			if command not in self.commandTable:
+				print("MQTT: unknown command " + topic)
+				continue
+
+			try:
+				value = None
+				if self.commandTable[command][1]:
+					value = int(payload.decode().strip())
+				self.runCommand(command, value)
+			except ValueError:
+				print("MQTT: bad value for " + command + ": " + str(payload))
+			except Exception as error:
+				print("MQTT " + command + " failed: " + repr(error))
+				if self.onError is not None:
+					self.onError(error)
+			self.changed.set()
+
+	###########################################################################
+	# State
+	###########################################################################
+
+	def publisher(self):
+		while True:
+			self.changed.wait()
+			self.changed.clear()
+			if not self.connected:
+				continue
+
+			for key, value in self.state().items():
+				if value is None or self.published.get(key) == value:
+					continue
+				info = self.client.publish(self.prefix + "/state/" + key, str(value), self.qos, retain=True)
+				if info.rc == 0:
+					self.published[key] = value
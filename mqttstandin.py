@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+
+# mqttstandin.py
+#
+# A stand-in for an MQTT broker, and for paho's Client, for trying the MQTT
+# bridge (mqttbridge.py) without a broker, or paho-mqtt, at all.  It's all in
+# memory: the broker keeps the retained messages and who's subscribed to
+# what, and hands each message to the clients whose subscriptions match, on
+# each client's own thread (the same as paho's network thread).
+#
+#     broker = mqttstandin.StandInBroker()
+#     bridge = MqttBridge("standin", 1883, run, COMMANDS, state, clientFactory=broker.client)
+#
+# drop() cuts a client off, the same as a broker going away: the client's
+# last will is published, and it connects again after its reconnect delay.
+# check-mqtt.py drives the bridge through it.
+
+import queue
+import threading
+
+# Whether topic matches filter, with MQTT's + (one level) and # (the rest).
+
+def topicMatches(filter, topic):
+	filterLevels = filter.split("/")
+	topicLevels = topic.split("/")
+	for index, level in enumerate(filterLevels):
+		if level == "#":
+			return True
+		if index >= len(topicLevels):
+			return False
+		if level != "+" and level != topicLevels[index]:
+			return False
+	return len(filterLevels) == len(topicLevels)
+
+class Message:
+	def __init__(self, topic, payload, qos=0, retain=False):
+		self.topic = topic
+		self.payload = payload if isinstance(payload, bytes) else str(payload).encode()
+		self.qos = qos
+		self.retain = retain
+
+# What publish() returns; rc 0 is success, the same as paho.
+
+class MessageInfo:
+	def __init__(self, rc):
+		self.rc = rc
+
+class StandInBroker:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.retained = {}
+		self.clients = []
+		self.published = []
+
+	# Used as MqttBridge's clientFactory.
+
+	def client(self, clientId):
+		return StandInClient(self, clientId)
+
+	def connect(self, client):
+		with self.lock:
+			if client not in self.clients:
+				self.clients.append(client)
+		client.deliver(("connect",))
+
+	def subscribe(self, client, filter):
+		with self.lock:
+			client.filters.append(filter)
+			retained = [message for topic, message in self.retained.items() if topicMatches(filter, topic)]
+		for message in retained:
+			client.deliver(("message", message))
+
+	def publish(self, message):
+		with self.lock:
+			self.published.append(message)
+			if message.retain:
+				if message.payload:
+					self.retained[message.topic] = message
+				else:
+					self.retained.pop(message.topic, None)
+			clients = [client for client in self.clients if any(topicMatches(filter, message.topic) for filter in client.filters)]
+		for client in clients:
+			client.deliver(("message", Message(message.topic, message.payload, message.qos, False)))
+
+	def disconnect(self, client, unexpected=False):
+		with self.lock:
+			if client not in self.clients:
+				return
+			self.clients.remove(client)
+			client.filters = []
+		if unexpected and client.will is not None:
+			self.publish(client.will)
+		client.deliver(("disconnect", 1 if unexpected else 0))
+
+	# Cut client off without it asking: its will is published, and it comes
+	# back after its reconnect delay.
+
+	def drop(self, client):
+		self.disconnect(client, unexpected=True)
+
+class StandInClient:
+	def __init__(self, broker, clientId):
+		self.broker = broker
+		self.clientId = clientId
+		self.filters = []
+		self.will = None
+		self.username = None
+		self.reconnectDelay = 1
+		self.running = False
+		self.events = queue.Queue()
+		self.on_connect = None
+		self.on_disconnect = None
+		self.on_message = None
+
+	def username_pw_set(self, username, password=None):
+		self.username = username
+
+	def will_set(self, topic, payload=None, qos=0, retain=False):
+		self.will = Message(topic, payload or b"", qos, retain)
+
+	def reconnect_delay_set(self, minDelay=1, maxDelay=120):
+		self.reconnectDelay = minDelay
+
+	def connect_async(self, host, port=1883, keepalive=60):
+		self.host = host
+
+	def loop_start(self):
+		self.running = True
+		threading.Thread(target=self.loop, name="mqttstandin-" + self.clientId, daemon=True).start()
+		self.broker.connect(self)
+
+	def loop_stop(self):
+		self.running = False
+		self.events.put(None)
+
+	def disconnect(self):
+		self.broker.disconnect(self)
+
+	def subscribe(self, topic, qos=0):
+		self.broker.subscribe(self, topic)
+		return 0, 1
+
+	# Like paho, fails (rc 4, not connected) while the broker has dropped us.
+
+	def publish(self, topic, payload=None, qos=0, retain=False):
+		if self not in self.broker.clients:
+			return MessageInfo(4)
+		self.broker.publish(Message(topic, payload if payload is not None else b"", qos, retain))
+		return MessageInfo(0)
+
+	def deliver(self, event):
+		self.events.put(event)
+
+	# The client's network thread: every callback runs here, one at a time.
+
+	def loop(self):
+		while self.running:
+			event = self.events.get()
+			if event is None:
+				return
+			if event[0] == "connect":
+				if self.on_connect is not None:
+					self.on_connect(self, None, {}, 0)
+			elif event[0] == "message":
+				if self.on_message is not None:
+					self.on_message(self, None, event[1])
+			elif event[0] == "disconnect":
+				if self.on_disconnect is not None:
+					self.on_disconnect(self, None, event[1])
+				if event[1] != 0:
+					threading.Timer(self.reconnectDelay, self.broker.connect, (self,)).start()
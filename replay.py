@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+
+# replay.py
+#
+# Replays a trace recorded by reverie.py (TRACE_FILE) to reproduce a problem
+# away from the running service.  It can replay against the bed itself, or
+# against a stand-in that answers reads with what the bed answered in the
+# trace, and can keep the original timing, speed it up, or go flat out.
+#
+#     replay.py --dump trace.bin                 print the trace
+#     replay.py trace.bin                        replay against the stand-in
+#     replay.py --mac C8:D0:76:DD:C8:90 trace.bin
+#                                                replay against the bed
+#     replay.py --speed 10 trace.bin             ten times faster
+#     replay.py --speed 0 trace.bin              no delays at all
+#
+# Reads that come back different from the trace, and any operation that fails
+# where it didn't before (or the other way around), are reported, along with
+# the latency of each kind of operation in the trace and in the replay.
+#
+# Remember that replaying against the bed really moves it.
+
+import argparse
+import collections
+import sys
+import time
+
+from bletrace import readTrace, OP_READ, OP_WRITE, OP_NAMES
+
+###############################################################################
+# Stand-in for the bed
+###############################################################################
+
+# Answers each read of a characteristic with the next value the bed gave for
+# it in the trace, and takes as long over each read and write as the bed did
+# (divided by speed).  Once it runs out of reads for a characteristic, it keeps
+# answering with the last one.
+
+class TraceStandIn:
+	def __init__(self, records, speed):
+		self.speed = speed
+		self.reads = collections.defaultdict(collections.deque)
+		self.writes = collections.defaultdict(collections.deque)
+		self.last = {}
+		for record in records:
+			if record.op == OP_READ and record.ok:
+				self.reads[record.uuid].append((record.payload, record.latency))
+			elif record.op == OP_WRITE:
+				self.writes[record.uuid].append(record.latency)
+
+	def delay(self, latency):
+		if self.speed:
+			time.sleep(latency / self.speed)
+
+	def read(self, uuid):
+		if self.reads[uuid]:
+			self.last[uuid] = self.reads[uuid].popleft()
+		payload, latency = self.last.get(uuid, (b"", 0.0))
+		self.delay(latency)
+		return payload
+
+	def write(self, uuid, payload):
+		if self.writes[uuid]:
+			self.delay(self.writes[uuid].popleft())
+
+###############################################################################
+# The bed itself
+###############################################################################
+
+class Bed:
+	def __init__(self, mac):
+		from bluepy import btle
+
+		print("Connecting to " + mac)
+		self.dev = btle.Peripheral(mac, "random")
+		self.characteristics = {}
+		for characteristic in self.dev.getCharacteristics():
+			self.characteristics[str(characteristic.uuid).lower()] = characteristic
+
+	def read(self, uuid):
+		return self.characteristics[uuid].read()
+
+	def write(self, uuid, payload):
+		self.characteristics[uuid].write(payload)
+
+###############################################################################
+# Replay
+###############################################################################
+
+def percentile(values, fraction):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def summary(label, latencies):
+	for op, values in sorted(latencies.items()):
+		print("%-8s %-6s count %5d  mean %7.1f ms  p50 %7.1f ms  p95 %7.1f ms  max %7.1f ms" % (
+			label, OP_NAMES.get(op, op), len(values),
+			sum(values) / len(values) * 1000, percentile(values, 0.5) * 1000,
+			percentile(values, 0.95) * 1000, max(values) * 1000))
+
+def dump(records):
+	start = None
+	for record in records:
+		if start is None:
+			start = record.time
+		print("%10.3f %-10s %-36s %7.1f ms %-4s %s" % (
+			record.time - start, OP_NAMES.get(record.op, record.op), record.uuid or "",
+			record.latency * 1000, "ok" if record.ok else "FAIL", record.payload.hex()))
+
+def replay(records, target, speed):
+	traced = collections.defaultdict(list)
+	replayed = collections.defaultdict(list)
+	problems = 0
+
+	start = time.monotonic()
+	first = None
+	for number, record in enumerate(records, 1):
+		if record.op not in (OP_READ, OP_WRITE):
+			continue
+		if first is None:
+			first = record.time
+
+		# Keep the gaps between operations, scaled by speed.
+		if speed:
+			wait = start + (record.time - first) / speed - time.monotonic()
+			if wait > 0:
+				time.sleep(wait)
+
+		traced[record.op].append(record.latency)
+		began = time.monotonic()
+		ok = True
+		try:
+			if record.op == OP_READ:
+				payload = target.read(record.uuid)
+			else:
+				target.write(record.uuid, record.payload)
+				payload = record.payload
+		except Exception as error:
+			ok = False
+			payload = str(error).encode()
+		replayed[record.op].append(time.monotonic() - began)
+
+		if ok != record.ok:
+			problems += 1
+			print("#%d %s %s: %s in the trace, %s in the replay (%s)" % (
+				number, OP_NAMES[record.op], record.uuid, "worked" if record.ok else "failed",
+				"worked" if ok else "failed", payload.decode(errors="replace")))
+		elif ok and record.op == OP_READ and payload != record.payload:
+			problems += 1
+			print("#%d read %s: %s in the trace, %s in the replay" % (
+				number, record.uuid, record.payload.hex(), payload.hex()))
+
+	print()
+	summary("trace", traced)
+	summary("replay", replayed)
+	print("%d differences" % problems)
+	return problems
+
+parser = argparse.ArgumentParser(description="Replay a reverie.py bluetooth trace.")
+parser.add_argument("trace", help="trace file recorded with TRACE_FILE")
+parser.add_argument("--mac", help="replay against the bed with this MAC address instead of the stand-in")
+parser.add_argument("--speed", type=float, default=1.0, help="how much faster than real time to go; 0 for no delays (default 1)")
+parser.add_argument("--dump", action="store_true", help="just print the trace")
+args = parser.parse_args()
+
+records = list(readTrace(args.trace))
+if args.dump:
+	dump(records)
+	sys.exit()
+
+if args.mac:
+	target = Bed(args.mac)
+else:
+	target = TraceStandIn(records, args.speed)
+
+sys.exit(1 if replay(records, target, args.speed) else 0)
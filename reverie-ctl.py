@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+# reverie-ctl.py
+#
+# Command line client for the reverie.py Unix socket, for shell scripts on the
+# same machine.  Give it a command the same way you would write the URL:
+#
+#     reverie-ctl.py setHead 50
+#     reverie-ctl.py light/status
+#     reverie-ctl.py adjust head +5
+#     reverie-ctl.py adjust head -5
+#
+# or give it no command, and it will run one command per line from standard
+# input over a single connection.  The reply is printed, and the exit status is
+# 0 if every command worked, and 1 if any of them didn't.
+#
+# The socket path is taken from -s, or UNIX_SOCKET in the environment (the
+# same setting reverie.py uses).
+
+import argparse
+import os
+import sys
+
+from unixsocket import CommandClient
+
+parser = argparse.ArgumentParser(description="Send commands to reverie.py over its Unix socket.")
+parser.add_argument("-s", "--socket", default=os.environ.get("UNIX_SOCKET", "/run/reverie-powerbase/reverie.sock"),
+	help="path of the socket (default: %(default)s)")
+parser.add_argument("-m", "--method", help="HTTP method to use, i.e. POST")
+parser.add_argument("-d", "--data", help="request body; use - to read it from standard input")
+parser.add_argument("command", nargs="*", help="the command, i.e. setHead 50")
+args = parser.parse_args()
+
+client = CommandClient(args.socket)
+try:
+	client.connect()
+except OSError as error:
+	print("Unable to connect to " + args.socket + ": " + str(error), file=sys.stderr)
+	sys.exit(2)
+
+def run(command, body=b""):
+	status, reply = client.send(command, body, args.method)
+	text = reply.decode(errors="replace")
+	if status < 400:
+		print(text)
+		return True
+	print(str(status) + " " + text, file=sys.stderr)
+	return False
+
+ok = True
+if args.command:
+	body = b""
+	if args.data == "-":
+		body = sys.stdin.buffer.read()
+	elif args.data:
+		body = args.data.encode()
+	ok = run(" ".join(args.command), body)
+else:
+	for line in sys.stdin:
+		if line.strip() and not line.startswith("#"):
+			ok = run(line.strip()) and ok
+
+client.close()
+sys.exit(0 if ok else 1)
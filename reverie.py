@@ -1,13 +1,38 @@
 #!/usr/bin/python3
 
-from flask import Flask, render_template
-from bluepy import btle
-from bluepy.btle import Scanner, DefaultDelegate
+import os
+
+# In slim mode (SLIM_MODE, see below) Flask is never imported at all.
+if os.environ.get("SLIM_MODE", "0") not in ("", "0"):
+	from slimweb import Flask, render_template, request, jsonify, g, has_request_context, HTTPException
+else:
+	from flask import Flask, render_template, request, jsonify, g, has_request_context
+	from werkzeug.exceptions import HTTPException
 import sys
 import time
 import math
-import os
 import signal
+import threading
+import json
+import hmac
+import atexit
+import string
+import urllib.parse
+from scheduler import Scheduler
+from unixsocket import CommandServer, CommandClient
+from massage import MassageProgram, parseProgram
+from motion import Mover
+from fairqueue import FairLock, QueueFull, Superseded
+import bletrace
+import sdnotify
+import sharedstate
+import transport
+import flightlog
+
+# Everything printed from here on is kept in the flight log as well (see
+# FLIGHT_LOG_SIZE below).
+flightLog = flightlog.FlightLog()
+flightlog.recordPrints(flightLog)
 
 ###############################################################################
 #
@@ -95,6 +120,26 @@ else:
 RPI_LISTEN_PORT = os.environ.get("RPI_LISTEN_PORT", "8001")
 print("Listening on port " + RPI_LISTEN_PORT)
 
+# On a small machine (a Pi Zero, say), Flask and everything it brings with it
+# take up a good part of the memory, and seconds to start.  Set SLIM_MODE to 1
+# to answer the same URLs with the web server built into Python instead (see
+# slimweb.py).  benchmark-startup.py compares the two.
+SLIM_MODE = os.environ.get("SLIM_MODE", "0") not in ("", "0")
+if SLIM_MODE:
+	print("Running in slim mode, without Flask")
+
+# If homebridge (or anything else) runs on the same machine, it can skip TCP
+# and HTTP altogether and talk to the bed over a Unix domain socket.  Set this
+# to the path of the socket to turn it on (i.e. /run/reverie-powerbase/reverie.sock);
+# leave it empty to turn it off.  Anyone who can write to the socket can control
+# the bed, so set the permissions (octal) and group to suit.  reverie-ctl.py is
+# a command line client for it.
+UNIX_SOCKET = os.environ.get("UNIX_SOCKET", "")
+UNIX_SOCKET_MODE = int(os.environ.get("UNIX_SOCKET_MODE", "660"), 8)
+UNIX_SOCKET_GROUP = os.environ.get("UNIX_SOCKET_GROUP", "")
+if UNIX_SOCKET:
+	print("Listening on Unix socket " + UNIX_SOCKET)
+
 # The factory set the fastest massage speed to 40% of what the motor
 # will actually do.  I am using that limit because I don't know if it's
 # an issue that can damage the bed, or just a comfort issue.
@@ -137,6 +182,181 @@ TILT_FLAT = os.environ.get("TILT_FLAT", 36)
 TILT_FLAT = int(TILT_FLAT)
 print("Bed's flat position tilt is " + str(TILT_FLAT))
 
+# The head and feet positions (0-100, separated by a comma) of the zeroG and
+# noSnore presets.  The tilt (or lumbar) is flat for both.
+ZEROG_POSITION = os.environ.get("ZEROG_POSITION", "31,70")
+NOSNORE_POSITION = os.environ.get("NOSNORE_POSITION", "11,0")
+print("Preset positions are zeroG " + ZEROG_POSITION + ", noSnore " + NOSNORE_POSITION)
+
+# The settings above (from MAX_MASSAGE_SPEED down) can be changed without
+# restarting, and losing the connection to the bed: edit this file, then
+# either "systemctl reload reverie-powerbase" or POST to /admin/reload (with
+# ADMIN_TOKEN).  HomeKit keeps the ones it started with until a restart.
+CONFIG_FILE = os.environ.get("CONFIG_FILE", "/etc/default/reverie-powerbase")
+
+# This is where the service keeps anything it needs to remember across
+# restarts (scheduled jobs and the last known state of the bed, for example).
+STATE_DIR = os.environ.get("STATE_DIR", "/var/lib/reverie-powerbase")
+print("Saving state in " + STATE_DIR)
+
+# If nothing has been sent to the bed for this many seconds, read the light
+# setting (it's one byte) just to make sure the connection is still alive, so
+# a dead connection is found between requests rather than during one.  Set to
+# 0 to turn this off.
+KEEPALIVE_INTERVAL = int(os.environ.get("KEEPALIVE_INTERVAL", 20))
+print("Keepalive interval is " + str(KEEPALIVE_INTERVAL) + " seconds")
+
+# The bed doesn't tell us when something changes (the remote, for example), so
+# the service reads it in the background to keep up.  For POLL_FAST_PERIOD
+# seconds after a command, or after the poller sees something change, it reads
+# every POLL_FAST_INTERVAL seconds; after that it backs off, doubling the
+# interval each time, up to POLL_INTERVAL.  It never uses more than
+# POLL_BUDGET (0-1) of the connection's time.  Set POLL_INTERVAL to 0 to turn
+# this off.
+POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", 60))
+POLL_FAST_INTERVAL = float(os.environ.get("POLL_FAST_INTERVAL", 1))
+POLL_FAST_PERIOD = float(os.environ.get("POLL_FAST_PERIOD", 30))
+POLL_BUDGET = float(os.environ.get("POLL_BUDGET", 0.1))
+if POLL_INTERVAL > 0:
+	print("Polling the bed every " + str(POLL_FAST_INTERVAL) + " to " + str(POLL_INTERVAL) + " seconds, using at most "
+		+ str(round(POLL_BUDGET * 100)) + "% of the connection")
+
+# A profile of the bed made by dump.py (i.e. dump.py --output profile.json).
+# With one, the service doesn't need to look up the characteristics every time
+# it connects, and writes to each one the fastest way it supports.  If you
+# update the bed's firmware, make a new one.  Leave it empty to not use one.
+DEVICE_PROFILE = os.environ.get("DEVICE_PROFILE", "")
+if DEVICE_PROFILE:
+	print("Using device profile " + DEVICE_PROFILE)
+
+# To record every read and write to the bed (for replay.py, or to see what
+# was sent when the bed did something odd), set this to the file to record
+# them to.  Leave it empty to turn recording off.
+TRACE_FILE = os.environ.get("TRACE_FILE", "")
+if TRACE_FILE:
+	print("Recording bluetooth trace to " + TRACE_FILE)
+
+# The bed only allows one connection, so while this service is connected, the
+# vendor app (and dump.py) can't be used.  Set this to a number of seconds to
+# disconnect from the bed after that long without a command, and connect again
+# (which takes well under a second) when the next one comes in.  While
+# disconnected, the get URLs answer with the last known values.  0 stays
+# connected all the time.
+IDLE_DISCONNECT = int(os.environ.get("IDLE_DISCONNECT", 0))
+if IDLE_DISCONNECT > 0:
+	print("Disconnecting from the bed after " + str(IDLE_DISCONNECT) + " idle seconds")
+
+# Smooth moves (/move) send the in-between positions to the bed this often
+# (in seconds).  If the bed takes longer than this to answer, they are sent
+# less often, to match.
+MOVE_STEP_INTERVAL = float(os.environ.get("MOVE_STEP_INTERVAL", 0.25))
+print("Move step interval is " + str(MOVE_STEP_INTERVAL) + " seconds")
+
+# Answer HTTP from this many worker processes instead of from this one, so a
+# busy homebridge doesn't hold up the process that talks to the bed.  This
+# process keeps the only connection to the bed; the workers answer the get URLs
+# from the shared state below, and pass everything else on over the Unix
+# socket (which is turned on at its default path if UNIX_SOCKET isn't set).
+# 0 answers HTTP from this process, the same as always.
+HTTP_WORKERS = int(os.environ.get("HTTP_WORKERS", 0))
+if HTTP_WORKERS > 0 and SLIM_MODE:
+	print("HTTP workers aren't available in slim mode; answering HTTP from this process")
+	HTTP_WORKERS = 0
+if HTTP_WORKERS > 0:
+	print("Answering HTTP from " + str(HTTP_WORKERS) + " worker processes")
+	if not UNIX_SOCKET:
+		UNIX_SOCKET = "/run/reverie-powerbase/reverie.sock"
+		print("Listening on Unix socket " + UNIX_SOCKET)
+
+# The state of the bed is kept in this shared memory file for other processes
+# to read (sharedstate.py prints it).  The workers need it, so it defaults to
+# /dev/shm/reverie-powerbase when they are on; otherwise leave it empty to
+# turn it off.
+SHARED_STATE = os.environ.get("SHARED_STATE", "")
+if HTTP_WORKERS > 0 and not SHARED_STATE:
+	SHARED_STATE = sharedstate.DEFAULT_PATH
+if SHARED_STATE:
+	print("Sharing state in " + SHARED_STATE)
+
+# To have the bed show up in the Home app directly, without homebridge, set
+# this to the port for the HomeKit accessory server (i.e. 51826).  It needs
+# HAP-python (pip3 install HAP-python).  The setup code to pair with is
+# printed when it starts, or set your own (i.e. 031-45-154) in HOMEKIT_PIN.
+# 0 turns it off.
+HOMEKIT_PORT = int(os.environ.get("HOMEKIT_PORT", 0))
+HOMEKIT_PIN = os.environ.get("HOMEKIT_PIN", "")
+HOMEKIT_NAME = os.environ.get("HOMEKIT_NAME", "Reverie Bed")
+if HOMEKIT_PORT > 0:
+	print("HomeKit accessory server on port " + str(HOMEKIT_PORT))
+
+# To publish the state of the bed to an MQTT broker, and take commands from it
+# (see mqttbridge.py for the topics), set this to the broker's address
+# (host or host:port).  It needs paho-mqtt (pip3 install paho-mqtt).  Leave it
+# empty to turn it off.
+MQTT_BROKER = os.environ.get("MQTT_BROKER", "")
+MQTT_TOPIC = os.environ.get("MQTT_TOPIC", "reverie")
+MQTT_QOS = int(os.environ.get("MQTT_QOS", 1))
+MQTT_USERNAME = os.environ.get("MQTT_USERNAME", "")
+MQTT_PASSWORD = os.environ.get("MQTT_PASSWORD", "")
+if MQTT_BROKER:
+	print("Using MQTT broker " + MQTT_BROKER + " (topic " + MQTT_TOPIC + ", QoS " + str(MQTT_QOS) + ")")
+
+# How to talk to the bed: bluepy (the default), or bleak, which is asyncio
+# based and doesn't need bluepy's helper process (pip3 install bleak), or
+# att, which talks to the bed directly over a bluetooth socket, with nothing
+# in between (benchmark-att.py compares it with bluepy).  See transport.py.
+BLE_TRANSPORT = os.environ.get("BLE_TRANSPORT", "bluepy")
+print("Using the " + BLE_TRANSPORT + " bluetooth transport")
+
+# The /gatt URLs read and write any characteristic on the bed, which can do
+# things the rest of the URLs can't, so they need this token, sent as
+# "Authorization: Bearer <token>" (or ?token=<token>).  Requests on the Unix
+# socket don't need it.  Leave it empty to turn them off.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+if ADMIN_TOKEN:
+	print("Admin URLs are turned on")
+
+# The last this many things the service did (everything it printed, and
+# every read and write to the bed, and every request) are kept in memory, and
+# written to flightlog.jsonl in STATE_DIR when the connection to the bed is
+# lost or the service stops.  /debug/log shows them (with ADMIN_TOKEN).  0
+# turns it off.
+FLIGHT_LOG_SIZE = int(os.environ.get("FLIGHT_LOG_SIZE", 2000))
+flightLog.resize(FLIGHT_LOG_SIZE)
+if FLIGHT_LOG_SIZE > 0:
+	print("Keeping the last " + str(FLIGHT_LOG_SIZE) + " events in the flight log")
+
+# When several clients use the bed at once (homebridge, a dashboard, scripts),
+# they take turns at the connection, so a busy one can't hold up the rest.
+# A client is named by the token it sends ("Authorization: Bearer <token>",
+# one of CLIENT_TOKENS, i.e. "homebridge=s3cret,dashboard=0ther"), or else by
+# its address.  Without CLIENT_TOKENS, it can name itself with the
+# X-Reverie-Client header instead; with them, the header is ignored, since
+# anyone could send it (taking a weighted client's share, or a new name for
+# every request to get round CLIENT_QUEUE_LIMIT).  Requests on
+# the Unix socket are "unix", and the service's own threads (the scheduler,
+# the poller...) are each their own client.  CLIENT_WEIGHTS gives some of
+# them a bigger share while they're all waiting, i.e. "homebridge=3" gets
+# three turns for every one the others get (everything else has a weight of
+# 1).  A client with CLIENT_QUEUE_LIMIT things already waiting gets a 429
+# instead (0 means no limit).
+def nameValues(setting, convert=str):
+	values = {}
+	for item in setting.split(","):
+		name, _, value = item.partition("=")
+		if name.strip():
+			values[name.strip()] = convert(value.strip())
+	return values
+
+CLIENT_WEIGHTS = nameValues(os.environ.get("CLIENT_WEIGHTS", ""), float)
+CLIENT_TOKENS = dict((token, name) for name, token in nameValues(os.environ.get("CLIENT_TOKENS", "")).items())
+CLIENT_QUEUE_LIMIT = int(os.environ.get("CLIENT_QUEUE_LIMIT", 8))
+if CLIENT_WEIGHTS:
+	print("Client weights: " + ", ".join(name + "=" + str(weight) for name, weight in CLIENT_WEIGHTS.items()))
+
+# Set (by workers.py) in the worker processes.
+WORKER = "REVERIE_WORKER_FD" in os.environ
+
 ###############################################################################
 # End User Config
 ###############################################################################
@@ -146,23 +366,22 @@ print("Bed's flat position tilt is " + str(TILT_FLAT))
 # Function/Service Declarations
 ###############################################################################
 
+# The signal strength of the bed the last time it was found by a scan.  bluepy
+# can't read the signal strength of a connection, so this is the best there is.
+
+scanRssi = None
+scanTime = None
+
 def findBed():
-	class ScanDelegate(DefaultDelegate):
-		def __init__(self):
-			DefaultDelegate.__init__(self)
+	global scanRssi, scanTime
 
 	print("Scanning for Reverie Powerbases...")
 
-	scanner = Scanner().withDelegate(ScanDelegate())
-	devices = scanner.scan(10.0)
-	
-	for device in devices:
-		#print ("Device %s (%s), RSSI=%d dB" % (device.addr, device.addrType, device.rssi))
-		for (adtype, desc, value) in device.getScanData():
-			#print ("	 %s = %s" % (desc, value))
-			if desc == "Complete Local Name" and value == "RevCB_A1":
-				print("Detected Reverie Powerbase: %s" % (device.addr))
-				return device.addr
+	for addr, rssi in bed.scan(10.0):
+		print("Detected Reverie Powerbase: %s" % (addr))
+		scanRssi = rssi
+		scanTime = time.time()
+		return addr
 	return "None"
 
 # Take the individual position values, and construct the HEX string needed to
@@ -173,15 +392,426 @@ def MakePosition(position):
 	# to be sent to the bed.
 	return "00"+position[0]+position[1]+position[2]+"00000000000000"
 
+# This is a list of the characteristics by UUID to controlling the bed
+
+PositionBed="db8010d0-f324-29c3-38d1-85c0c2e86885"
+
+PositionHead="db801041-f324-29c3-38d1-85c0c2e86885"
+PositionFeet="db801042-f324-29c3-38d1-85c0c2e86885"
+
+# You'll notice that Tilt and Lumbar use the same UUID.  This is on purpose.  The 
+# beds have either tilt or lumbar.  Lumbar (I assume) is a straight 0-100 setting
+# where you have no lumbar lift to the maximum lift.  Tilt, however is "flat" at 
+# 36% (raw decimal).  I have logic to convert it to a straight 0-100, where 50% is flat.
+#
+# Obviously, use only one function or the other.
+PositionTilt="db801040-f324-29c3-38d1-85c0c2e86885"
+PositionLumbar="db801040-f324-29c3-38d1-85c0c2e86885"
+
+MassageHead="db801061-f324-29c3-38d1-85c0c2e86885"
+MassageFeet="db801060-f324-29c3-38d1-85c0c2e86885"
+MassageWave="db801080-f324-29c3-38d1-85c0c2e86885"
+
+Light="db8010a0-f324-29c3-38d1-85c0c2e86885"
+
+# The characteristics we use.  Once connectBed() has connected to the bed (and
+# found all of these), bedReady is set.
+
+CHARACTERISTICS = (PositionBed, PositionHead, PositionFeet, PositionTilt, MassageHead, MassageFeet, MassageWave, Light)
+
+bed = transport.TRANSPORTS[BLE_TRANSPORT]()
+bedReady = threading.Event()
+
+class BedNotReady(Exception):
+	pass
+
+###############################################################################
+# Device profile
+#
+# dump.py lists the handle of every characteristic and what each one
+# supports.  With that, a characteristic can be read and written by handle
+# straight away, without the service and characteristic discovery that takes
+# up most of the time connecting, and each one can be written the quickest
+# way it supports (see transport.py).
+###############################################################################
+
+def loadProfile():
+	if not DEVICE_PROFILE:
+		return {}
+
+	try:
+		with open(DEVICE_PROFILE) as f:
+			profile = json.load(f)
+	except (OSError, ValueError) as error:
+		print("Unable to read device profile " + DEVICE_PROFILE + ": " + str(error))
+		return {}
+
+	found = {}
+	for service in profile.get("services", []):
+		for characteristic in service.get("characteristics", []):
+			found[characteristic["uuid"].lower()] = characteristic
+	print("Loaded profile of " + str(len(found)) + " characteristics for " + profile.get("mac", "unknown bed"))
+	return {"mac": profile.get("mac", "").lower(), "characteristics": found}
+
+###############################################################################
+# Last known state of the bed
+#
+# Every value read from or written to the bed is kept here (raw, by UUID), and
+# saved to disk every so often.  While the service is starting up and hasn't
+# connected to the bed yet, reads are answered from this, marked as stale, so
+# homebridge gets an answer straight away instead of connection refused.
+###############################################################################
+
+STATE_FILE = os.path.join(STATE_DIR, "state.json")
+SAVE_INTERVAL = 10
+
+bedState = {}
+bedStateTime = 0
+stateChanged = threading.Event()
+
+# With SHARED_STATE set, the state (and whether the bed is connected) is
+# published there every time it's updated.
+
+sharedState = None
+
+# Functions to call (with no arguments) whenever a value changes.
+
+stateListeners = []
+
+def publishState():
+	if sharedState is not None:
+		sharedState.publish(bedState, bedReady.is_set(), linkUp, bedStateTime)
+
+def updateState(characteristic, value):
+	global bedStateTime
+
+	bedStateTime = time.time()
+	if bedState.get(characteristic) != value:
+		bedState[characteristic] = value
+		stateChanged.set()
+		for listener in stateListeners:
+			listener()
+	publishState()
+
+def loadState():
+	global bedStateTime
+
+	try:
+		with open(STATE_FILE) as f:
+			saved = json.load(f)
+	except FileNotFoundError:
+		return {}
+	except (OSError, ValueError) as error:
+		print("Unable to read saved state " + STATE_FILE + ": " + str(error))
+		return {}
+
+	for characteristic, value in saved.get("values", {}).items():
+		bedState[characteristic] = bytes.fromhex(value)
+	bedStateTime = saved.get("time", 0)
+	print("Loaded saved state from " + time.ctime(bedStateTime))
+	return saved
+
+def saveState():
+	saved = {
+		"time": bedStateTime,
+		"mac": DEVICE_MAC,
+		"values": {characteristic: value.hex() for characteristic, value in list(bedState.items())},
+	}
+	try:
+		os.makedirs(STATE_DIR, exist_ok=True)
+		with open(STATE_FILE + ".tmp", "w") as f:
+			json.dump(saved, f)
+		os.replace(STATE_FILE + ".tmp", STATE_FILE)
+	except OSError as error:
+		print("Unable to save state " + STATE_FILE + ": " + str(error))
+
+# Save the state when it changes, but no more than once every SAVE_INTERVAL
+# seconds, to go easy on the SD card.
+
+def stateSaver():
+	while True:
+		stateChanged.wait()
+		time.sleep(SAVE_INTERVAL)
+		stateChanged.clear()
+		saveState()
+
+###############################################################################
+# Connection lifecycle
+#
+# With IDLE_DISCONNECT set, the connection is dropped when it hasn't been used
+# for a while (see idleMonitor() below), and made again by the next read or
+# write that needs it.  The same Peripheral is reconnected, and the
+# characteristics found the first time (or from the device profile) still
+# work, so there's no discovery to wait for.  Anything else that wants the bed
+# while it reconnects waits its turn on bleLock.
+###############################################################################
+
+linkUp = False
+lastUseTime = time.monotonic()
+reconnects = 0
+reconnectTime = None
+
+def reconnect():
+	global linkUp, reconnects, reconnectTime
+
+	startOp()
+	try:
+		bed.reconnect(DEVICE_MAC)
+	except bed.errors as error:
+		traceOp(bletrace.OP_CONNECT, None, DEVICE_MAC.encode(), False)
+		finishOp()
+		# Most likely the vendor app has the connection.
+		print("Unable to reconnect to "+DEVICE_MAC+": "+str(error))
+		raise BedNotReady()
+	traceOp(bletrace.OP_CONNECT, None, DEVICE_MAC.encode(), True)
+	finishOp()
+
+	linkUp = True
+	publishState()
+	reconnects += 1
+	reconnectTime = lastOpLatency
+	print("Reconnected to "+DEVICE_MAC+" in "+str(round(reconnectTime * 1000))+" ms")
+
+def disconnect():
+	global linkUp
+
+	startOp()
+	try:
+		bed.disconnect()
+	finally:
+		traceOp(bletrace.OP_DISCONNECT, None, DEVICE_MAC.encode(), True)
+		finishOp()
+		linkUp = False
+		publishState()
+	print("Disconnected from "+DEVICE_MAC+" after "+str(IDLE_DISCONNECT)+" idle seconds")
+
+# All reads and writes to the bed go through these two functions.  Flask
+# handles each request in its own thread, and the scheduler runs jobs from
+# another, but bluepy can only do one thing at a time on a connection, so
+# they take turns.
+#
+# Until the bed is connected, reads come from the saved state and writes
+# raise BedNotReady, which is sent back as a 503.  While the connection is
+# dropped for being idle, reads come from the saved state, and writes
+# reconnect.  (In an HTTP worker the bed is never "connected"; reads come
+# from the shared state, and are only stale if they are stale there.)  Reads made in the background (the keepalive, for example) don't
+# count as using the connection, so they don't keep it from going idle.
+#
+# They also keep track of when the last one finished and how long it took,
+# and when the one in progress (if any) started, for /health and the
+# systemd watchdog.
+#
+# bleLock is a FairLock (see fairqueue.py), which works like an RLock but
+# takes the waiting operations in turns between clients (see CLIENT_WEIGHTS).
+
+bleLock = FairLock(CLIENT_WEIGHTS, CLIENT_QUEUE_LIMIT)
+
+# Set after every write, to tell the poller (see poller() below) something
+# has just been changed.
+pollWake = threading.Event()
+
+lastOpTime = None
+lastOpLatency = None
+opStarted = None
+
+def startOp():
+	global opStarted
+	opStarted = time.monotonic()
+
+def finishOp():
+	global opStarted, lastOpTime, lastOpLatency
+	lastOpTime = time.monotonic()
+	if opStarted is not None:
+		lastOpLatency = lastOpTime - opStarted
+	opStarted = None
+
+# Every operation goes in the flight log, and if TRACE_FILE is set, it's
+# recorded there too, whether it worked or not.
+# This is called with bleLock held, so the trace is in the order the
+# operations actually happened.
+
+tracer = None
+
+def traceOp(op, characteristic, data, ok):
+	latency = time.monotonic() - opStarted
+	flightLog.record(bletrace.OP_NAMES[op], uuid=characteristic, data=data, latency=latency, ok=ok)
+	if tracer is not None:
+		tracer.record(op, characteristic, data, latency, ok)
+
+# Reads of the same characteristic at the same time (homebridge asking for
+# the head from several threads at once, say) share one read from the bed:
+# the first one reads it, and the rest wait for its answer (or its error)
+# rather than queueing up their own.  A thread that already has bleLock
+# always reads for itself, since the read it would wait for can't happen
+# until it lets go.  How many reads were shared, and how many reads from the
+# bed served more than one, are shown in /health.
+
+class ReadInFlight:
+	def __init__(self):
+		self.done = threading.Event()
+		self.value = None
+		self.error = None
+		self.stale = False
+		self.shared = False
+
+readsInFlight = {}
+readsInFlightLock = threading.Lock()
+sharedReads = 0
+sharedFlights = 0
+
+def bleRead(characteristic, background=False):
+	global lastUseTime, sharedReads, sharedFlights
+
+	if not bedReady.is_set():
+		if characteristic not in bedState:
+			raise BedNotReady()
+		if has_request_context() and not g.get("fresh"):
+			g.stale = True
+		return bedState[characteristic]
+
+	if bleLock.owned():
+		value, stale = readFromBed(characteristic, background)
+	else:
+		with readsInFlightLock:
+			flight = readsInFlight.get(characteristic)
+			leader = flight is None
+			if leader:
+				flight = readsInFlight[characteristic] = ReadInFlight()
+			else:
+				sharedReads += 1
+				if not flight.shared:
+					flight.shared = True
+					sharedFlights += 1
+
+		if leader:
+			try:
+				flight.value, flight.stale = readFromBed(characteristic, background)
+			except Exception as error:
+				flight.error = error
+				raise
+			finally:
+				with readsInFlightLock:
+					del readsInFlight[characteristic]
+				flight.done.set()
+		else:
+			flight.done.wait()
+			if flight.error is not None:
+				raise flight.error
+			if not background:
+				lastUseTime = time.monotonic()
+		value, stale = flight.value, flight.stale
+
+	if stale and has_request_context():
+		g.stale = True
+	return value
+
+# Returns the value, and whether it's the last known one rather than read
+# from the bed (because the connection is idle).
+
+def readFromBed(characteristic, background=False):
+	global lastUseTime
+
+	with bleLock:
+		if not linkUp:
+			if characteristic in bedState:
+				return bedState[characteristic], True
+			reconnect()
+		if not background:
+			lastUseTime = time.monotonic()
+		startOp()
+		try:
+			value = bed.read(characteristic)
+		except Exception as error:
+			traceOp(bletrace.OP_READ, characteristic, b"", False)
+			if isinstance(error, transport.GattError):
+				finishOp()
+			raise
+		traceOp(bletrace.OP_READ, characteristic, value, True)
+		finishOp()
+	updateState(characteristic, value)
+	return value, False
+
+def bleWrite(characteristic, data):
+	global lastUseTime
+
+	if not bedReady.is_set():
+		raise BedNotReady()
+
+	with bleLock.writing(characteristic):
+		if not linkUp:
+			reconnect()
+		lastUseTime = time.monotonic()
+		startOp()
+		try:
+			bed.write(characteristic, data)
+		except Exception as error:
+			traceOp(bletrace.OP_WRITE, characteristic, data, False)
+			if isinstance(error, transport.GattError):
+				finishOp()
+			raise
+		traceOp(bletrace.OP_WRITE, characteristic, data, True)
+		finishOp()
+	pollWake.set()
+	writtenState(characteristic, data)
+
+def writtenState(characteristic, data):
+	# A position write sets the head, feet and tilt all at once.
+	if characteristic == PositionBed:
+		updateState(PositionHead, data[1:2])
+		updateState(PositionFeet, data[2:3])
+		updateState(PositionTilt, data[3:4])
+	else:
+		updateState(characteristic, data)
+
+# Read everything /state shows at once: in one round trip with a transport
+# that can (the att transport, see readMany() in transport.py), or one after
+# another with one that can't.  How many round trips the last one took is
+# shown in /health.  Returns False, without reading anything, if the bed isn't
+# connected (or the connection is idle).
+
+STATE_CHARACTERISTICS = (PositionHead, PositionFeet, PositionTilt, MassageHead, MassageFeet, MassageWave, Light)
+
+refreshes = 0
+refreshRoundTrips = None
+
+def refreshState(background=False):
+	global lastUseTime, refreshes, refreshRoundTrips
+
+	if not bedReady.is_set():
+		return False
+
+	with bleLock:
+		if not linkUp:
+			return False
+		if not background:
+			lastUseTime = time.monotonic()
+		startOp()
+		try:
+			values, roundTrips = bed.readMany(STATE_CHARACTERISTICS)
+		except Exception as error:
+			traceOp(bletrace.OP_READ, None, b"", False)
+			if isinstance(error, transport.GattError):
+				finishOp()
+			raise
+		for characteristic, value in zip(STATE_CHARACTERISTICS, values):
+			traceOp(bletrace.OP_READ, characteristic, value, True)
+		finishOp()
+		refreshes += 1
+		refreshRoundTrips = roundTrips
+
+	for characteristic, value in zip(STATE_CHARACTERISTICS, values):
+		updateState(characteristic, value)
+	return True
+
 def getBedValue(getBedValue):
-	return str(int.from_bytes(getBedValue.read(), byteorder=sys.byteorder))
+	return str(int.from_bytes(bleRead(getBedValue), byteorder=sys.byteorder))
 
 def setBedPosition(setBedPosition,position):
-	setBedPosition.write(bytes.fromhex(MakePosition(position)))
+	bleWrite(setBedPosition, bytes.fromhex(MakePosition(position)))
 	return
 
 def setBedValue(setBedValue,percentage):
-	setBedValue.write(bytes.fromhex(percent2hex(percentage)))
+	bleWrite(setBedValue, bytes.fromhex(percent2hex(percentage)))
 	return
 
 # Convert a percentage (0-100 decimal) to Hex (0x00-0x64 hex)
@@ -218,7 +848,7 @@ def moveWait(service,desired):
 	return int(desired)
 	
 	def readService(service):
-		return int.from_bytes(service.read(), byteorder=sys.byteorder)
+		return int.from_bytes(bleRead(service), byteorder=sys.byteorder)
 
 	check=readService(service)
 	while not math.isclose(check,int(desired),abs_tol=2):
@@ -238,6 +868,38 @@ def moveWait(service,desired):
 
 app = Flask(__name__)
 
+# Keep connections open between requests, so a client making a lot of them
+# (homebridge, or reverieclient.py) doesn't connect every time.  The headers
+# and body of a reply are written separately, so without TCP_NODELAY the body
+# would wait for the client to acknowledge the headers, which it can put off
+# for 40 ms or more.  (slimweb.py does the same on its own.)
+if not SLIM_MODE:
+	from werkzeug.serving import WSGIRequestHandler
+	WSGIRequestHandler.protocol_version = "HTTP/1.1"
+	WSGIRequestHandler.disable_nagle_algorithm = True
+
+# Which client a request is for, so they take turns on bleLock (see
+# CLIENT_WEIGHTS).  Requests on the Unix socket, and those passed on by an
+# HTTP worker, already have a name by now.
+
+def clientName():
+	if g.get("client"):
+		return g.client
+	if CLIENT_TOKENS:
+		supplied = request.headers.get("Authorization", "")
+		if supplied.startswith("Bearer ") and supplied[len("Bearer "):] in CLIENT_TOKENS:
+			return CLIENT_TOKENS[supplied[len("Bearer "):]]
+	else:
+		name = request.headers.get("X-Reverie-Client", "").strip()
+		if name:
+			return name
+	return request.remote_addr or "unknown"
+
+@app.before_request
+def identifyClient():
+	g.client = clientName()
+	bleLock.setClient(g.client)
+
 
 
 
@@ -262,7 +924,8 @@ def setFlat():
 	global position
 
 	# head, feet, tilt
-	position=FLAT
+	mover.cancel()
+	position=list(FLAT)
 
 	setBedPosition(PositionBed, position)
 
@@ -283,7 +946,8 @@ def setZeroG():
 	global position
 
 	# head, feet, tilt
-	position=ZEROG
+	mover.cancel()
+	position=list(ZEROG)
 
 	setBedPosition(PositionBed, position)
 
@@ -304,7 +968,8 @@ def setNoSnore():
 	global position
 
 	# head, feet, tilt
-	position=NOSNORE
+	mover.cancel()
+	position=list(NOSNORE)
 
 	setBedPosition(PositionBed, position)
 	
@@ -337,6 +1002,7 @@ def setHead(percentage):
 	if percentage == 1:
 		percentage = 0
 
+	mover.cancel(0)
 	position[0]=percent2hex(percentage)
 
 	setBedPosition(PositionBed, position)
@@ -362,6 +1028,7 @@ def setFeet(percentage):
 	if percentage == 1:
 		percentage = 0
 
+	mover.cancel(1)
 	position[1]=percent2hex(percentage)
 
 	setBedPosition(PositionBed, position)
@@ -387,6 +1054,7 @@ def setLumbar(percentage):
 	if percentage == 1:
 		percentage = 0
 
+	mover.cancel(2)
 	position[2]=percent2hex(percentage)
 
 	setBedPosition(PositionBed, position)
@@ -399,25 +1067,29 @@ def setLumbar(percentage):
 def getFeet():
 	return getBedValue(PositionFeet)
 
-@app.route("/setTilt/<percentage>")
-def setTilt(percentage):
-	global position
-
-	# A little "magic" here to frame 50% around the value 36, which is the (decimal)
-	# position of the tilt when the bed is flat.
-	# i.e. 0-50% ranges 0-36, and 51-100% is 37-100.
-
-	percentage=int(percentage)
+# A little "magic" here to frame 50% around the value 36, which is the (decimal)
+# position of the tilt when the bed is flat.
+# i.e. 0-50% ranges 0-36, and 51-100% is 37-100.
 
+def tiltPosition(percentage):
 	if percentage <= 50:
 		tilt = TILT_FLAT * percentage / 50
 	else:
 		tilt = TILT_FLAT + ( 100 - TILT_FLAT ) * ( percentage - 50 ) / 50
 
-	adjusted_percentage = round(int(tilt))
+	return round(int(tilt))
+
+@app.route("/setTilt/<percentage>")
+def setTilt(percentage):
+	global position
+
+	percentage=int(percentage)
+
+	adjusted_percentage = tiltPosition(percentage)
 
 	# Just change the feet postion.	 The other values were read at the start of the loop.
 
+	mover.cancel(2)
 	position[2]=percent2hex(adjusted_percentage)
 
 	setBedPosition(PositionBed, position)
@@ -428,16 +1100,70 @@ def setTilt(percentage):
 
 @app.route("/getTilt")
 def getTilt():
-	percentage = int(getBedValue(PositionTilt))
+	return str(tiltPercentage(int(getBedValue(PositionTilt))))
+
+# This reverses the "magic" done earlier to present the percentage so that
+# when the bed is flat, it will be 50%.
 
-	# This reverses the "magic" done earlier to present the percentage so that
-	# when the bed is flat, it will be 50%.
+def tiltPercentage(percentage):
 	if percentage <= TILT_FLAT:
 		tilt = 50 * percentage / TILT_FLAT
 	else:
 		tilt = 50 + 50 * ( percentage - TILT_FLAT ) / ( 100 - TILT_FLAT )
 
-	return str(round(tilt))
+	return round(tilt)
+
+###############################################################################
+# Smooth moves
+#
+# Rather than jumping straight to a new position, /move gets there over a
+# number of seconds, with the daemon sending the positions in between (see
+# motion.py).  Moving the head, feet or tilt any other way stops that part's
+# move; a preset position stops them all.
+###############################################################################
+
+# Which part of position each part of the bed is.
+
+MOVE_PARTS = {"head": 0, "feet": 1, "tilt": 2, "lumbar": 2}
+
+def writeMove(changed):
+	with bleLock.writing(PositionBed):
+		for part, value in changed.items():
+			position[part]=percent2hex(value)
+		setBedPosition(PositionBed, position)
+
+def startMove(part, target, duration, profile="easeInOut"):
+	if not bedReady.is_set():
+		raise BedNotReady()
+
+	target=int(target)
+	if part == "tilt":
+		target = tiltPosition(target)
+
+	index = MOVE_PARTS[part]
+	mover.move(index, int(position[index], 16), int(percent2hex(target), 16), duration, profile)
+
+mover = Mover(writeMove, MOVE_STEP_INTERVAL, lambda: lastOpLatency, lambda error: backgroundFailed(error))
+
+# Move part (head, feet, tilt or lumbar) to target (0-100%, the same as the
+# set URLs) over duration seconds (default 10), following profile (linear,
+# easeIn, easeOut or easeInOut, the default).
+
+@app.route("/move/<part>/<target>")
+def setMove(part, target):
+	if part not in MOVE_PARTS:
+		return 'Unknown Part: '+part, 404
+
+	startMove(part, target, float(request.args.get("duration", 10)), request.args.get("profile", "easeInOut"))
+
+	return part.capitalize()+' Moving to: '+str(int(target))
+
+# The moves in progress, by position index (0 head, 1 feet, 2 tilt/lumbar),
+# in raw values.
+
+@app.route("/move")
+def getMove():
+	return jsonify(mover.status())
 
 ###############################################################################
 # Functions to control the massager functions
@@ -511,12 +1237,212 @@ def getWaveMassage():
 
 @app.route("/stopMassage")
 def setStopMassage():
+	stopMassageProgram()
+
 	setBedValue(MassageHead, 0)
 	setBedValue(MassageFeet, 0)
 	setBedValue(MassageWave, 0)
 
 	return "All Massages Stopped"
 
+###############################################################################
+# Relative changes
+#
+# /adjust/<part>/<change> changes part by change from wherever it is now, i.e.
+# /adjust/head/+5 or /adjust/tilt/-10, in the same units as the set URLs and
+# clamped the same way.  For the massages, change can also be up or down, one
+# press of the remote's button (MASSAGE_STEP, or one wave setting).  It starts
+# from the last known state (so there's no read from the bed, unless nothing
+# is known yet) and is written in one go, holding bleLock throughout, so two
+# at once can't both start from the same value.
+###############################################################################
+
+# What each part is called in the reply, where it's read from, and which part
+# of position it is (None for the massages).
+
+ADJUSTABLE = {
+	"head": ("Head Position", PositionHead, 0),
+	"feet": ("Feet Position", PositionFeet, 1),
+	"tilt": ("Tilt", PositionTilt, 2),
+	"lumbar": ("Lumbar Position", PositionLumbar, 2),
+	"headMassage": ("Head Massage", MassageHead, None),
+	"feetMassage": ("Feet Massage", MassageFeet, None),
+	"waveMassage": ("Wave Massage", MassageWave, None),
+}
+
+# How much one press of the remote's massage up or down button changes the
+# (raw) speed.
+
+MASSAGE_STEP = 4
+
+def currentValue(characteristic):
+	if characteristic not in bedState:
+		bleRead(characteristic)
+	return int.from_bytes(bedState[characteristic], byteorder=sys.byteorder)
+
+# Returns the new setting, in the same units as change.
+
+def adjust(part, change):
+	characteristic, index = ADJUSTABLE[part][1:]
+	stepped = change in ("up", "down")
+	if not stepped:
+		by = int(change)
+	elif index is None:
+		by = 1 if change == "up" else -1
+		if part != "waveMassage":
+			by *= MASSAGE_STEP
+	else:
+		raise ValueError("positions can only be changed by a number")
+
+	if not bedReady.is_set():
+		raise BedNotReady()
+
+	# Before taking bleLock: the mover holds its own lock while it waits for
+	# bleLock to write the next step.
+	if index is not None:
+		mover.cancel(index)
+
+	with bleLock.writing(PositionBed if index is not None else characteristic):
+		current = currentValue(characteristic)
+
+		if part == "waveMassage":
+			setting = min(max(current + by, 0), MAX_WAVES)
+			setBedValue(characteristic, setting)
+			return setting
+
+		if index is None:
+			if stepped:
+				speed = min(max(current + by, 0), MAX_MASSAGE_SPEED)
+			else:
+				percentage = min(max(round(current * 100 / MAX_MASSAGE_SPEED) + by, 0), 100)
+				speed = round(percentage / 100 * MAX_MASSAGE_SPEED)
+			setBedValue(characteristic, speed)
+			return round(speed * 100 / MAX_MASSAGE_SPEED)
+
+		if part == "tilt":
+			value = tiltPosition(min(max(tiltPercentage(current) + by, 0), 100))
+			# tiltPosition() rounds down, so a small step can come back to
+			# the same percentage: carry on a raw step at a time until it
+			# changes (or the tilt runs out).
+			step = 1 if by > 0 else -1
+			while by and tiltPercentage(value) == tiltPercentage(current) and 0 <= value + step <= 100:
+				value += step
+			percentage = tiltPercentage(value)
+		else:
+			percentage = min(max(current + by, 0), 100)
+			value = percentage
+
+		position[index]=percent2hex(value)
+		setBedPosition(PositionBed, position)
+		return percentage
+
+@app.route("/adjust/<part>/<change>")
+def setAdjust(part, change):
+	if part not in ADJUSTABLE:
+		return 'Unknown Part: '+part, 404
+
+	return ADJUSTABLE[part][0]+' Set to: '+str(adjust(part, change))
+
+###############################################################################
+# Massage programs
+#
+# A program is a list of steps that set the head, feet and wave massage, each
+# held for a number of seconds, which the daemon runs itself (see massage.py).
+# Levels are the same as the URLs: 0-100% for head and feet, and 0-MAX_WAVES
+# for the wave.  /stopMassage stops the program as well as the massage.
+###############################################################################
+
+MASSAGE_PROGRAMS = {
+	# Both on and off, once a second.
+	"pulse": {"repeat": 30, "steps": [
+		{"head": 60, "feet": 60, "duration": 1},
+		{"head": 0, "feet": 0, "duration": 1},
+	]},
+	# Back and forth between the head and the feet.
+	"alternate": {"repeat": 15, "steps": [
+		{"head": 50, "feet": 0, "duration": 2},
+		{"head": 0, "feet": 50, "duration": 2},
+	]},
+	# Slowly up to full speed and back down.
+	"ramp": {"repeat": 5, "steps": [
+		{"head": 20, "feet": 20, "duration": 3},
+		{"head": 40, "feet": 40, "duration": 3},
+		{"head": 60, "feet": 60, "duration": 3},
+		{"head": 80, "feet": 80, "duration": 3},
+		{"head": 100, "feet": 100, "duration": 3},
+		{"head": 80, "feet": 80, "duration": 3},
+		{"head": 60, "feet": 60, "duration": 3},
+		{"head": 40, "feet": 40, "duration": 3},
+	]},
+}
+
+MASSAGE_CHANNELS = {"head": MassageHead, "feet": MassageFeet, "wave": MassageWave}
+
+massageProgram = None
+massageLock = threading.Lock()
+
+# Turn a level from a program into the raw value for the bed, the same way
+# /setHeadMassage, /setFeetMassage and /setWaveMassage do.
+
+def massageSetting(channel, value):
+	if channel == "wave":
+		return min(max(value, 0), MAX_WAVES)
+	return round(min(max(value, 0), 100) / 100 * MAX_MASSAGE_SPEED)
+
+def writeMassage(channel, value):
+	setBedValue(MASSAGE_CHANNELS[channel], value)
+
+def stopMassageProgram():
+	with massageLock:
+		if massageProgram is not None:
+			massageProgram.stop()
+
+def startMassageProgram(program, name=None):
+	global massageProgram
+
+	if not bedReady.is_set():
+		raise BedNotReady()
+
+	try:
+		steps, repeat = parseProgram(program, massageSetting)
+	except (ValueError, TypeError) as error:
+		return 'Invalid Massage Program: '+str(error), 400
+
+	with massageLock:
+		if massageProgram is not None:
+			massageProgram.stop()
+
+		current = {}
+		for channel, characteristic in MASSAGE_CHANNELS.items():
+			if characteristic in bedState:
+				current[channel] = int.from_bytes(bedState[characteristic], byteorder=sys.byteorder)
+
+		massageProgram = MassageProgram(steps, repeat, writeMassage, current, name, backgroundFailed)
+		massageProgram.start()
+
+	return 'Massage Program Started'
+
+# GET returns the status of the program that is running (or last ran), and
+# POST starts the program in the body (JSON).
+
+@app.route("/massageProgram", methods=["GET", "POST"])
+def massageProgramRoute():
+	if request.method == "POST":
+		program = request.get_json(force=True, silent=True)
+		if program is None:
+			return 'Invalid Massage Program: not JSON', 400
+		return startMassageProgram(program)
+
+	if massageProgram is None:
+		return jsonify({"running": False})
+	return jsonify(massageProgram.status())
+
+@app.route("/massageProgram/<name>")
+def runMassageProgram(name):
+	if name not in MASSAGE_PROGRAMS:
+		return 'Unknown Massage Program: '+name, 404
+	return startMassageProgram(MASSAGE_PROGRAMS[name], name)
+
 ###############################################################################
 # Functions to control the under-bed light
 ###############################################################################
@@ -535,110 +1461,1056 @@ def setLightOff():
 @app.route("/light/status")
 def getLightStatus():
 	# 0-63 are off, 64 is on
-	if ( int.from_bytes(Light.read(), byteorder=sys.byteorder) == 64):
+	if ( int.from_bytes(bleRead(Light), byteorder=sys.byteorder) == 64):
 		return '1'
 	else:
 		return '0'
 
 ###############################################################################
-# Main Program Starts
+# Everything at once
 ###############################################################################
 
+# The whole state of the bed as JSON, in the same units as the URLs above.
+# "stale" is true if the bed isn't connected, and these are the values from
+# the last time it was.
 
-if DEVICE_MAC == "Auto":
-	DEVICE_MAC = findBed()
+@app.route("/state")
+def getState():
+	# With the bed connected, everything is read in one go.
+	if refreshState():
+		state = cachedState()
+	else:
+		state = {
+			"head": int(getHead()),
+			"feet": int(getFeet()),
+			"tilt": int(getTilt()) if USE_TILT == True else None,
+			"lumbar": int(getLumbar()) if USE_TILT != True else None,
+			"headMassage": int(getHeadMassage()),
+			"feetMassage": int(getFeetMassage()),
+			"waveMassage": int(getWaveMassage()),
+			"light": int(getLightStatus()),
+		}
+	state["stale"] = g.get("stale", False)
+	state["updated"] = bedStateTime
+	return jsonify(state)
+
+# Set any number of things at once, in the same units as the URLs: head, feet,
+# tilt (or lumbar), headMassage, feetMassage, waveMassage and light (0 or 1),
+# as JSON (POST) or query parameters (GET).  The positions all go to the bed
+# in one write.  Returns the state afterwards, the same as /state.
+
+SCENE_KEYS = ("head", "feet", "tilt", "lumbar", "headMassage", "feetMassage", "waveMassage", "light")
+
+@app.route("/scene", methods=["GET", "POST"])
+def setScene():
+	global position
 
-if DEVICE_MAC == "None":
-	print("No Reverie Powerbase found.")
-	sys.exit()
+	if request.method == "POST":
+		values = request.get_json(force=True, silent=True)
+		if not isinstance(values, dict):
+			return 'Invalid Scene: not a JSON object', 400
+	else:
+		values = request.args.to_dict()
+
+	unknown = [key for key in values if key not in SCENE_KEYS]
+	if unknown:
+		return 'Invalid Scene: unknown '+', '.join(unknown), 400
+
+	# Check every value before changing anything.
+	try:
+		values = {key: int(value) for key, value in values.items()}
+	except (TypeError, ValueError):
+		return 'Invalid Scene: values must be numbers', 400
+
+	if not bedReady.is_set():
+		raise BedNotReady()
+
+	parts = {}
+	for part in ("head", "feet", "lumbar"):
+		if part in values:
+			# The same correction as the set URLs; see setHead.
+			parts[MOVE_PARTS[part]] = 0 if values[part] == 1 else values[part]
+	if "tilt" in values:
+		parts[2] = tiltPosition(values["tilt"])
+
+	# Before taking bleLock: the mover holds its own lock while it waits for
+	# bleLock to write the next step.
+	for index in parts:
+		mover.cancel(index)
+
+	with bleLock:
+		if parts:
+			for index, value in parts.items():
+				position[index]=percent2hex(value)
+			setBedPosition(PositionBed, position)
+
+		if "headMassage" in values:
+			setHeadMassage(values["headMassage"])
+		if "feetMassage" in values:
+			setFeetMassage(values["feetMassage"])
+		if "waveMassage" in values:
+			setWaveMassage(values["waveMassage"])
+		if "light" in values:
+			if values["light"]:
+				setLightOn()
+			else:
+				setLightOff()
+
+	return jsonify(cachedState())
+
+# The same as /state, from the last known state only, without going to the bed.  Values
+# that aren't known yet are None.
+
+def cachedState():
+	def value(characteristic):
+		if characteristic not in bedState:
+			return None
+		return int.from_bytes(bedState[characteristic], byteorder=sys.byteorder)
+
+	def scaled(characteristic, scale):
+		if value(characteristic) is None:
+			return None
+		return round(value(characteristic) * 100 / scale)
+
+	return {
+		"head": value(PositionHead),
+		"feet": value(PositionFeet),
+		"tilt": tiltPercentage(value(PositionTilt)) if USE_TILT == True and value(PositionTilt) is not None else None,
+		"lumbar": value(PositionLumbar) if USE_TILT != True else None,
+		"headMassage": scaled(MassageHead, MAX_MASSAGE_SPEED),
+		"feetMassage": scaled(MassageFeet, MAX_MASSAGE_SPEED),
+		"waveMassage": value(MassageWave),
+		"light": (1 if value(Light) == 64 else 0) if value(Light) is not None else None,
+	}
+
+###############################################################################
+# Health of the connection to the bed
+###############################################################################
+
+startTime = time.time()
+
+def secondsSince(when):
+	if when is None:
+		return None
+	return round(time.monotonic() - when, 3)
+
+# Returns 200 if the bed is connected, and 503 if it isn't (yet).
+
+@app.route("/health")
+def getHealth():
+	health = {
+		"link": ("connected" if linkUp else "idle") if bedReady.is_set() else "connecting",
+		"mac": DEVICE_MAC,
+		"uptime": round(time.time() - startTime),
+		"lastOpAge": secondsSince(lastOpTime),
+		"lastOpLatency": round(lastOpLatency * 1000, 1) if lastOpLatency is not None else None,
+		"opInProgress": secondsSince(opStarted),
+		"keepaliveInterval": KEEPALIVE_INTERVAL,
+		"pollInterval": pollInterval,
+		"pollReads": pollReads,
+		"pollSkipped": pollSkipped,
+		"refreshes": refreshes,
+		"refreshRoundTrips": refreshRoundTrips,
+		"clients": bleLock.report(),
+		"lanes": bleLock.laneReport(),
+		"sharedReads": sharedReads,
+		"sharedFlights": sharedFlights,
+		"idleDisconnect": IDLE_DISCONNECT,
+		"lastUseAge": secondsSince(lastUseTime),
+		"reconnects": reconnects,
+		"reconnectTime": round(reconnectTime * 1000, 1) if reconnectTime is not None else None,
+		"rssi": scanRssi,
+		"rssiTime": scanTime,
+	}
+	return jsonify(health), 200 if bedReady.is_set() else 503
+
+###############################################################################
+# Raw GATT access
+#
+# For dump.py (dump.py --api) and other diagnostic tools: every service and
+# characteristic on the bed, and any of them read or written by UUID or value
+# handle, through this service's connection (taking turns with everything
+# else on bleLock), so the service doesn't have to be stopped, and the bed
+# found and connected to again afterwards, to use them.  They need
+# ADMIN_TOKEN.
+#
+#     GET /gatt                  every service and characteristic
+#     GET /gatt/<uuid|handle>    read one: {"uuid", "handle", "value" (hex), "latency" (ms)}
+#     POST /gatt/<uuid|handle>   write one: {"value": "<hex>", "withResponse": true}
+###############################################################################
+
+ADMIN_ENDPOINTS = ("getGatt", "gattCharacteristic", "getDebugLog", "adminReload")
+
+def adminRequest():
+	if request.endpoint not in ADMIN_ENDPOINTS or g.get("trusted"):
+		return None
+	if not ADMIN_TOKEN:
+		return 'Forbidden: ADMIN_TOKEN Not Set', 403
+	supplied = request.headers.get("Authorization", "")
+	if supplied.startswith("Bearer "):
+		supplied = supplied[len("Bearer "):]
+	else:
+		supplied = request.args.get("token", "")
+	if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+		return 'Unauthorized', 401, {'WWW-Authenticate': 'Bearer'}
+	return None
+
+app.before_request(adminRequest)
+
+# Looked up once; the bed's services don't change while it's connected.
+
+gattServices = None
+
+def gattTable():
+	global gattServices
+
+	if gattServices is None:
+		if not bedReady.is_set():
+			raise BedNotReady()
+		with bleLock:
+			if not linkUp:
+				reconnect()
+			startOp()
+			try:
+				services = bed.services()
+			finally:
+				finishOp()
+		gattServices = services
+	return gattServices
+
+def findCharacteristic(name):
+	try:
+		handle = int(name, 0)
+	except ValueError:
+		handle = None
+	for service in gattTable():
+		for characteristic in service["characteristics"]:
+			if characteristic["valueHandle"] == handle or characteristic["uuid"] == name.lower():
+				return characteristic
+	return None
+
+# The same as bleRead and bleWrite, by handle.  What's read from or written to
+# one of the characteristics the service uses goes into the last known state
+# as well.  Returns the value, and how long the bed took.  The bed refusing
+# (transport.GattError) is raised like any other error, but the connection is
+# still fine.
+
+def gattOp(op, characteristic, data=b"", withResponse=True):
+	global lastUseTime
+
+	if not bedReady.is_set():
+		raise BedNotReady()
+
+	uuid = characteristic["uuid"]
+	with bleLock:
+		if not linkUp:
+			reconnect()
+		lastUseTime = time.monotonic()
+		startOp()
+		try:
+			if op == bletrace.OP_READ:
+				data = bed.readHandle(characteristic["valueHandle"])
+			else:
+				bed.writeHandle(characteristic["valueHandle"], data, withResponse)
+		except Exception as error:
+			traceOp(op, uuid, data, False)
+			if isinstance(error, transport.GattError):
+				finishOp()
+			raise
+		traceOp(op, uuid, data, True)
+		finishOp()
+		latency = lastOpLatency
+
+	if op == bletrace.OP_WRITE:
+		pollWake.set()
+	if uuid in CHARACTERISTICS:
+		if op == bletrace.OP_READ:
+			updateState(uuid, data)
+		else:
+			writtenState(uuid, data)
+	return data, latency
+
+@app.route("/gatt")
+def getGatt():
+	return jsonify(gattTable())
+
+@app.route("/gatt/<name>", methods=["GET", "POST"])
+def gattCharacteristic(name):
+	characteristic = findCharacteristic(name)
+	if characteristic is None:
+		return 'Unknown Characteristic', 404
+	properties = characteristic["properties"]
+
+	# Asking for something the characteristic doesn't do is an error from the
+	# bed, which would otherwise look the same as losing the connection.
+	if request.method == "POST":
+		values = request.get_json(force=True, silent=True)
+		if not isinstance(values, dict) or not isinstance(values.get("value"), str):
+			return 'Invalid Value: expected {"value": "<hex>"}', 400
+		withResponse = values.get("withResponse", "writeWithoutResponse" not in properties)
+		if ("write" if withResponse else "writeWithoutResponse") not in properties:
+			return 'Characteristic Not Writable', 405
+	elif "read" not in properties:
+		return 'Characteristic Not Readable', 405
+
+	# A characteristic that says no (it needs encryption, say) is the bed's
+	# answer, not a lost connection.
+	try:
+		if request.method == "POST":
+			value, latency = gattOp(bletrace.OP_WRITE, characteristic, bytes.fromhex(values["value"]), bool(withResponse))
+		else:
+			value, latency = gattOp(bletrace.OP_READ, characteristic)
+	except transport.GattError as error:
+		code = "unknown" if error.code is None else "0x%02x" % error.code
+		return 'Refused by the Bed (ATT error '+code+'): '+str(error), 502
+
+	return jsonify({
+		"uuid": characteristic["uuid"],
+		"handle": characteristic["valueHandle"],
+		"value": value.hex(),
+		"latency": round(latency * 1000, 2),
+	})
+
+###############################################################################
+# Flight log
+###############################################################################
+
+FLIGHT_LOG = os.path.join(STATE_DIR, "flightlog.jsonl")
+
+# The flight log, oldest first (JSON).  ?limit=n for only the last n entries.
+# Needs ADMIN_TOKEN, like /gatt.
+
+@app.route("/debug/log")
+def getDebugLog():
+	limit = request.args.get("limit")
+	return jsonify(flightLog.snapshot(int(limit) if limit is not None else None))
+
+# Write the flight log when the service stops, too: normally, or when systemd
+# stops it (SIGTERM), after which it stops the same way it always has.
+
+def stopping(signum, frame):
+	flightLog.dump(FLIGHT_LOG)
+	signal.signal(signum, signal.SIG_DFL)
+	os.kill(os.getpid(), signum)
+
+###############################################################################
+# Scheduled jobs
+#
+# Jobs run the same functions the URLs below call, straight from the scheduler
+# thread, so a timed job doesn't need cron, an HTTP call, or (since the bed
+# only allows one) a second bluetooth connection.
+###############################################################################
+
+# The commands that can be run other than by their URL, the function that runs
+# each one, and whether it takes a value.  The names are the same as the URLs.
+
+COMMANDS = {
+	"flat": (setFlat, False),
+	"zeroG": (setZeroG, False),
+	"noSnore": (setNoSnore, False),
+	"setHead": (setHead, True),
+	"setFeet": (setFeet, True),
+	"setLumbar": (setLumbar, True),
+	"setTilt": (setTilt, True),
+	"setHeadMassage": (setHeadMassage, True),
+	"setFeetMassage": (setFeetMassage, True),
+	"setWaveMassage": (setWaveMassage, True),
+	"stopMassage": (setStopMassage, False),
+	"light/on": (setLightOn, False),
+	"light/off": (setLightOff, False),
+}
+
+# The commands that can be ramped, and how to read the current value in the
+# same units that the command takes.
+
+# Ramps of the head, feet and tilt are done as smooth moves instead.
+
+RAMPERS = {
+	"setHead": lambda value, seconds: startMove("head", value, seconds, "linear"),
+	"setFeet": lambda value, seconds: startMove("feet", value, seconds, "linear"),
+	"setLumbar": lambda value, seconds: startMove("lumbar", value, seconds, "linear"),
+	"setTilt": lambda value, seconds: startMove("tilt", value, seconds, "linear"),
+}
+
+RAMPABLE = {
+	"setHead": getHead,
+	"setFeet": getFeet,
+	"setLumbar": getLumbar,
+	"setTilt": getTilt,
+	"setHeadMassage": getHeadMassage,
+	"setFeetMassage": getFeetMassage,
+}
+
+# The commands that go ahead of everything else waiting for the bed (see
+# LANES in fairqueue.py), and what each one makes pointless to write first,
+# which is taken out of the queue: a stop, or a preset position, shouldn't
+# wait behind a pile of slider moves or massage changes it's about to undo.
+# The wait in each lane is shown in /health.
+
+PRIORITY_LANES = {
+	"stopMassage": ("stop", (MassageHead, MassageFeet, MassageWave)),
+	"light/off": ("stop", (Light,)),
+	"flat": ("preset", (PositionBed,)),
+	"zeroG": ("preset", (PositionBed,)),
+	"noSnore": ("preset", (PositionBed,)),
+}
+
+def prioritise(command):
+	lane, obsoletes = PRIORITY_LANES.get(command, ("normal", ()))
+	bleLock.setLane(lane)
+	if obsoletes:
+		cancelled = bleLock.cancel(obsoletes, command)
+		if cancelled:
+			print(command + " cancelled " + str(cancelled) + " waiting writes")
+
+@app.before_request
+def chooseLane():
+	prioritise(request.path.strip("/"))
+
+def runCommand(command, value=None):
+	function, takesValue = COMMANDS[command]
+	lane = bleLock.lane()
+	prioritise(command)
+	try:
+		if takesValue:
+			return function(value)
+		return function()
+	finally:
+		bleLock.setLane(lane)
+
+# A job that comes due while the service is still connecting to the bed waits
+# (up to a minute) for the connection rather than failing straight away.
+
+def runScheduledCommand(command, value=None):
+	bedReady.wait(60)
+	return runCommand(command, value)
+
+# Anything running in the background (a scheduled job, or a massage program)
+# that can't talk to the bed is treated the same as a URL that can't; anything
+# else (a bad value in the job, say) is just logged.
+
+def backgroundFailed(error):
+	if isinstance(error, bed.errors) and not isinstance(error, transport.GattError):
+		connectionLost()
+
+def jobFailed(job, error):
+	backgroundFailed(error)
+
+# Turn the "at" parameter into seconds since the epoch.  It can be a time of
+# day (HH:MM or HH:MM:SS, the next time it comes around) or an epoch time.
+
+def parseTime(at):
+	if ":" not in at:
+		return float(at)
+
+	now = time.localtime()
+	parts = [int(part) for part in at.split(":")] + [0]
+	when = time.mktime((now.tm_year, now.tm_mon, now.tm_mday, parts[0], parts[1], parts[2], 0, 0, -1))
+	if when <= time.time():
+		when = time.mktime((now.tm_year, now.tm_mon, now.tm_mday + 1, parts[0], parts[1], parts[2], 0, 0, -1))
+	return when
+
+@app.route("/schedule")
+def getSchedule():
+	return jsonify(scheduler.list())
+
+@app.route("/schedule/add/<path:command>")
+def addSchedule(command):
+	if command not in COMMANDS:
+		return 'Unknown command: '+command, 400
+
+	try:
+		value = request.args.get("value")
+		if COMMANDS[command][1]:
+			if value is None:
+				return command+' needs a value', 400
+			value = int(value)
+
+		if "at" in request.args:
+			at = parseTime(request.args["at"])
+		else:
+			at = time.time() + float(request.args.get("in", 0))
+
+		every = request.args.get("every", "0")
+		if every == "daily":
+			every = 86400
+		every = int(every)
+
+		job = scheduler.add(command, value, at=at, every=every, ramp=int(request.args.get("ramp", 0)))
+	except ValueError as error:
+		return 'Invalid job: '+str(error), 400
+
+	return 'Job '+str(job["id"])+' Scheduled for '+time.ctime(job["at"])
+
+@app.route("/schedule/delete/<int:id>")
+def deleteSchedule(id):
+	if not scheduler.remove(id):
+		return 'No Job '+str(id), 404
+	return 'Job '+str(id)+' Deleted'
+
+# Turn the massage off after a number of minutes.  Setting a new timer replaces
+# the old one, and 0 cancels it.  This one still runs if the service was
+# restarted and the time has already passed, so a massage never keeps going
+# because the timer was missed.
+
+@app.route("/massageTimer/<minutes>")
+def setMassageTimer(minutes):
+	minutes=int(minutes)
+
+	if minutes <= 0:
+		for job in scheduler.list():
+			if job["name"] == "massageTimer":
+				scheduler.remove(job["id"])
+		return 'Massage Timer Cancelled'
+
+	scheduler.add("stopMassage", at=time.time() + minutes * 60, name="massageTimer", catchup=True)
+
+	return 'Massage Timer Set to: '+str(minutes)
+
+###############################################################################
+# Main Program Starts
+###############################################################################
 
 # If this is set to 0 or a negative number(which technically makes no sense), 
 # it will be invalid or cause a divide by zero and explode.
 
 if MAX_MASSAGE_SPEED <= 0:
 	MAX_MASSAGE_SPEED = 1
-	
-# Open a connection to the bed.  This might fail, as the bed has no security and
-# only allows one device connection at a time.  So, for example, if you have used the
-# bed's remote and it hasn't closed its connection yet, this one will fail.  Just
-# re-run until you get a connection.
 
-connected=False
-MAXTRIES = 5
-check = 1
-while (MAXTRIES >= check and connected == False):
-	try:
-		print("Attempting to connect to "+DEVICE_MAC+" (Try "+str(check)+"/"+str(MAXTRIES)+")")
-		dev = btle.Peripheral(DEVICE_MAC, "random")
-		# Since service UUIDs that begin with 0000 are supposed to be reserved,
-		# I am looking for a UUID that is anything else.  This will assign the
-		# first UUID it finds.  With the Reverie beds, this SHOULD be adequate.
-		for primary in dev.services:
-			if str(primary.uuid)[:4] != "0000":
-				service=dev.getServiceByUUID(primary.uuid)
-		connected = True
-	except:
-		check += 1
-		time.sleep(5)
-		pass
+# head, feet, tilt or lumbar (raw hex values).  With tilt, the presets leave it
+# at tiltFlat, the same as /setTilt/50.
 
-if connected == False:
-	print("Error connecting to device "+DEVICE_MAC+" after "+str(MAXTRIES)+" tries.")
-	sys.exit()
+def presetPositions(useTilt, tiltFlat, zeroG, noSnore):
+	flat = percent2hex(tiltFlat) if useTilt == True else "00"
 
-# This is a list of the services by UUID to controlling the bed
+	def preset(value):
+		head, feet = value.split(",")
+		return [percent2hex(head), percent2hex(feet), flat]
 
-PositionBed=service.getCharacteristics(forUUID="db8010d0-f324-29c3-38d1-85c0c2e86885")[0]
+	return ["00", "00", flat], preset(zeroG), preset(noSnore)
 
-PositionHead=service.getCharacteristics(forUUID="db801041-f324-29c3-38d1-85c0c2e86885")[0]
-PositionFeet=service.getCharacteristics(forUUID="db801042-f324-29c3-38d1-85c0c2e86885")[0]
+FLAT, ZEROG, NOSNORE = presetPositions(USE_TILT, TILT_FLAT, ZEROG_POSITION, NOSNORE_POSITION)
 
-# You'll notice that Tilt and Lumbar use the same UUID.  This is on purpose.  The 
-# beds have either tilt or lumbar.  Lumbar (I assume) is a straight 0-100 setting
-# where you have no lumbar lift to the maximum lift.  Tilt, however is "flat" at 
-# 36% (raw decimal).  I have logic to convert it to a straight 0-100, where 50% is flat.
+# Open a connection to the bed.  This might fail, as the bed has no security and
+# only allows one device connection at a time.  So, for example, if you have used the
+# bed's remote and it hasn't closed its connection yet, this one will fail.  It
+# keeps trying until it gets a connection.
 #
-# Obviously, use only one function or the other.
-PositionTilt=service.getCharacteristics(forUUID="db801040-f324-29c3-38d1-85c0c2e86885")[0]
-PositionLumbar=service.getCharacteristics(forUUID="db801040-f324-29c3-38d1-85c0c2e86885")[0]
+# This runs in the background, so the web server can start answering (from the
+# saved state) straight away, rather than refusing connections for however long
+# it takes to find and connect to the bed.
+
+RETRY_AFTER = 5
+
+def connectBed():
+	global DEVICE_MAC, position, linkUp
+
+	# A bed we found last time (or that the profile is for) is probably still
+	# there, so try that before spending 10 seconds scanning for it.
+	mac = DEVICE_MAC
+	if mac == "Auto":
+		mac = savedState.get("mac") or profile.get("mac") or "Auto"
+
+	global connectStarted
+
+	check = 1
+	while True:
+		connectStarted = time.monotonic()
+		sdnotify.notify("STATUS=Connecting to bed (try "+str(check)+")")
+
+		if mac == "Auto":
+			mac = findBed()
+			if mac == "None":
+				print("No Reverie Powerbase found.")
+				mac = "Auto"
+				time.sleep(RETRY_AFTER)
+				continue
+
+		try:
+			print("Attempting to connect to "+mac+" (Try "+str(check)+")")
+			startOp()
+			bed.connect(mac, CHARACTERISTICS, profile)
+			traceOp(bletrace.OP_CONNECT, None, mac.encode(), True)
+			finishOp()
+			# The first read (see below) is part of connecting; if it
+			# fails, start again.
+			with bleLock:
+				values, roundTrips = bed.readMany((PositionHead, PositionFeet, PositionTilt))
+			break
+		except Exception as error:
+			print("Error connecting to device "+mac+": "+str(error))
+			if opStarted is not None:
+				traceOp(bletrace.OP_CONNECT, None, mac.encode(), False)
+				finishOp()
+			try:
+				bed.disconnect()
+			except Exception:
+				pass
+			if DEVICE_MAC == "Auto":
+				mac = "Auto"
+			check += 1
+			time.sleep(RETRY_AFTER)
+
+	DEVICE_MAC = mac
+
+	# Get the current positions of the bed components.	We keep these values
+	# so that when an adjustment of one is changed, the other values can be
+	# maintained and it won't interrupt if you make another change before
+	# the first is finished.  In the functions below, you have to set position
+	# as a global variable so that the changes will persist across events.
+	#
+	# position is defined as a list where [ 0, 1, 2 ] are [ head, feet, tilt ]
+	#
+	# i.e. to get/set the position of the feet would be position[1]
+
+	with bleLock:
+		for characteristic, value in zip((PositionHead, PositionFeet, PositionTilt), values):
+			updateState(characteristic, value)
+		position=[ bedState[PositionHead].hex(), bedState[PositionFeet].hex(), bedState[PositionTilt].hex() ]
+		linkUp = True
+		bedReady.set()
+		publishState()
+
+	print("Connected to "+DEVICE_MAC)
+	sdnotify.notify("STATUS=Connected to "+DEVICE_MAC)
+
+connectStarted = time.monotonic()
+
+# Make sure the connection is still alive when nothing else has used it for a
+# while.  The read goes through bleRead, so it waits its turn behind any
+# requests, and if it fails, it's handled the same way as a request failing.
+
+def keepalive():
+	while True:
+		time.sleep(KEEPALIVE_INTERVAL / 2)
+		if not bedReady.is_set() or not linkUp:
+			continue
+		if lastOpTime is not None and secondsSince(lastOpTime) < KEEPALIVE_INTERVAL:
+			continue
+		try:
+			bleRead(Light, background=True)
+		except Exception as error:
+			print("Keepalive failed: " + str(error))
+			connectionLost()
+
+# Read the bed in the background (see POLL_INTERVAL), one characteristic at a
+# time (or all at once, if the transport can do that in one round trip), and
+# only when nothing else is using the connection, so a command never waits
+# for more than one read.  A smooth move in progress is left
+# alone; it knows where the bed is.  How long each round of reads takes sets
+# how long to wait before the next, to stay within POLL_BUDGET.
+
+pollInterval = None
+pollReads = 0
+pollSkipped = 0
+
+# Returns whether anything changed, and whether it had to stop because the
+# connection was in use.
+
+def pollOnce():
+	global pollReads
+
+	if bed.readsAtOnce:
+		if not bleLock.acquire(blocking=False):
+			return False, True
+		try:
+			before = [bedState.get(characteristic) for characteristic in STATE_CHARACTERISTICS]
+			if not refreshState(background=True):
+				return False, False
+			pollReads += len(STATE_CHARACTERISTICS)
+		finally:
+			bleLock.release()
+		return before != [bedState.get(characteristic) for characteristic in STATE_CHARACTERISTICS], False
+
+	changed = False
+	for characteristic in STATE_CHARACTERISTICS:
+		if not bleLock.acquire(blocking=False):
+			return changed, True
+		try:
+			if not linkUp:
+				return changed, False
+			before = bedState.get(characteristic)
+			bleRead(characteristic, background=True)
+			pollReads += 1
+		finally:
+			bleLock.release()
+		changed = changed or bedState.get(characteristic) != before
+	return changed, False
+
+def poller():
+	global pollInterval, pollSkipped
+
+	interval = POLL_FAST_INTERVAL
+	fastUntil = time.monotonic() + POLL_FAST_PERIOD
+	while True:
+		pollInterval = interval
+		if pollWake.wait(interval):
+			pollWake.clear()
+			interval = POLL_FAST_INTERVAL
+			fastUntil = time.monotonic() + POLL_FAST_PERIOD
+			continue
+		if not bedReady.is_set() or not linkUp or mover.status():
+			continue
+
+		started = time.monotonic()
+		try:
+			changed, busy = pollOnce()
+		except Exception as error:
+			print("Polling failed: " + str(error))
+			connectionLost()
+			return
+		spent = time.monotonic() - started
+
+		if busy:
+			pollSkipped += 1
+		if changed or busy:
+			fastUntil = time.monotonic() + POLL_FAST_PERIOD
+		if time.monotonic() < fastUntil:
+			interval = POLL_FAST_INTERVAL
+		else:
+			interval = min(interval * 2, POLL_INTERVAL)
+		# Reading for spent seconds out of every interval + spent.
+		if POLL_BUDGET > 0:
+			interval = max(interval, spent / POLL_BUDGET - spent)
+
+# Drop the connection once nothing has used it for IDLE_DISCONNECT seconds.
+# A smooth move in progress counts as using it.
+
+def idleMonitor():
+	while True:
+		time.sleep(min(5, IDLE_DISCONNECT / 2))
+		if not bedReady.is_set() or not linkUp or mover.status():
+			continue
+		if secondsSince(lastUseTime) < IDLE_DISCONNECT:
+			continue
+		with bleLock:
+			if linkUp and secondsSince(lastUseTime) >= IDLE_DISCONNECT:
+				try:
+					disconnect()
+				except Exception as error:
+					print("Error disconnecting: " + str(error))
+
+# Keep feeding the systemd watchdog as long as the connection isn't stuck.  It
+# counts as stuck if a read or write, or an attempt to connect, has been going
+# for longer than the watchdog interval.  Then systemd restarts the service.
+
+def watchdog(interval):
+	while True:
+		time.sleep(interval / 2)
+		if opStarted is not None and secondsSince(opStarted) > interval:
+			print("Bluetooth operation stuck for "+str(secondsSince(opStarted))+" seconds")
+			continue
+		if not bedReady.is_set() and secondsSince(connectStarted) > interval:
+			print("Connecting to the bed stuck for "+str(secondsSince(connectStarted))+" seconds")
+			continue
+		sdnotify.notify("WATCHDOG=1")
 
-MassageHead=service.getCharacteristics(forUUID="db801061-f324-29c3-38d1-85c0c2e86885")[0]
-MassageFeet=service.getCharacteristics(forUUID="db801060-f324-29c3-38d1-85c0c2e86885")[0]
-MassageWave=service.getCharacteristics(forUUID="db801080-f324-29c3-38d1-85c0c2e86885")[0]
+###############################################################################
+# Reloading the configuration
+#
+# On SIGHUP, or POST /admin/reload, the settings that can be changed while
+# running are read again from CONFIG_FILE.  They're all worked out first, so a
+# bad value leaves every setting as it was, and then changed together while
+# holding bleLock, so no read or write to the bed sees half of them.  The
+# connection, and anything already sent to the bed, are left alone.
+###############################################################################
 
-Light=service.getCharacteristics(forUUID="db8010A0-f324-29c3-38d1-85c0c2e86885")[0]
+# The file is in the systemd EnvironmentFile format: NAME=value lines, with
+# optional quotes, and comments.
 
-# Get the current positions of the bed components.	We keep these values
-# so that when an adjustment of one is changed, the other values can be
-# maintained and it won't interrupt if you make another change before
-# the first is finished.  In the functions below, you have to set position
-# as a global variable so that the changes will persist across events.
-#
-# position is defined as a list where [ 0, 1, 2 ] are [ head, feet, tilt ]
-#
-# i.e. to get/set the position of the feet would be position[1]
+def readConfigFile():
+	values = {}
+	try:
+		with open(CONFIG_FILE) as f:
+			for line in f:
+				line = line.strip()
+				if not line or line.startswith("#") or "=" not in line:
+					continue
+				name, _, value = line.partition("=")
+				name = name.strip()
+				if name.startswith("export "):
+					name = name[len("export "):].strip()
+				value = value.strip()
+				if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+					value = value[1:-1]
+				values[name] = value
+	except FileNotFoundError:
+		pass
+	except OSError as error:
+		print("Unable to read configuration " + CONFIG_FILE + ": " + str(error))
+	return values
+
+# What came from the file when the service started, so a setting taken out of
+# the file since goes back to its default rather than staying as it was.
+
+configFromFile = {}
+configLock = threading.Lock()
+
+def reloadConfig():
+	global configFromFile, MAX_MASSAGE_SPEED, MAX_WAVES, USE_TILT, TILT_FLAT, ZEROG_POSITION, NOSNORE_POSITION, FLAT, ZEROG, NOSNORE
+
+	with configLock:
+		fromFile = readConfigFile()
+		environ = {name: value for name, value in os.environ.items() if name not in configFromFile}
+		environ.update(fromFile)
+
+		settings = {
+			"MAX_MASSAGE_SPEED": max(int(environ.get("MAX_MASSAGE_SPEED", 40)), 1),
+			"MAX_WAVES": int(environ.get("MAX_WAVES", 4)),
+			"USE_TILT": environ.get("USE_TILT", True),
+			"TILT_FLAT": int(environ.get("TILT_FLAT", 36)),
+			"ZEROG_POSITION": environ.get("ZEROG_POSITION", "31,70"),
+			"NOSNORE_POSITION": environ.get("NOSNORE_POSITION", "11,0"),
+		}
+		flat, zeroG, noSnore = presetPositions(settings["USE_TILT"], settings["TILT_FLAT"], settings["ZEROG_POSITION"], settings["NOSNORE_POSITION"])
+
+		changed = {name: value for name, value in settings.items() if globals()[name] != value}
+		with bleLock:
+			MAX_MASSAGE_SPEED = settings["MAX_MASSAGE_SPEED"]
+			MAX_WAVES = settings["MAX_WAVES"]
+			USE_TILT = settings["USE_TILT"]
+			TILT_FLAT = settings["TILT_FLAT"]
+			ZEROG_POSITION = settings["ZEROG_POSITION"]
+			NOSNORE_POSITION = settings["NOSNORE_POSITION"]
+			FLAT, ZEROG, NOSNORE = flat, zeroG, noSnore
+
+		# HTTP workers started again later get the same settings.
+		for name in settings:
+			if name in environ:
+				os.environ[name] = environ[name]
+			else:
+				os.environ.pop(name, None)
+		configFromFile = fromFile
+
+	print("Reloaded configuration from " + CONFIG_FILE + ": " + (", ".join(name + "=" + str(value) for name, value in changed.items()) or "nothing changed"))
+	return changed
+
+# The HTTP workers have their own copies of the settings, so they're told to
+# reload too.
+
+def reloadAll():
+	changed = reloadConfig()
+	if not WORKER and HTTP_WORKERS > 0:
+		import workers
+		workers.signalWorkers(signal.SIGHUP)
+	return changed
+
+def reloadFromSignal():
+	try:
+		reloadAll()
+	except ValueError as error:
+		print("Not reloading configuration, it has a bad value: " + str(error))
+
+# Not on the signal handler itself, which could have interrupted a thread
+# holding bleLock.
+
+def hangup(signum, frame):
+	threading.Thread(target=reloadFromSignal, name="reloadConfig", daemon=True).start()
+
+@app.route("/admin/reload", methods=["POST"])
+def adminReload():
+	return jsonify({"changed": reloadAll()})
+
+# Until the bed is connected, the position comes from the saved state.
 
-position=[ PositionHead.read().hex(), PositionFeet.read().hex(), PositionTilt.read().hex() ]
+savedState = loadState()
+profile = loadProfile()
 
-if USE_TILT == True:
-	# head, feet, tilt (raw hex values)
-	FLAT=["00", "00", "24"]
-	ZEROG=["1f", "46", "24"]
-	NOSNORE=["0b", "00", "24"]
+if TRACE_FILE and not WORKER:
+	tracer = bletrace.TraceWriter(TRACE_FILE)
+
+if PositionHead in bedState and PositionFeet in bedState and PositionTilt in bedState:
+	position=[ bedState[PositionHead].hex(), bedState[PositionFeet].hex(), bedState[PositionTilt].hex() ]
 else:
-	# head, feet, lumbar (raw hex values)
-	FLAT=["00", "00", "00"]
-	ZEROG=["1f", "46", "00"]
-	NOSNORE=["0b", "00", "00"]
+	position=list(FLAT)
 
 # I haven't yet figured out how to get the exception out of the Flask thread
 # to have it re-connect to the bed.  If it's run as a service, having it kill
 # itself here, systemd will restart it for you.
-@app.errorhandler(Exception)
-def special_exception_handler(error):
+def connectionLost():
 	print("Bluetooth Connection Lost.  Exiting.")
+	saveState()
+	if FLIGHT_LOG_SIZE > 0:
+		flightLog.dump(FLIGHT_LOG)
 	os.kill(os.getpid(), getattr(signal, "SIGKILL", signal.SIGTERM))
+
+@app.errorhandler(Exception)
+def special_exception_handler(error):
+	if isinstance(error, BedNotReady):
+		# A worker that hasn't got a value in the shared state yet asks the
+		# main process for it.
+		if WORKER:
+			return forwardRequest()
+		return 'Bed Not Connected', 503, {'Retry-After': str(RETRY_AFTER)}
+	if isinstance(error, QueueFull):
+		return 'Too Many Requests Waiting', 429, {'Retry-After': '1'}
+	if isinstance(error, Superseded):
+		return 'Cancelled: '+str(error), 409
+	# A bad URL isn't a lost connection, and neither is a bad value in one
+	# (i.e. /setHead/abc), or a bug.  Only give up on the connection if it
+	# was the connection that failed.
+	if isinstance(error, HTTPException):
+		return error
+	if isinstance(error, ValueError):
+		return 'Invalid Value', 400
+	if isinstance(error, transport.GattError):
+		print("Refused by the bed: "+str(error))
+		return 'Refused by the Bed', 502
+	if not isinstance(error, bed.errors):
+		print("Error handling request: "+repr(error))
+		return 'Internal Error', 500
+	connectionLost()
 	return 'Bluetooth Connection Lost', 500
 
+# Anything answered from the saved state rather than the bed gets the standard
+# "stale" warning, and how old it is.
+
+@app.after_request
+def markStale(response):
+	if g.get("stale"):
+		response.headers["Warning"] = '110 - "Response is Stale"'
+		response.headers["Age"] = str(max(0, int(time.time() - bedStateTime)))
+	return response
+
+@app.after_request
+def logRequest(response):
+	flightLog.record("request", method=request.method, path=request.path, status=response.status_code)
+	return response
+
+###############################################################################
+# HTTP worker processes
+#
+# A worker answers the get URLs itself, from the state the main process
+# shares, and sends everything else to the main process over the Unix socket
+# (one connection per thread, kept open), passing the answer straight back.
+# Everything after this is only for the main process.
+###############################################################################
+
+WORKER_LOCAL = ("index", "getHead", "getFeet", "getLumbar", "getTilt", "getHeadMassage", "getFeetMassage", "getWaveMassage", "getLightStatus", "getState")
+
+workerClients = threading.local()
+
+def forwardRequest():
+	client = getattr(workerClients, "client", None)
+	if client is None:
+		client = workerClients.client = CommandClient(UNIX_SOCKET)
+
+	# Quoted again, since Flask has decoded it: a %0A would end the request
+	# line and start another, and a %20 would let the rest be taken for a
+	# client name or a body length.
+	path = urllib.parse.quote(request.path)
+	if request.query_string:
+		path += "?" + urllib.parse.quote(request.query_string.decode("latin-1"), safe=string.punctuation)
+
+	try:
+		status, contentType, reply = client.request(path, request.get_data(), request.method, g.client)
+	except OSError as error:
+		client.close()
+		print("Unable to reach the main process: " + str(error))
+		return 'Bed Not Connected', 503, {'Retry-After': str(RETRY_AFTER)}
+
+	headers = {"Content-Type": contentType}
+	if status == 503:
+		headers["Retry-After"] = str(RETRY_AFTER)
+	elif status == 429:
+		headers["Retry-After"] = "1"
+	return reply, status, headers
+
+def workerRequest():
+	global bedStateTime
+
+	if request.endpoint not in WORKER_LOCAL:
+		return forwardRequest()
+
+	values, ready, up, updated = sharedReader.read()
+	bedState.update(values)
+	bedStateTime = updated
+	g.fresh = ready and up
+	return None
+
+configFromFile = readConfigFile()
+signal.signal(signal.SIGHUP, hangup)
+
+if WORKER:
+	sharedReader = sharedstate.SharedStateReader(SHARED_STATE)
+	app.before_request(workerRequest)
+	import workers
+	workers.serveWorker(app, RPI_LOCAL_IP, RPI_LISTEN_PORT)
+	sys.exit()
+
+if FLIGHT_LOG_SIZE > 0:
+	atexit.register(flightLog.dump, FLIGHT_LOG)
+	signal.signal(signal.SIGTERM, stopping)
+
+if SHARED_STATE:
+	sharedState = sharedstate.SharedStateWriter(SHARED_STATE)
+	publishState()
+
+# Start running any jobs that were scheduled before the service was last
+# stopped.
+
+scheduler = Scheduler(os.path.join(STATE_DIR, "schedule.json"), runScheduledCommand, RAMPABLE, jobFailed, RAMPERS)
+scheduler.load()
+scheduler.start()
+
+# Requests that come in on the Unix socket are run through Flask the same way
+# as HTTP requests, just without the network and HTTP parsing, so every URL
+# works the same way on both.  Anyone who can write to the socket can already
+# control the bed, so they don't need ADMIN_TOKEN (and HTTP workers check it
+# before passing a request on).  They're all the "unix" client, unless they
+# name another (HTTP workers pass on the name of the client they came from).
+
+def dispatch(method, path, body=b"", client=None):
+	path, _, query = path.partition("?")
+	with app.test_request_context(path, method=method, query_string=query, data=body):
+		g.trusted = True
+		g.client = client or "unix"
+		response = app.full_dispatch_request()
+	return response.status_code, response.get_data(), response.content_type
+
+if UNIX_SOCKET:
+	CommandServer(UNIX_SOCKET, dispatch, UNIX_SOCKET_MODE, UNIX_SOCKET_GROUP or None).start()
+
+threading.Thread(target=stateSaver, name="stateSaver", daemon=True).start()
+threading.Thread(target=connectBed, name="connectBed", daemon=True).start()
+mover.start()
+
+if KEEPALIVE_INTERVAL > 0:
+	threading.Thread(target=keepalive, name="keepalive", daemon=True).start()
+
+if POLL_INTERVAL > 0:
+	threading.Thread(target=poller, name="poller", daemon=True).start()
+
+if HOMEKIT_PORT > 0:
+	import homekit
+	homekit.startHomeKit(HOMEKIT_PORT, os.path.join(STATE_DIR, "homekit.state"), HOMEKIT_NAME, runCommand, cachedState,
+		USE_TILT == True, MAX_WAVES, HOMEKIT_PIN or None, backgroundFailed)
+
+if MQTT_BROKER:
+	from mqttbridge import MqttBridge
+	host, _, port = MQTT_BROKER.partition(":")
+	mqtt = MqttBridge(host, int(port or 1883), runCommand, COMMANDS, cachedState, MQTT_TOPIC, MQTT_QOS,
+		username=MQTT_USERNAME or None, password=MQTT_PASSWORD or None, onError=backgroundFailed)
+	stateListeners.append(mqtt.notify)
+	mqtt.start()
+
+if IDLE_DISCONNECT > 0:
+	threading.Thread(target=idleMonitor, name="idleMonitor", daemon=True).start()
+
+if sdnotify.watchdogInterval():
+	threading.Thread(target=watchdog, args=(sdnotify.watchdogInterval(),), name="watchdog", daemon=True).start()
+
+# With HTTP_WORKERS, this process opens the port and leaves the workers to
+# answer on it.
+if HTTP_WORKERS > 0 and __name__ == '__main__':
+	import workers
+	workers.startWorkers(HTTP_WORKERS, workers.listen(RPI_LOCAL_IP, RPI_LISTEN_PORT), os.path.abspath(__file__))
+
+# The web server is about to start listening, which is when systemd should
+# consider the service started, even though the bed may not be connected yet.
+sdnotify.notify("READY=1")
+
 if __name__ == '__main__':
+	if HTTP_WORKERS > 0:
+		threading.Event().wait()
 	app.run(host=RPI_LOCAL_IP, port=RPI_LISTEN_PORT, debug=False)
\ No newline at end of file
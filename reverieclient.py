@@ -0,0 +1,529 @@
+#!/usr/bin/python3
+
+# reverieclient.py
+#
+# A Python client for reverie.py's HTTP API, so integrations don't each have
+# to build the URLs and pick apart replies like "Tilt Set to: 50".  There's a
+# blocking one (ReverieClient) and an asyncio one (AsyncReverieClient), with
+# the same methods:
+#
+#     client = ReverieClient("bedroom-pi", 8001)
+#     client.setHead(30)
+#     print(client.head(), client.light())
+#
+#     client = AsyncReverieClient("bedroom-pi", 8001)
+#     await asyncio.gather(client.setHead(30), client.setFeet(10), client.setLight(1))
+#
+# Both keep their connection to the server open between calls.
+#
+# Reads all come from /state, which is kept for cacheTtl seconds, so asking
+# for the head, the feet and the light one after the other is one request.
+# Sets made within batchWindow seconds of each other with the async client
+# (or inside "with client.batch():" with the blocking one) are sent together
+# as one /scene, so the head and feet move in one write to the bed.  With a
+# server too old to have /scene, each one is sent to its own URL instead.
+#
+# A call that can't reach the server, or finds the bed isn't connected yet
+# (503), is tried again until it works or deadline seconds have passed since
+# it was made, when it raises ReverieError.  So does any other error from the
+# server, straight away.
+#
+# Only needs the standard library.  benchmark-client.py compares it with
+# making a new request for each call.
+
+import asyncio
+import contextlib
+import http.client
+import json
+import threading
+import time
+
+class ReverieError(Exception):
+	def __init__(self, message, status=None):
+		Exception.__init__(self, message)
+		self.status = status
+
+# A request that went out but got no answer, so it may or may not have been
+# done.  Fine to try again, unless doing it twice isn't the same as doing it
+# once (see adjust()).
+class Unanswered(Exception):
+	pass
+
+# Failures worth trying again: the connection (OSError covers timeouts), or
+# a reply that got cut off.
+RETRYABLE = (OSError, EOFError, http.client.HTTPException, asyncio.TimeoutError, Unanswered)
+
+# How long to wait before trying again: a little longer each time, at least
+# as long as the server asks for, and never past the deadline.
+
+def retryDelay(attempt, retryAfter, remaining):
+	delay = min(0.1 * 2 ** attempt, 2.0)
+	if retryAfter:
+		delay = max(delay, retryAfter)
+	return max(0, min(delay, remaining))
+
+# The URLs that do the same as a scene, for servers without /scene.
+
+def sceneURLs(values):
+	urls = []
+	for key, value in values.items():
+		if key == "light":
+			urls.append("/light/on" if value else "/light/off")
+		else:
+			urls.append("/set" + key[0].upper() + key[1:] + "/" + str(int(value)))
+	return urls
+
+###############################################################################
+# Blocking client
+###############################################################################
+
+class ReverieClient:
+	def __init__(self, host="127.0.0.1", port=8001, timeout=5.0, deadline=15.0, cacheTtl=0.5):
+		self.host = host
+		self.port = int(port)
+		self.timeout = timeout
+		self.deadline = deadline
+		self.cacheTtl = cacheTtl
+		self.lock = threading.RLock()
+		self.connection = None
+		self.cached = None
+		self.cachedTime = 0
+		self.pending = None
+		self.hasScene = True
+		self.requests = 0
+
+	def close(self):
+		with self.lock:
+			if self.connection is not None:
+				self.connection.close()
+				self.connection = None
+
+	# Send one request on the open connection (opening it if need be), and
+	# return (status, Retry-After, body).
+
+	def send(self, method, path, body=None):
+		with self.lock:
+			if self.connection is None:
+				self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+			headers = {"Content-Type": "application/json"} if body is not None else {}
+			self.requests += 1
+			sent = False
+			try:
+				if self.connection.sock is None:
+					self.connection.connect()
+				sent = True
+				self.connection.request(method, path, body, headers)
+				response = self.connection.getresponse()
+				reply = response.read()
+			except RETRYABLE as error:
+				self.close()
+				if sent:
+					raise Unanswered(str(error) or type(error).__name__) from error
+				raise
+			if response.will_close:
+				self.close()
+			return response.status, response.getheader("Retry-After"), reply
+
+	# retry=False doesn't try again once the request might have been done.
+
+	def request(self, method, path, body=None, retry=True):
+		deadline = time.monotonic() + self.deadline
+		attempt = 0
+		while True:
+			retryAfter = None
+			try:
+				status, retryAfter, reply = self.send(method, path, body)
+			except RETRYABLE as error:
+				status, problem = None, str(error) or type(error).__name__
+				if isinstance(error, Unanswered) and not retry:
+					raise ReverieError(path + ": " + problem + " (it may have been done)")
+			else:
+				if status < 400:
+					return reply
+				problem = str(status) + " " + reply.decode(errors="replace")
+				if status != 503:
+					raise ReverieError(path + ": " + problem, status)
+
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				raise ReverieError(path + ": " + problem, status)
+			time.sleep(retryDelay(attempt, float(retryAfter or 0), remaining))
+			attempt += 1
+
+	###########################################################################
+	# Reading
+	###########################################################################
+
+	# The whole state of the bed, the same as /state.
+
+	def state(self):
+		with self.lock:
+			if self.cached is None or time.monotonic() - self.cachedTime > self.cacheTtl:
+				self.remember(json.loads(self.request("GET", "/state")))
+			return dict(self.cached)
+
+	def remember(self, state):
+		with self.lock:
+			self.cached = state
+			self.cachedTime = time.monotonic()
+
+	def forget(self):
+		with self.lock:
+			self.cached = None
+
+	def head(self):
+		return self.state()["head"]
+
+	def feet(self):
+		return self.state()["feet"]
+
+	def tilt(self):
+		return self.state()["tilt"]
+
+	def lumbar(self):
+		return self.state()["lumbar"]
+
+	def headMassage(self):
+		return self.state()["headMassage"]
+
+	def feetMassage(self):
+		return self.state()["feetMassage"]
+
+	def waveMassage(self):
+		return self.state()["waveMassage"]
+
+	def light(self):
+		return self.state()["light"]
+
+	###########################################################################
+	# Setting
+	###########################################################################
+
+	# Set any of head, feet, tilt, lumbar, headMassage, feetMassage,
+	# waveMassage and light at once.
+
+	def scene(self, **values):
+		if self.pending is not None:
+			self.pending.update(values)
+			return
+		if not values:
+			return
+
+		if self.hasScene:
+			try:
+				self.remember(json.loads(self.request("POST", "/scene", json.dumps(values))))
+				return
+			except ReverieError as error:
+				if error.status != 404:
+					raise
+				self.hasScene = False
+
+		for url in sceneURLs(values):
+			self.request("GET", url)
+		self.forget()
+
+	# Everything set inside the with is sent as one scene at the end.  Only
+	# for one thread at a time.
+
+	@contextlib.contextmanager
+	def batch(self):
+		self.pending = {}
+		try:
+			yield self
+		finally:
+			values, self.pending = self.pending, None
+		self.scene(**values)
+
+	def setHead(self, value):
+		self.scene(head=value)
+
+	def setFeet(self, value):
+		self.scene(feet=value)
+
+	def setTilt(self, value):
+		self.scene(tilt=value)
+
+	def setLumbar(self, value):
+		self.scene(lumbar=value)
+
+	def setHeadMassage(self, value):
+		self.scene(headMassage=value)
+
+	def setFeetMassage(self, value):
+		self.scene(feetMassage=value)
+
+	def setWaveMassage(self, value):
+		self.scene(waveMassage=value)
+
+	def setLight(self, on):
+		self.scene(light=1 if on else 0)
+
+	# The presets, and anything else that's just a URL.
+
+	def command(self, path):
+		reply = self.request("GET", "/" + path.lstrip("/"))
+		self.forget()
+		return reply.decode()
+
+	def flat(self):
+		self.command("flat")
+
+	def zeroG(self):
+		self.command("zeroG")
+
+	def noSnore(self):
+		self.command("noSnore")
+
+	def stopMassage(self):
+		self.command("stopMassage")
+
+	# Change part (head, feet, tilt, lumbar, headMassage, feetMassage or
+	# waveMassage) by change from wherever it is now (i.e. 5, -10, or "up" or
+	# "down" for the massages), and return where it ended up.  Doing it twice
+	# would change it twice, so it isn't tried again once it's been sent.
+
+	def adjust(self, part, change):
+		reply = self.request("GET", "/adjust/" + part + "/" + str(change), retry=False)
+		self.forget()
+		return int(reply.decode().rsplit(" ", 1)[1])
+
+###############################################################################
+# asyncio client
+###############################################################################
+
+class AsyncReverieClient:
+	def __init__(self, host="127.0.0.1", port=8001, timeout=5.0, deadline=15.0, cacheTtl=0.5, batchWindow=0.005):
+		self.host = host
+		self.port = int(port)
+		self.timeout = timeout
+		self.deadline = deadline
+		self.cacheTtl = cacheTtl
+		self.batchWindow = batchWindow
+		self.lock = None
+		self.reader = None
+		self.writer = None
+		self.sent = False
+		self.cached = None
+		self.cachedTime = 0
+		self.reading = None
+		self.pending = None
+		self.pendingResult = None
+		self.hasScene = True
+		self.requests = 0
+
+	async def close(self):
+		if self.writer is not None:
+			writer, self.reader, self.writer = self.writer, None, None
+			writer.close()
+			with contextlib.suppress(Exception):
+				await writer.wait_closed()
+
+	async def exchange(self, method, path, body):
+		if self.writer is None:
+			self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+		head = method + " " + path + " HTTP/1.1\r\nHost: " + self.host + "\r\n"
+		if body is not None:
+			head += "Content-Type: application/json\r\nContent-Length: " + str(len(body)) + "\r\n"
+		self.sent = True
+		self.writer.write(head.encode() + b"\r\n" + (body or b""))
+		await self.writer.drain()
+
+		statusLine = await self.reader.readline()
+		if not statusLine:
+			raise EOFError("connection closed by the server")
+		status = int(statusLine.split()[1])
+		headers = {}
+		while True:
+			line = await self.reader.readline()
+			if line in (b"\r\n", b"\n", b""):
+				break
+			name, _, value = line.decode("latin-1").partition(":")
+			headers[name.strip().lower()] = value.strip()
+
+		if "content-length" in headers:
+			reply = await self.reader.readexactly(int(headers["content-length"]))
+		else:
+			reply = await self.reader.read()
+			headers["connection"] = "close"
+		if headers.get("connection", "").lower() == "close":
+			await self.close()
+		return status, headers.get("retry-after"), reply
+
+	async def send(self, method, path, body=None):
+		if self.lock is None:
+			self.lock = asyncio.Lock()
+		async with self.lock:
+			self.requests += 1
+			self.sent = False
+			try:
+				return await asyncio.wait_for(self.exchange(method, path, body), self.timeout)
+			except (Exception, asyncio.CancelledError) as error:
+				# Whatever was half sent or read, the connection can't be
+				# used again.
+				await self.close()
+				if self.sent and isinstance(error, RETRYABLE):
+					raise Unanswered(str(error) or type(error).__name__) from error
+				raise
+
+	async def request(self, method, path, body=None, retry=True):
+		deadline = time.monotonic() + self.deadline
+		attempt = 0
+		while True:
+			retryAfter = None
+			try:
+				status, retryAfter, reply = await self.send(method, path, body)
+			except RETRYABLE as error:
+				status, problem = None, str(error) or type(error).__name__
+				if isinstance(error, Unanswered) and not retry:
+					raise ReverieError(path + ": " + problem + " (it may have been done)")
+			else:
+				if status < 400:
+					return reply
+				problem = str(status) + " " + reply.decode(errors="replace")
+				if status != 503:
+					raise ReverieError(path + ": " + problem, status)
+
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				raise ReverieError(path + ": " + problem, status)
+			await asyncio.sleep(retryDelay(attempt, float(retryAfter or 0), remaining))
+			attempt += 1
+
+	###########################################################################
+	# Reading
+	###########################################################################
+
+	# Callers that ask while /state is already being fetched wait for the
+	# same answer.
+
+	async def state(self):
+		if self.cached is not None and time.monotonic() - self.cachedTime <= self.cacheTtl:
+			return dict(self.cached)
+		if self.reading is None:
+			self.reading = asyncio.ensure_future(self.request("GET", "/state"))
+		reading = self.reading
+		try:
+			reply = await asyncio.shield(reading)
+		finally:
+			if self.reading is reading and reading.done():
+				self.reading = None
+		self.remember(json.loads(reply))
+		return dict(self.cached)
+
+	def remember(self, state):
+		self.cached = state
+		self.cachedTime = time.monotonic()
+
+	def forget(self):
+		self.cached = None
+
+	async def head(self):
+		return (await self.state())["head"]
+
+	async def feet(self):
+		return (await self.state())["feet"]
+
+	async def tilt(self):
+		return (await self.state())["tilt"]
+
+	async def lumbar(self):
+		return (await self.state())["lumbar"]
+
+	async def headMassage(self):
+		return (await self.state())["headMassage"]
+
+	async def feetMassage(self):
+		return (await self.state())["feetMassage"]
+
+	async def waveMassage(self):
+		return (await self.state())["waveMassage"]
+
+	async def light(self):
+		return (await self.state())["light"]
+
+	###########################################################################
+	# Setting
+	###########################################################################
+
+	# Everything set within batchWindow of the first one goes in the same
+	# scene, and every caller gets its result (or its error).
+
+	async def scene(self, **values):
+		loop = asyncio.get_running_loop()
+		if self.pending is None:
+			self.pending = {}
+			self.pendingResult = loop.create_future()
+			loop.call_later(self.batchWindow, lambda: asyncio.ensure_future(self.flush()))
+		self.pending.update(values)
+		return await asyncio.shield(self.pendingResult)
+
+	async def flush(self):
+		values, result = self.pending, self.pendingResult
+		self.pending = self.pendingResult = None
+		try:
+			result.set_result(await self.sendScene(values))
+		except Exception as error:
+			result.set_exception(error)
+
+	async def sendScene(self, values):
+		if self.hasScene:
+			try:
+				state = json.loads(await self.request("POST", "/scene", json.dumps(values).encode()))
+				self.remember(state)
+				return state
+			except ReverieError as error:
+				if error.status != 404:
+					raise
+				self.hasScene = False
+
+		for url in sceneURLs(values):
+			await self.request("GET", url)
+		self.forget()
+		return None
+
+	async def setHead(self, value):
+		await self.scene(head=value)
+
+	async def setFeet(self, value):
+		await self.scene(feet=value)
+
+	async def setTilt(self, value):
+		await self.scene(tilt=value)
+
+	async def setLumbar(self, value):
+		await self.scene(lumbar=value)
+
+	async def setHeadMassage(self, value):
+		await self.scene(headMassage=value)
+
+	async def setFeetMassage(self, value):
+		await self.scene(feetMassage=value)
+
+	async def setWaveMassage(self, value):
+		await self.scene(waveMassage=value)
+
+	async def setLight(self, on):
+		await self.scene(light=1 if on else 0)
+
+	async def command(self, path):
+		reply = await self.request("GET", "/" + path.lstrip("/"))
+		self.forget()
+		return reply.decode()
+
+	async def flat(self):
+		await self.command("flat")
+
+	async def zeroG(self):
+		await self.command("zeroG")
+
+	async def noSnore(self):
+		await self.command("noSnore")
+
+	async def stopMassage(self):
+		await self.command("stopMassage")
+
+	async def adjust(self, part, change):
+		reply = await self.request("GET", "/adjust/" + part + "/" + str(change), retry=False)
+		self.forget()
+		return int(reply.decode().rsplit(" ", 1)[1])
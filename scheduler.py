@@ -0,0 +1,390 @@
+#!/usr/bin/python3
+
+# scheduler.py
+#
+# In-process job scheduler for reverie.py.  Jobs are kept in a small table
+# that is saved to disk as JSON, so they survive a restart of the service,
+# and are fired from a hashed timer wheel driven by a single thread (each job
+# then runs on a thread of its own, so a slow one can't hold up the rest).
+#
+# A job is just a command name (the same names as the URL routes, i.e.
+# "setHead", "stopMassage", "light/on") with an optional value.  It can run
+# once, or repeat every N seconds.  A job with a ramp time will move from the
+# current value to its target value in small steps over that many seconds
+# rather than jumping straight there.
+#
+# The scheduler does not know anything about the bed.  reverie.py hands it a
+# function that runs a command and a table of functions that read the
+# current value of anything that can be ramped.  It can also hand it a table
+# of functions that do the ramp themselves (smooth moves of the head, feet
+# and tilt), which are used instead of stepping every few seconds.
+
+import collections
+import json
+import math
+import os
+import threading
+import time
+
+###############################################################################
+# Timer wheel
+#
+# The wheel is a ring of slots, one per tick.  A timer is dropped into the slot
+# for the tick it expires on, so adding and cancelling are constant time no
+# matter how many jobs there are, and each tick only has to look at one slot.
+# Timers more than one lap away just stay in their slot until their tick comes
+# around.
+###############################################################################
+
+class Timer:
+	def __init__(self, expires, callback, key):
+		self.expires = expires
+		self.callback = callback
+		self.key = key
+		self.cancelled = False
+
+	def cancel(self):
+		self.cancelled = True
+
+class TimerWheel:
+	def __init__(self, slots=512, tick=1.0):
+		self.slots = [[] for i in range(slots)]
+		self.tick = tick
+		self.current = 0
+		self.origin = time.monotonic()
+		self.lock = threading.Lock()
+
+	# Schedule callback to run after delay seconds.  The delay is rounded up
+	# to the next tick, and is always at least one tick.  key says what the
+	# timer is for (the scheduler uses the job's id).
+
+	def add(self, delay, callback, key=None):
+		ticks = max(1, int(math.ceil(delay / self.tick)))
+		with self.lock:
+			timer = Timer(self.current + ticks, callback, key)
+			self.slots[timer.expires % len(self.slots)].append(timer)
+		return timer
+
+	def clear(self):
+		with self.lock:
+			for slot in self.slots:
+				for timer in slot:
+					timer.cancel()
+				del slot[:]
+
+	# Advance the wheel up to the current time, and return the timers that
+	# have expired.  If the thread was held up for a few ticks, all of the
+	# missed ticks are processed, so nothing is skipped.
+
+	def advance(self):
+		due = []
+		now = int((time.monotonic() - self.origin) / self.tick)
+		with self.lock:
+			while self.current < now:
+				self.current += 1
+				slot = self.slots[self.current % len(self.slots)]
+				keep = []
+				for timer in slot:
+					if timer.cancelled:
+						continue
+					if timer.expires <= self.current:
+						due.append(timer)
+					else:
+						keep.append(timer)
+				slot[:] = keep
+		return due
+
+	def sleepTime(self):
+		return self.origin + (self.current + 1) * self.tick - time.monotonic()
+
+###############################################################################
+# Scheduler
+###############################################################################
+
+# What's wrong with a job's start time, repeat interval and ramp time, if
+# anything.  A negative interval would put the job straight back on the wheel
+# for the next tick, forever, and a time that isn't finite (nan or inf) can't
+# go on the wheel, or be saved as JSON, at all.
+
+def invalidTiming(at, every, ramp):
+	for name, value in (("at", at), ("every", every), ("ramp", ramp)):
+		if value is None:
+			continue
+		if isinstance(value, bool) or not isinstance(value, (int, float)):
+			return name + " must be a number"
+		try:
+			finite = math.isfinite(value)
+		except OverflowError:
+			finite = False
+		if not finite:
+			return name + " must be finite"
+		if name != "at" and value < 0:
+			return name + " can't be negative"
+	if at is not None:
+		try:
+			time.localtime(at + (every or 0))
+		except (OverflowError, ValueError, OSError):
+			return "at is out of range"
+	return None
+
+class Scheduler:
+	# Anything that is still waiting when the service starts back up and is
+	# overdue by more than this many seconds is skipped, unless the job is
+	# marked catchup (the massage auto-off timer, for example).
+	MISFIRE_GRACE = 300
+
+	# Ramped jobs are sent in steps this many seconds apart.
+	RAMP_STEP = 5
+
+	def __init__(self, filename, runCommand, readers=None, onError=None, rampers=None):
+		self.filename = filename
+		self.runCommand = runCommand
+		self.readers = readers or {}
+		self.rampers = rampers or {}
+		self.onError = onError
+		self.wheel = TimerWheel()
+		self.jobs = {}
+		self.timers = {}
+		# Job id: the due callbacks that job's thread hasn't got to yet.
+		self.pending = {}
+		self.nextId = 1
+		self.lock = threading.RLock()
+		self.thread = None
+		self.clockOffset = time.time() - time.monotonic()
+
+	###########################################################################
+	# Job table
+	###########################################################################
+
+	def load(self):
+		try:
+			with open(self.filename) as f:
+				table = json.load(f)
+		except FileNotFoundError:
+			return
+		except (OSError, ValueError) as error:
+			print("Unable to read schedule " + self.filename + ": " + str(error))
+			return
+
+		now = time.time()
+		with self.lock:
+			for job in table.get("jobs", []):
+				problem = invalidTiming(job.get("at"), job.get("every"), job.get("ramp"))
+				if problem:
+					print("Skipping scheduled job " + str(job["id"]) + ": " + problem)
+					continue
+				if job["at"] < now - self.MISFIRE_GRACE and not job.get("catchup"):
+					if not job.get("every"):
+						print("Skipping missed job " + str(job["id"]))
+						continue
+					# Move a repeating job on to its next future run.
+					missed = math.ceil((now - job["at"]) / job["every"])
+					job["at"] += missed * job["every"]
+				self.jobs[job["id"]] = job
+			self.nextId = max([table.get("nextId", 1)] + [id + 1 for id in self.jobs])
+		print("Loaded " + str(len(self.jobs)) + " scheduled jobs")
+
+	def save(self):
+		table = {"nextId": self.nextId, "jobs": sorted(self.jobs.values(), key=lambda job: job["id"])}
+		try:
+			directory = os.path.dirname(self.filename)
+			if directory:
+				os.makedirs(directory, exist_ok=True)
+			# Write to a temporary file and rename it, so a power cut can't
+			# leave a half written schedule behind.
+			with open(self.filename + ".tmp", "w") as f:
+				json.dump(table, f, indent=1)
+			os.replace(self.filename + ".tmp", self.filename)
+		except OSError as error:
+			print("Unable to save schedule " + self.filename + ": " + str(error))
+
+	# Add a job.  at is the wall clock time (seconds since the epoch) it should
+	# first run.  every is the repeat interval in seconds (0 runs it once).
+	# ramp is how many seconds to take getting to value.  A job with a name
+	# replaces any other job with the same name.
+
+	def add(self, command, value=None, at=None, every=0, ramp=0, name=None, catchup=False):
+		if at is None:
+			at = time.time()
+		problem = invalidTiming(at, every, ramp)
+		if problem:
+			raise ValueError(problem)
+		if ramp and command not in self.readers and command not in self.rampers:
+			raise ValueError(command + " can't be ramped")
+
+		with self.lock:
+			if name is not None:
+				for job in list(self.jobs.values()):
+					if job.get("name") == name:
+						self.remove(job["id"])
+
+			job = {
+				"id": self.nextId,
+				"command": command,
+				"value": value,
+				"at": at,
+				"every": every,
+				"ramp": ramp,
+				"name": name,
+				"catchup": catchup,
+			}
+			# On the wheel first, so a job that can't be armed is never in
+			# the table.
+			self.arm(job)
+			self.nextId += 1
+			self.jobs[job["id"]] = job
+			self.save()
+		return job
+
+	def remove(self, id):
+		with self.lock:
+			job = self.jobs.pop(id, None)
+			timers = self.timers.pop(id, [])
+			for timer in timers:
+				timer.cancel()
+			if job is None:
+				# A one-off ramp that is still stepping can be stopped too.
+				return len(timers) > 0
+			self.save()
+		return True
+
+	def list(self):
+		with self.lock:
+			return sorted([dict(job) for job in self.jobs.values()], key=lambda job: job["at"])
+
+	###########################################################################
+	# Running jobs
+	###########################################################################
+
+	def arm(self, job):
+		self.timers[job["id"]] = [self.wheel.add(job["at"] - time.time(), lambda: self.fire(job["id"]), job["id"])]
+
+	def rearm(self):
+		self.wheel.clear()
+		self.timers = {}
+		for job in self.jobs.values():
+			self.arm(job)
+
+	def fire(self, id):
+		with self.lock:
+			job = self.jobs.get(id)
+			if job is None:
+				return
+			if job["every"]:
+				job["at"] += job["every"]
+				self.arm(job)
+			else:
+				del self.jobs[id]
+				self.timers.pop(id, None)
+			self.save()
+
+		if job["ramp"]:
+			self.startRamp(job)
+		else:
+			self.run(job, job["value"])
+
+	# Work out the in-between values from where it is now to the target, and
+	# put one timer on the wheel for each step.  The steps aren't saved; if the
+	# service restarts partway through, the ramp is abandoned.
+
+	def startRamp(self, job):
+		if job["command"] in self.rampers:
+			print("Running scheduled job " + str(job["id"]) + ": " + job["command"] + " " + str(job["value"]) + " over " + str(job["ramp"]) + " seconds")
+			try:
+				self.rampers[job["command"]](job["value"], job["ramp"])
+			except Exception as error:
+				self.failed(job, error)
+			return
+
+		try:
+			start = int(self.readers[job["command"]]())
+		except Exception as error:
+			self.failed(job, error)
+			return
+
+		target = int(job["value"])
+		steps = max(1, int(job["ramp"] // self.RAMP_STEP))
+		timers = []
+		for step in range(1, steps + 1):
+			value = round(start + (target - start) * step / steps)
+			timers.append(self.wheel.add((step - 1) * self.RAMP_STEP, lambda value=value, last=(step == steps): self.rampStep(job, value, last), job["id"]))
+
+		with self.lock:
+			if job["id"] in self.timers:
+				self.timers[job["id"]] += timers
+			else:
+				self.timers[job["id"]] = timers
+
+	def rampStep(self, job, value, last):
+		self.run(job, value)
+		if last:
+			with self.lock:
+				if job["id"] not in self.jobs:
+					self.timers.pop(job["id"], None)
+
+	def run(self, job, value):
+		print("Running scheduled job " + str(job["id"]) + ": " + job["command"] + " " + str(value))
+		try:
+			self.runCommand(job["command"], value)
+		except Exception as error:
+			self.failed(job, error)
+
+	def failed(self, job, error):
+		print("Scheduled job " + str(job["id"]) + " failed: " + str(error))
+		if self.onError is not None:
+			self.onError(job, error)
+
+	###########################################################################
+	# Scheduler thread
+	###########################################################################
+
+	def start(self):
+		with self.lock:
+			self.rearm()
+		self.thread = threading.Thread(target=self.loop, name="scheduler", daemon=True)
+		self.thread.start()
+
+	def loop(self):
+		while True:
+			time.sleep(max(0, self.wheel.sleepTime()))
+
+			# The Pi has no real-time clock, so the wall clock can jump when
+			# NTP finally syncs after boot.  The wheel runs on the monotonic
+			# clock, so if that happens, put every job back on the wheel
+			# against the corrected wall clock.
+			offset = time.time() - time.monotonic()
+			if abs(offset - self.clockOffset) > 2:
+				print("System clock changed; rescheduling jobs")
+				self.clockOffset = offset
+				with self.lock:
+					self.rearm()
+
+			for timer in self.wheel.advance():
+				if not timer.cancelled:
+					self.dispatch(timer.key, timer.callback)
+
+	# Running a job can take a while (waiting its turn for the bed, or for the
+	# bed to connect), so it's done on a thread of its own rather than this
+	# one, and the wheel keeps ticking for everything else.  Each job's
+	# callbacks (its runs, or the steps of its ramp) still go one at a time,
+	# in order.
+
+	def dispatch(self, key, callback):
+		with self.lock:
+			if key in self.pending:
+				self.pending[key].append(callback)
+				return
+			self.pending[key] = collections.deque([callback])
+		threading.Thread(target=self.drain, args=(key,), name="scheduler-" + str(key), daemon=True).start()
+
+	def drain(self, key):
+		while True:
+			with self.lock:
+				if not self.pending[key]:
+					del self.pending[key]
+					return
+				callback = self.pending[key].popleft()
+			try:
+				callback()
+			except Exception as error:
+				print("Scheduled job " + str(key) + " failed: " + str(error))
@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+
+# sdnotify.py
+#
+# Just enough of the systemd notify protocol (see sd_notify(3)) to tell
+# systemd when the service is ready, and to keep its watchdog fed, without
+# needing the python systemd bindings.  When the service isn't started by
+# systemd (NOTIFY_SOCKET isn't set), these quietly do nothing.
+
+import os
+import socket
+
+def notify(state):
+	address = os.environ.get("NOTIFY_SOCKET")
+	if not address:
+		return False
+
+	# An address starting with @ is in the abstract namespace.
+	if address[0] == "@":
+		address = "\0" + address[1:]
+
+	try:
+		with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+			sock.sendto(state.encode(), address)
+	except OSError as error:
+		print("Unable to notify systemd: " + str(error))
+		return False
+	return True
+
+# How often (in seconds) systemd expects to hear from us, from WatchdogSec= in
+# the unit file, or None if the watchdog isn't turned on for this process.
+
+def watchdogInterval():
+	usec = os.environ.get("WATCHDOG_USEC")
+	if not usec:
+		return None
+
+	pid = os.environ.get("WATCHDOG_PID")
+	if pid and int(pid) != os.getpid():
+		return None
+
+	return int(usec) / 1000000
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+# sharedstate.py
+#
+# The state of the bed in a small shared memory segment (a file in /dev/shm,
+# mapped with mmap), so other processes on the same machine can read it
+# without asking reverie.py for it.  reverie.py's HTTP worker processes use it
+# to answer the get URLs, and anything else local can read it too:
+#
+#     sharedstate.py                         print it as JSON
+#     sharedstate.py /dev/shm/some-other-name
+#
+# reverie.py is the only writer.  Readers never block it, and it never blocks
+# them: the writer bumps a sequence number before and after each update, and
+# a reader that sees the number odd (an update in progress) or changed while it
+# was reading just reads again.
+#
+# Layout (little endian):
+#
+#     0   "RVSS"
+#     4   version (1 byte), 3 bytes padding
+#     8   sequence number (4 bytes)
+#     12  flags (1 byte): 1 = connected to the bed, 2 = link up (not idle)
+#     13  number of values (1 byte), 2 bytes padding
+#     16  time of the last update (8 byte double, seconds since epoch)
+#     24  up to 16 values, each: UUID (16 bytes), length (1 byte), value (15 bytes)
+
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import uuid as uuidlib
+
+MAGIC = b"RVSS"
+VERSION = 1
+
+HEADER = struct.Struct("<4sB3x")
+SEQUENCE = struct.Struct("<I")
+STATE = struct.Struct("<BB2xd")
+SLOT = struct.Struct("<16sB15s")
+
+SEQUENCE_OFFSET = 8
+STATE_OFFSET = 12
+SLOTS_OFFSET = 24
+MAX_SLOTS = 16
+SIZE = SLOTS_OFFSET + MAX_SLOTS * SLOT.size
+
+FLAG_READY = 1
+FLAG_LINK_UP = 2
+
+DEFAULT_PATH = "/dev/shm/reverie-powerbase"
+
+class SharedStateWriter:
+	def __init__(self, path=DEFAULT_PATH):
+		fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+		try:
+			os.ftruncate(fd, SIZE)
+			self.map = mmap.mmap(fd, SIZE)
+		finally:
+			os.close(fd)
+		self.lock = threading.Lock()
+		self.sequence = 0
+		HEADER.pack_into(self.map, 0, MAGIC, VERSION)
+		self.publish({}, False, False, 0)
+
+	# values is {uuid: bytes}.  Anything over 16 values, or longer than 15
+	# bytes, is left out.
+
+	def publish(self, values, ready, linkUp, updated):
+		slots = b""
+		count = 0
+		for uuid, value in list(values.items())[:MAX_SLOTS]:
+			if len(value) > 15:
+				continue
+			slots += SLOT.pack(uuidlib.UUID(uuid).bytes, len(value), value)
+			count += 1
+		flags = (FLAG_READY if ready else 0) | (FLAG_LINK_UP if linkUp else 0)
+
+		with self.lock:
+			self.sequence += 1
+			SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, self.sequence & 0xffffffff)
+			STATE.pack_into(self.map, STATE_OFFSET, flags, count, updated)
+			self.map[SLOTS_OFFSET:SLOTS_OFFSET + len(slots)] = slots
+			self.sequence += 1
+			SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, self.sequence & 0xffffffff)
+
+class SharedStateReader:
+	def __init__(self, path=DEFAULT_PATH):
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			self.map = mmap.mmap(fd, SIZE, prot=mmap.PROT_READ)
+		finally:
+			os.close(fd)
+		magic, version = HEADER.unpack_from(self.map, 0)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError(path + " isn't a reverie shared state segment")
+
+	# Returns ({uuid: bytes}, ready, linkUp, updated).
+
+	def read(self):
+		while True:
+			before, = SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)
+			if before & 1:
+				time.sleep(0)
+				continue
+			data = self.map[STATE_OFFSET:SIZE]
+			after, = SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)
+			if before == after:
+				break
+
+		flags, count, updated = STATE.unpack_from(data, 0)
+		values = {}
+		for slot in range(count):
+			uuid, length, value = SLOT.unpack_from(data, SLOTS_OFFSET - STATE_OFFSET + slot * SLOT.size)
+			values[str(uuidlib.UUID(bytes=uuid))] = value[:length]
+		return values, bool(flags & FLAG_READY), bool(flags & FLAG_LINK_UP), updated
+
+if __name__ == "__main__":
+	values, ready, linkUp, updated = SharedStateReader(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH).read()
+	json.dump({
+		"ready": ready,
+		"linkUp": linkUp,
+		"updated": updated,
+		"values": {uuid: value.hex() for uuid, value in values.items()},
+	}, sys.stdout, indent=1)
+	print()
@@ -0,0 +1,312 @@
+#!/usr/bin/python3
+
+# slimweb.py
+#
+# Just enough of Flask for reverie.py, on the web server that comes with
+# Python, for when Flask, Werkzeug and Jinja take up too much of a small
+# machine's memory and startup time (a Pi Zero, say).  reverie.py uses it
+# instead of Flask when SLIM_MODE is set; the URLs, replies and status codes
+# are all the same.
+#
+# It has the parts of Flask reverie.py uses and no more: routes (with
+# <name>, <int:name> and <path:name> in them), one error handler,
+# before_request and after_request, request (method, args, headers, body and
+# JSON), g, jsonify, and render_template, which only fills in {{ name }} and
+# renders each page once.
+#
+# Connections are kept open between requests (HTTP/1.1), and each one is
+# handled on its own thread.
+
+import html
+import http.server
+import json
+import os
+import re
+import sys
+import threading
+import urllib.parse
+
+###############################################################################
+# Requests and responses
+###############################################################################
+
+class HTTPException(Exception):
+	code = 500
+	name = "Internal Server Error"
+	description = "The server encountered an internal error."
+
+	def response(self):
+		body = "<!doctype html>\n<html lang=en>\n<title>%d %s</title>\n<h1>%s</h1>\n<p>%s</p>\n" % (
+			self.code, self.name, self.name, self.description)
+		return Response(body, self.code)
+
+class NotFound(HTTPException):
+	code = 404
+	name = "Not Found"
+	description = "The requested URL was not found on the server. If you entered the URL manually please check your spelling and try again."
+
+class MethodNotAllowed(HTTPException):
+	code = 405
+	name = "Method Not Allowed"
+	description = "The method is not allowed for the requested URL."
+
+class Args(dict):
+	def to_dict(self):
+		return dict(self)
+
+class Headers(dict):
+	def __init__(self, headers=()):
+		dict.__init__(self, ((name.lower(), value) for name, value in headers))
+
+	def get(self, name, default=None):
+		return dict.get(self, name.lower(), default)
+
+class Response:
+	def __init__(self, body=b"", status=200, headers=None, content_type="text/html; charset=utf-8"):
+		self.data = body.encode() if isinstance(body, str) else body
+		self.status_code = status
+		self.headers = {"Content-Type": content_type}
+		if headers:
+			self.headers.update(headers)
+
+	@property
+	def content_type(self):
+		return self.headers["Content-Type"]
+
+	def get_data(self):
+		return self.data
+
+# The request being handled on this thread, and g, which is cleared for each
+# request.
+
+local = threading.local()
+
+class RequestProxy:
+	def __getattr__(self, name):
+		return getattr(local.request, name)
+
+class GlobalsProxy:
+	def __getattr__(self, name):
+		try:
+			return local.g[name]
+		except KeyError:
+			raise AttributeError(name)
+
+	def __setattr__(self, name, value):
+		local.g[name] = value
+
+	def get(self, name, default=None):
+		return local.g.get(name, default)
+
+request = RequestProxy()
+g = GlobalsProxy()
+
+class Request:
+	def __init__(self, method, path, query, body, headers=None):
+		self.method = method
+		self.path = path
+		self.full_path = path + "?" + query
+		self.args = Args((name, values[0]) for name, values in urllib.parse.parse_qs(query).items())
+		self.data = body
+		self.headers = headers if headers is not None else Headers()
+		self.remote_addr = None
+		self.endpoint = None
+
+	def get_data(self):
+		return self.data
+
+	def get_json(self, force=False, silent=False):
+		try:
+			return json.loads(self.data)
+		except ValueError:
+			if silent:
+				return None
+			raise
+
+def has_request_context():
+	return getattr(local, "request", None) is not None
+
+def jsonify(value):
+	return Response(json.dumps(value, separators=(",", ":"), sort_keys=True) + "\n", content_type="application/json")
+
+# Turn whatever a route returned into a Response, the same way Flask does:
+# a string, or (body, status), or (body, status, headers).
+
+def makeResponse(value):
+	if isinstance(value, Response):
+		return value
+	if isinstance(value, HTTPException):
+		return value.response()
+	if isinstance(value, tuple):
+		body, status, headers = (value + (None,))[:3]
+		response = makeResponse(body)
+		response.status_code = status
+		if headers:
+			response.headers.update(headers)
+		return response
+	return Response(value)
+
+###############################################################################
+# Templates
+###############################################################################
+
+currentApp = None
+rendered = {}
+
+def render_template(name, **context):
+	key = (name, tuple(sorted(context.items())))
+	if key not in rendered:
+		with open(os.path.join(currentApp.root, "templates", name)) as f:
+			page = f.read()
+		rendered[key] = re.sub(r"{{\s*(\w+)\s*}}", lambda match: html.escape(str(context.get(match.group(1), ""))), page)
+	return rendered[key]
+
+###############################################################################
+# The application
+###############################################################################
+
+CONVERTERS = {
+	"default": (r"[^/]+", str),
+	"int": (r"\d+", int),
+	"path": (r".+", str),
+}
+
+class Rule:
+	def __init__(self, rule, methods, function):
+		self.methods = set(methods)
+		if "GET" in self.methods:
+			self.methods.add("HEAD")
+		self.function = function
+		self.converters = {}
+
+		pattern = ""
+		for text, converter, name in re.findall(r"([^<]*)(?:<(?:(\w+):)?(\w+)>)?", rule):
+			pattern += re.escape(text)
+			if name:
+				regex, self.converters[name] = CONVERTERS[converter or "default"]
+				pattern += "(?P<" + name + ">" + regex + ")"
+		self.regex = re.compile(pattern)
+
+	def match(self, path):
+		match = self.regex.fullmatch(path)
+		if match is None:
+			return None
+		return {name: self.converters[name](value) for name, value in match.groupdict().items()}
+
+class Flask:
+	def __init__(self, name):
+		global currentApp
+
+		module = sys.modules.get(name)
+		self.root = os.path.dirname(os.path.abspath(module.__file__)) if module and hasattr(module, "__file__") else os.getcwd()
+		self.rules = []
+		self.errorHandler = None
+		self.beforeRequest = []
+		self.afterRequest = []
+		currentApp = self
+
+	def route(self, rule, methods=("GET",)):
+		def decorator(function):
+			self.rules.append(Rule(rule, methods, function))
+			return function
+		return decorator
+
+	def errorhandler(self, exception):
+		def decorator(function):
+			self.errorHandler = function
+			return function
+		return decorator
+
+	def before_request(self, function):
+		self.beforeRequest.append(function)
+		return function
+
+	def after_request(self, function):
+		self.afterRequest.append(function)
+		return function
+
+	def match(self, method, path):
+		allowed = False
+		for rule in self.rules:
+			args = rule.match(path)
+			if args is None:
+				continue
+			if method in rule.methods:
+				return rule.function, args
+			allowed = True
+		raise MethodNotAllowed() if allowed else NotFound()
+
+	# Handle the request on this thread (see test_request_context()).
+
+	def full_dispatch_request(self):
+		try:
+			try:
+				function, args = self.match(request.method, request.path)
+				request.endpoint = function.__name__
+			except HTTPException as error:
+				function, args = None, error
+
+			value = None
+			for before in self.beforeRequest:
+				value = before()
+				if value is not None:
+					break
+			if value is None:
+				if function is None:
+					raise args
+				value = function(**args)
+		except Exception as error:
+			if self.errorHandler is None:
+				raise
+			value = self.errorHandler(error)
+
+		response = makeResponse(value)
+		for after in self.afterRequest:
+			response = after(response)
+		return response
+
+	def test_request_context(self, path, method="GET", query_string="", data=b"", headers=()):
+		return RequestContext(Request(method, urllib.parse.unquote(path), query_string, data, Headers(headers)))
+
+	def run(self, host="127.0.0.1", port=5000, debug=False):
+		server = http.server.ThreadingHTTPServer((host, int(port)), RequestHandler)
+		server.daemon_threads = True
+		server.app = self
+		print("Serving on http://" + host + ":" + str(port) + " (slim mode)")
+		server.serve_forever()
+
+class RequestContext:
+	def __init__(self, request):
+		self.request = request
+
+	def __enter__(self):
+		local.request = self.request
+		local.g = {}
+		return self
+
+	def __exit__(self, *exception):
+		local.request = None
+		local.g = None
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	disable_nagle_algorithm = True
+
+	def handleRequest(self):
+		path, _, query = self.path.partition("?")
+		length = int(self.headers.get("Content-Length") or 0)
+		body = self.rfile.read(length) if length else b""
+
+		with self.server.app.test_request_context(path, self.command, query, body, self.headers.items()) as context:
+			context.request.remote_addr = self.client_address[0]
+			response = self.server.app.full_dispatch_request()
+
+		self.send_response(response.status_code)
+		for name, value in response.headers.items():
+			self.send_header(name, value)
+		self.send_header("Content-Length", str(len(response.data)))
+		self.end_headers()
+		if self.command != "HEAD":
+			self.wfile.write(response.data)
+
+	do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = handleRequest
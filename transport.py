@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+
+# transport.py
+#
+# How reverie.py talks to the bed over bluetooth.  Everything it does goes
+# through a transport: scan for the bed, connect to it, read and write
+# characteristics by UUID, and disconnect (or connect again).  Which one is
+# used is set with BLE_TRANSPORT:
+#
+#     bluepy    the default, and what this has always used.  bluepy runs a
+#               helper process for each connection and waits for each
+#               operation to finish, so one thing happens at a time.
+#     bleak     asyncio based, talking to BlueZ over D-Bus.  It runs its own
+#               event loop on its own thread, so nothing else waits on it,
+#               and code running on that loop can await reads, writes and
+#               notifications (see BleakTransport.notifications()) at the
+#               same time.
+#     att       ATT straight over an L2CAP socket, without bluepy's helper
+#               process in between, with requests from every thread queued
+#               and sent back to back (see atttransport.py).
+#
+# Each transport has the same methods, which block until they are done, and
+# errors, the exceptions that mean the connection to the bed has failed.
+# services(), readHandle() and writeHandle() reach every characteristic on
+# the bed, not just the ones reverie.py uses, for its /gatt URLs.  readMany()
+# reads several in as few round trips as the transport can (readsAtOnce is
+# true if that's one).
+#
+# A device profile (from dump.py, through reverie.py's loadProfile()) lets
+# the bluepy transport skip looking up the characteristics, and tells both
+# how best to write to each one.
+
+# The bed's name, as it advertises itself.
+BED_NAME = "RevCB_A1"
+
+# Raised by the bleak transport when the connection fails or an operation
+# times out.  It's an OSError, the same as bluepy's own errors when its helper
+# process goes away, so the two are handled the same way.
+
+class TransportError(OSError):
+	pass
+
+# Raised when the bed answers with an error (the characteristic needs
+# encryption, say, or won't take the value) rather than the connection
+# failing, so whoever asked can tell the two apart.  code is the ATT error
+# code, if it's known.
+
+class GattError(TransportError):
+	def __init__(self, message, code=None):
+		TransportError.__init__(self, message)
+		self.code = code
+
+# How a characteristic from a device profile should be written: without a
+# response (which is quicker) when it supports that.
+
+def withResponse(profile, uuid):
+	return "writeWithoutResponse" not in profile["characteristics"][uuid]["properties"]
+
+# Bits in the characteristic properties, from the bluetooth core spec.
+PROPERTIES = [
+	(0x01, "broadcast"),
+	(0x02, "read"),
+	(0x04, "writeWithoutResponse"),
+	(0x08, "write"),
+	(0x10, "notify"),
+	(0x20, "indicate"),
+	(0x40, "authenticatedWrite"),
+	(0x80, "extended"),
+]
+
+def propertyNames(properties):
+	return [name for bit, name in PROPERTIES if properties & bit]
+
+# For transports that can only read one characteristic at a time: read them
+# one after another.  Returns the values, and how many round trips it took.
+
+def readEach(bed, uuids):
+	return [bed.read(uuid) for uuid in uuids], len(uuids)
+
+def profileFor(profile, mac):
+	if not profile or profile["mac"] != mac.lower():
+		return None
+	return profile
+
+###############################################################################
+# bluepy
+###############################################################################
+
+# A characteristic read and written by handle.  With one for every UUID we
+# need from the device profile, there's no service and characteristic
+# discovery to wait for, which is most of the time connecting takes.  And
+# writes can be sent without waiting for the bed to acknowledge them where the
+# characteristic supports that, or with the acknowledgement where it doesn't
+# (bluepy never asks for one on its own).
+
+class ProfiledCharacteristic:
+	def __init__(self, dev, uuid, valueHandle, withResponse):
+		self.dev = dev
+		self.uuid = uuid
+		self.valueHandle = valueHandle
+		self.withResponse = withResponse
+
+	def read(self):
+		return self.dev.readCharacteristic(self.valueHandle)
+
+	def write(self, data):
+		return self.dev.writeCharacteristic(self.valueHandle, data, self.withResponse)
+
+class BluepyTransport:
+	def __init__(self):
+		from bluepy import btle
+
+		self.btle = btle
+		self.errors = (btle.BTLEException, OSError)
+		self.dev = None
+		self.characteristics = {}
+
+	# Returns [(address, rssi)] of every bed found.
+
+	def scan(self, timeout=10.0):
+		found = []
+		for device in self.btle.Scanner().scan(timeout):
+			for (adtype, desc, value) in device.getScanData():
+				if desc == "Complete Local Name" and value == BED_NAME:
+					found.append((device.addr, device.rssi))
+		return found
+
+	def connect(self, mac, uuids, profile=None):
+		self.dev = self.btle.Peripheral(mac, "random")
+		profile = profileFor(profile, mac)
+
+		if profile and all(uuid in profile["characteristics"] for uuid in uuids):
+			print("Using characteristic handles from the device profile")
+			for uuid in uuids:
+				self.characteristics[uuid] = ProfiledCharacteristic(self.dev, uuid,
+					profile["characteristics"][uuid]["valueHandle"], withResponse(profile, uuid))
+			return
+
+		# Since service UUIDs that begin with 0000 are supposed to be reserved,
+		# I am looking for a UUID that is anything else.  This will assign the
+		# first UUID it finds.  With the Reverie beds, this SHOULD be adequate.
+		for primary in self.dev.services:
+			if str(primary.uuid)[:4] != "0000":
+				service = self.dev.getServiceByUUID(primary.uuid)
+		for uuid in uuids:
+			found = service.getCharacteristics(forUUID=uuid)[0]
+			# If there's a profile (for the same bed), it still says how best
+			# to write to each one.
+			if profile and uuid in profile["characteristics"]:
+				found = ProfiledCharacteristic(self.dev, uuid, found.valHandle, withResponse(profile, uuid))
+			self.characteristics[uuid] = found
+
+	# The characteristics found the first time still work after this, so
+	# there's nothing to look up again.
+
+	def reconnect(self, mac):
+		self.dev.connect(mac, "random")
+
+	# Every service and characteristic on the bed, in the same form as dump.py
+	# lists them (without the values).
+
+	def services(self):
+		found = []
+		for svc in self.dev.getServices():
+			service = {"uuid": str(svc.uuid), "start": svc.hndStart, "end": svc.hndEnd, "characteristics": []}
+			for characteristic in svc.getCharacteristics():
+				service["characteristics"].append({
+					"uuid": str(characteristic.uuid),
+					"handle": characteristic.handle,
+					"valueHandle": characteristic.valHandle,
+					"properties": propertyNames(characteristic.properties),
+				})
+			found.append(service)
+		return found
+
+	def disconnect(self):
+		self.dev.disconnect()
+
+	def read(self, uuid):
+		return self.characteristics[uuid].read()
+
+	def write(self, uuid, data):
+		self.characteristics[uuid].write(data)
+
+	# bluepy has no way to read several at once.
+
+	readsAtOnce = False
+
+	def readMany(self, uuids):
+		return readEach(self, uuids)
+
+	# Any characteristic at all, by its value handle.
+
+	def readHandle(self, handle):
+		try:
+			return self.dev.readCharacteristic(handle)
+		except self.btle.BTLEGattError as error:
+			raise GattError(str(error), getattr(error, "estat", None))
+
+	def writeHandle(self, handle, data, withResponse=True):
+		try:
+			self.dev.writeCharacteristic(handle, data, withResponse)
+		except self.btle.BTLEGattError as error:
+			raise GattError(str(error), getattr(error, "estat", None))
+
+# The bleak transport is in bleaktransport.py, so asyncio (which takes a while
+# to import) is only imported when it's used, and the att transport is in
+# atttransport.py.
+
+def bleakTransport():
+	from bleaktransport import BleakTransport
+	return BleakTransport()
+
+def attTransport():
+	from atttransport import AttTransport
+	return AttTransport()
+
+TRANSPORTS = {
+	"bluepy": BluepyTransport,
+	"bleak": bleakTransport,
+	"att": attTransport,
+}
@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+
+# unixsocket.py
+#
+# A small command protocol for clients on the same machine as reverie.py,
+# over a Unix domain socket instead of TCP and HTTP.  Anything that can reach
+# the socket file can control the bed, so access is controlled with the
+# file's owner, group and permissions.
+#
+# Every URL the HTTP API has can be sent.  A request is one line: the URL path
+# (the leading / is optional, and spaces can be used instead of slashes), with
+# an optional method in front, and an optional client name (for taking turns
+# with other clients; see CLIENT_WEIGHTS in reverie.py) on the end.  A body
+# needs a method in front, and its length after a + at the very end; without
+# a method, a +number at the end is part of the path, as in adjust:
+#
+#     setHead 50
+#     /getHead
+#     adjust head +5
+#     adjust head -5
+#     schedule/add/setHead?value=60&in=30
+#     POST massageProgram +42        (followed by 42 bytes of body)
+#     setHead 50 @homebridge
+#     GET adjust head +5 @homebridge +0
+#
+# The reply is the HTTP status code, the length of the body and its content
+# type, on one line, followed by the body:
+#
+#     200 27 text/html; charset=utf-8
+#     Head Position Set to: 50
+#
+# A connection can be kept open and used for as many requests as you like.
+
+import os
+import socket
+import socketserver
+import threading
+
+METHODS = ("GET", "POST", "PUT", "DELETE")
+
+# Only plain spaces separate the words of a request line.  Newlines, tabs and
+# anything else unprintable (which a URL has %-encoded) aren't allowed in it,
+# since they could end it early.
+
+def controlCharacters(text):
+	return any(not character.isprintable() for character in text)
+
+# Turn a request line into a method, path, body length and client name (None
+# if it doesn't give one).
+
+def parseRequest(line):
+	line = line.rstrip("\r\n")
+	if controlCharacters(line):
+		raise ValueError("control characters in request")
+	words = [word for word in line.split(" ") if word]
+	method = "GET"
+	length = 0
+	client = None
+
+	if words and words[0].upper() in METHODS:
+		method = words.pop(0).upper()
+		if words and words[-1].startswith("+"):
+			length = int(words.pop()[1:])
+	if words and words[-1].startswith("@"):
+		client = words.pop()[1:] or None
+	if not words:
+		raise ValueError("empty request")
+
+	return method, "/" + "/".join(words).lstrip("/"), length, client
+
+###############################################################################
+# Server
+###############################################################################
+
+class CommandHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		while True:
+			line = self.rfile.readline()
+			if not line:
+				return
+
+			try:
+				method, path, length, client = parseRequest(line.decode())
+				body = self.rfile.read(length) if length else b""
+				status, reply, contentType = self.server.dispatch(method, path, body, client)
+			except ValueError as error:
+				status, reply, contentType = 400, str(error).encode(), "text/plain"
+
+			self.wfile.write(b"%d %d %s\n" % (status, len(reply), contentType.encode()) + reply)
+			self.wfile.flush()
+
+class CommandServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+	# dispatch is called with (method, path, body, client) and returns a status code,
+	# the reply as bytes, and its content type.  mode is the permissions of the
+	# socket file, and group, if set, is the group that gets to use it.
+
+	def __init__(self, path, dispatch, mode=0o660, group=None):
+		self.dispatch = dispatch
+
+		directory = os.path.dirname(path)
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+
+		# A socket left over from the last run would stop us binding.
+		if os.path.exists(path):
+			os.unlink(path)
+
+		# Make sure nobody else can connect in the moment between creating
+		# the socket and setting its permissions.
+		oldmask = os.umask(0o177)
+		try:
+			socketserver.UnixStreamServer.__init__(self, path, CommandHandler)
+		finally:
+			os.umask(oldmask)
+
+		if group:
+			import grp
+			os.chown(path, -1, grp.getgrnam(group).gr_gid)
+		os.chmod(path, mode)
+
+	def start(self):
+		thread = threading.Thread(target=self.serve_forever, name="unixsocket", daemon=True)
+		thread.start()
+		return thread
+
+###############################################################################
+# Client
+###############################################################################
+
+class CommandClient:
+	def __init__(self, path):
+		self.path = path
+		self.sock = None
+		self.file = None
+
+	def connect(self):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.connect(self.path)
+		self.file = self.sock.makefile("rwb")
+
+	def close(self):
+		if self.sock is not None:
+			self.file.close()
+			self.sock.close()
+			self.sock = None
+
+	# Send one request and return (status, reply).  command is written the
+	# same way as a request line, i.e. "setHead 50".  client, if given, is
+	# the name of the client it's for.
+
+	def send(self, command, body=b"", method=None, client=None):
+		status, contentType, reply = self.request(command, body, method, client)
+		return status, reply
+
+	# The same, but returns (status, content type, reply).
+
+	def request(self, command, body=b"", method=None, client=None):
+		if self.sock is None:
+			self.connect()
+
+		if controlCharacters(command):
+			raise ValueError("control characters in command")
+
+		# Always with a method and a length, so a +number at the end of
+		# command can't be taken for the length.
+		line = (method or "GET") + " " + command
+		if client:
+			line += " @" + "_".join(client.split())
+		line += " +" + str(len(body))
+		self.file.write(line.encode() + b"\n" + body)
+		self.file.flush()
+
+		header = self.file.readline().decode().split(None, 2)
+		if len(header) < 2:
+			self.close()
+			raise ConnectionError("connection closed by reverie")
+		status, length = int(header[0]), int(header[1])
+		contentType = header[2].strip() if len(header) > 2 else "text/plain"
+		return status, contentType, self.file.read(length)
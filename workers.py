@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+# workers.py
+#
+# Runs reverie.py's web server in several worker processes, so the HTTP side
+# doesn't share a GIL (and a CPU) with the process that talks to the bed.
+#
+# The main process opens the listening socket, then starts each worker as a
+# fresh copy of reverie.py with the socket's file descriptor in
+# REVERIE_WORKER_FD.  The workers all accept connections from the same socket.
+# A worker that dies is started again, and a worker whose main process has
+# gone away (restarted by systemd, say) exits.
+
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+def listen(host, port):
+	family = socket.AF_INET6 if ":" in host else socket.AF_INET
+	sock = socket.socket(family, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+	# Workers from the last run can take a moment to notice it's gone and let
+	# go of the port.
+	for attempt in range(10):
+		try:
+			sock.bind((host, int(port)))
+			break
+		except OSError:
+			if attempt == 9:
+				raise
+			time.sleep(0.5)
+
+	sock.listen(128)
+	sock.set_inheritable(True)
+	return sock
+
+# The workers running now, by number.
+
+running = {}
+
+# Start count workers running script, sharing sock, and keep them running.
+
+def startWorkers(count, sock, script, env=None):
+	def worker(number):
+		while True:
+			workerEnv = dict(os.environ if env is None else env)
+			workerEnv["REVERIE_WORKER_FD"] = str(sock.fileno())
+			workerEnv["REVERIE_WORKER_PARENT"] = str(os.getpid())
+			workerEnv["REVERIE_WORKER_NUMBER"] = str(number)
+			process = subprocess.Popen([sys.executable, script], env=workerEnv, pass_fds=[sock.fileno()])
+			running[number] = process
+			print("Started HTTP worker " + str(number) + " (pid " + str(process.pid) + ")")
+			status = process.wait()
+			print("HTTP worker " + str(number) + " exited with status " + str(status) + "; restarting")
+			time.sleep(1)
+
+	for number in range(1, count + 1):
+		threading.Thread(target=worker, args=(number,), name="worker" + str(number), daemon=True).start()
+
+def signalWorkers(signum):
+	for process in list(running.values()):
+		if process.poll() is None:
+			process.send_signal(signum)
+
+# In a worker: serve app on the inherited socket until the main process goes
+# away.  host and port are what the main process is listening on.
+
+def serveWorker(app, host, port):
+	from werkzeug.serving import make_server
+
+	parent = int(os.environ["REVERIE_WORKER_PARENT"])
+
+	def watchParent():
+		while os.getppid() == parent:
+			time.sleep(1)
+		os._exit(0)
+
+	threading.Thread(target=watchParent, name="watchParent", daemon=True).start()
+
+	server = make_server(host, int(port), app, threaded=True, fd=int(os.environ["REVERIE_WORKER_FD"]))
+	server.serve_forever()